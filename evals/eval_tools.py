@@ -5,18 +5,26 @@ import pandas as pd
 import multiprocessing
 import tensorflow as tf
 import os
+import json
 from collections import deque
 import matplotlib.pyplot as plt
 
 
-def create_nn_prediction(dataset_path, model_path="../DATA/Trained_model", threshold=0.5, batch_size=1024,
-                         verbose=True):
-    if type(dataset_path) is str:
-        dataset_path = [dataset_path]
-        dataset_path_iterable = False
-    else:
-        dataset_path_iterable = True
-    predictions_list = ()
+def load_prediction_model(model_path, mixed_precision=False, jit_compile=False, steps_per_execution=1,
+                          full_frame=False, verbose=True):
+    """
+    Loads a trained model for inference, optionally rebuilt with inputs of any size (see tools.model.full_frame_model),
+    with its batch normalizations folded and dropout removed (see tools.model.inference_model), in the requested
+    precision and compiled for prediction.
+
+    :param model_path: Path to the model
+    :param mixed_precision: Predict in mixed precision
+    :param jit_compile: Compile the prediction with XLA
+    :param steps_per_execution: Number of batches predicted in one compiled call
+    :param full_frame: Rebuild the model to predict whole frames
+    :param verbose: Verbose output
+    :return: Compiled model
+    """
     if len(tf.config.list_physical_devices('GPU')) == 0:
         if verbose:
             print("No GPU detected")
@@ -24,28 +32,179 @@ def create_nn_prediction(dataset_path, model_path="../DATA/Trained_model", thres
     else:
         mirrored_strategy = tf.distribute.MirroredStrategy()
     with mirrored_strategy.scope():
-        model = tf.keras.models.load_model(model_path, compile=False, safe_mode=False)
-    for i, dataset in enumerate(dataset_path):
-        if not os.path.exists(dataset):
-            raise FileNotFoundError(f"Dataset {dataset} not found")
-
-        dataset_test = tf.data.TFRecordDataset([dataset])
-        tfrecord_shape = tools.model.get_shape_of_quadratic_image_tfrecord(dataset_test)
-        dataset_test = dataset_test.interleave(lambda x: tf.data.Dataset.from_tensors(
-            tools.model.parse_function(img_shape=tfrecord_shape, test=True)(x)),
-                                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        dataset_test = dataset_test.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+        model = tools.model.load_model(model_path)
+        if full_frame:
+            model = tools.model.full_frame_model(model)
+        model = tools.model.inference_model(model)
+        model = tools.model.cast_model(model, tools.model.precision_policy(mixed_precision))
+        jit_mode = tools.model.jit_compile_mode(model, jit_compile)
+        if jit_mode == "autoclustering":
+            tf.config.optimizer.set_jit("autoclustering")
+        model.compile(jit_compile=jit_mode == "xla", steps_per_execution=steps_per_execution)
+    return model
+
+
+def load_tile_gate(gate_path, recall=0.99, mixed_precision=False):
+    """
+    Loads a tile gate trained by train/gate.py and the threshold at which it keeps the target recall of the tiles with
+    trails on its validation tiles.
+
+    :param gate_path: Path to the gate model
+    :param recall: Target recall of the gate
+    :param mixed_precision: Predict in mixed precision
+    :return: Compiled gate model and its threshold
+    """
+    gate = tools.model.load_model(gate_path)
+    gate = tools.model.inference_model(gate)
+    gate = tools.model.cast_model(gate, tools.model.precision_policy(mixed_precision))
+    gate.compile()
+    with open(tools.model.gate_calibration_path(gate_path)) as f:
+        positive_scores = json.load(f)["positive_scores"]
+    return gate, tools.metrics.threshold_for_recall(positive_scores, np.ones(len(positive_scores)), recall)
+
+
+def gated_prediction(model, dataset, gate, gate_threshold, verbose=True):
+    """
+    Predicts a dataset of tile batches, running the segmentation model only on the tiles that contain data (not only
+    zeros from padding or NO_DATA) and whose gate score reaches gate_threshold. The other tiles are predicted empty.
+
+    :param model: Segmentation model (Keras or tools.tflite.TFLiteModel)
+    :param dataset: Dataset of batches of tiles
+    :param gate: Tile gate model
+    :param gate_threshold: Gate score from which a tile is segmented
+    :param verbose: Verbose output
+    :return: Array of predictions of all tiles
+    """
+    def inference_function(m):
+        # traced once for any number of tiles, the number of tiles passing the gate changes from batch to batch
+        return tf.function(lambda x: m(x, training=False), jit_compile=bool(m.jit_compile),
+                           input_signature=[tf.TensorSpec((None,) + tuple(m.inputs[0].shape[1:]), tf.float32)])
+
+    segment = inference_function(model) if isinstance(model, tf.keras.Model) else model.predict_on_batch
+    score = inference_function(gate)
+    output_shape = tuple(model.output_shape[1:])
+    predictions = []
+    n_segmented = 0
+    for x in dataset:
+        has_data = tf.reduce_any(tf.logical_and(tf.math.is_finite(x), tf.not_equal(x, 0)), axis=[1, 2, 3]).numpy()
+        keep = np.flatnonzero(has_data)
+        if len(keep) > 0:
+            keep = keep[score(tf.gather(x, keep)).numpy()[:, 0] >= gate_threshold]
+        batch = np.zeros((len(x),) + output_shape, dtype=np.float32)
+        if len(keep) > 0:
+            batch[keep] = np.asarray(segment(tf.gather(x, keep)))
+        predictions.append(batch)
+        n_segmented += len(keep)
+    predictions = np.concatenate(predictions)
+    if verbose:
+        print("{} of {} tiles passed the gate".format(n_segmented, len(predictions)))
+    return predictions
+
+
+def tiled_prediction(model, dataset, threshold=0.5, batch_size=1024, verbose=True, gate=None, gate_threshold=0.):
+    """
+    Predicts the tiles of a TFRecord dataset and stitches them back into frames. With a gate, only the tiles passing
+    it are segmented (see gated_prediction).
+
+    :param model: Model returned by load_prediction_model, or a tools.tflite.TFLiteModel
+    :param dataset: Path to the TFRecord dataset
+    :param threshold: Threshold of the predictions (0 returns the probabilities)
+    :param batch_size: Number of tiles predicted at once
+    :param verbose: Verbose output
+    :param gate: Tile gate model returned by load_tile_gate (Optional)
+    :param gate_threshold: Threshold of the gate
+    :return: Array of frames, or list of frames if their shapes differ
+    """
+    dataset_test = tools.data.load_tfrecord_dataset(dataset, ordered=True)
+    schema = tools.data.get_dataset_schema(dataset)
+    tfrecord_shape = schema["shape"]
+    dataset_test = dataset_test.batch(batch_size).map(
+        tools.model.parse_function(img_shape=tfrecord_shape, test=True, schema=schema, batched=True),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset_test = dataset_test.prefetch(tf.data.experimental.AUTOTUNE)
+    if gate is None:
         predictions = model.predict(dataset_test, verbose=1 if verbose else 0)
+    else:
+        predictions = gated_prediction(model, dataset_test, gate, gate_threshold, verbose=verbose)
+    if threshold > 0:
+        predictions = (predictions > threshold).astype(float)
+    else:
+        predictions = predictions.astype(float)
+    if not tuple(model.output_shape[1:]) == tfrecord_shape:
+        with tf.device("/cpu:0"):
+            predictions = np.array(tf.image.resize(predictions, tfrecord_shape[:-1]))
+    if threshold > 0:
+        predictions = np.ceil(predictions)
+    return tools.tiling.merge_frames(predictions[..., 0], tools.data.get_frame_shapes(dataset))
+
+
+def full_frame_prediction(model, dataset, threshold=0.5, batch_size=1024, verbose=True):
+    """
+    Predicts whole frames of a TFRecord dataset with a model returned by load_prediction_model(full_frame=True). The
+    tiles are stitched into frames, every frame is padded with zeros to a multiple of tools.model.frame_multiple and
+    predicted in one call, and the prediction is cropped back to the frame.
+
+    :param model: Fully convolutional model
+    :param dataset: Path to the TFRecord dataset
+    :param threshold: Threshold of the predictions (0 returns the probabilities)
+    :param batch_size: Number of tiles parsed at once
+    :param verbose: Verbose output
+    :return: Array of frames, or list of frames if their shapes differ
+    """
+    schema = tools.data.get_dataset_schema(dataset)
+    dataset_test = tools.data.load_tfrecord_dataset(dataset, ordered=True).batch(batch_size).map(
+        tools.model.parse_function(img_shape=schema["shape"], test=True, schema=schema, batched=True),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    frames = tools.tiling.merge_frames(np.concatenate([x.numpy() for x in dataset_test]),
+                                       tools.data.get_frame_shapes(dataset))
+    multiple = tools.model.frame_multiple(model)
+    predictions = []
+    for i, frame in enumerate(frames):
+        padded_shape = tuple(-(-size // multiple) * multiple for size in frame.shape[:2])
+        padded = np.zeros((1,) + padded_shape + frame.shape[2:], dtype=frame.dtype)
+        padded[0, :frame.shape[0], :frame.shape[1]] = frame
+        prediction = np.asarray(model.predict_on_batch(padded), dtype=float)
         if threshold > 0:
-            predictions = (predictions > threshold).astype(float)
-        else:
-            predictions = predictions.astype(float)
-        if not tuple(model.outputs[0].shape[1:]) == tfrecord_shape:
+            prediction = (prediction > threshold).astype(float)
+        if prediction.shape[1:3] != padded_shape:
             with tf.device("/cpu:0"):
-                predictions = np.array(tf.image.resize(predictions, tfrecord_shape[:-1]))
+                prediction = np.array(tf.image.resize(prediction, padded_shape))
         if threshold > 0:
-            predictions = np.ceil(predictions)
-        predictions = tools.data.npy_merge(predictions, (4176, 2048))
+            prediction = np.ceil(prediction)
+        predictions.append(prediction[0, :frame.shape[0], :frame.shape[1], 0])
+        if verbose:
+            print("Frame {}/{} predicted".format(i + 1, len(frames)), end="\r" if i + 1 < len(frames) else "\n")
+    if len(set(prediction.shape for prediction in predictions)) == 1:
+        return np.stack(predictions)
+    return predictions
+
+
+def create_nn_prediction(dataset_path, model_path="../DATA/Trained_model", threshold=0.5, batch_size=1024,
+                         verbose=True, mixed_precision=False, jit_compile=False, steps_per_execution=1,
+                         full_frame=False, gate_path="", gate_recall=0.99, num_threads=None):
+    if type(dataset_path) is str:
+        dataset_path = [dataset_path]
+        dataset_path_iterable = False
+    else:
+        dataset_path_iterable = True
+    predictions_list = ()
+    if model_path.endswith(".tflite"):
+        # exported by tools/export_tflite.py, predicted on the CPU by the TensorFlow Lite interpreter
+        if full_frame:
+            raise ValueError("TensorFlow Lite models predict tiles of a fixed size, full_frame is not supported")
+        model = tools.tflite.TFLiteModel(model_path, num_threads=num_threads)
+    else:
+        model = load_prediction_model(model_path, mixed_precision=mixed_precision, jit_compile=jit_compile,
+                                      steps_per_execution=steps_per_execution, full_frame=full_frame,
+                                      verbose=verbose)
+    gate_kwargs = {}
+    if gate_path != "" and not full_frame:
+        gate, gate_threshold = load_tile_gate(gate_path, recall=gate_recall, mixed_precision=mixed_precision)
+        gate_kwargs = {"gate": gate, "gate_threshold": gate_threshold}
+    predict = full_frame_prediction if full_frame else tiled_prediction
+    for i, dataset in enumerate(dataset_path):
+        predictions = predict(model, dataset, threshold=threshold, batch_size=batch_size, verbose=verbose,
+                              **gate_kwargs)
         if not dataset_path_iterable:
             return predictions
         else:
@@ -187,13 +346,19 @@ def one_image_hits(butler, injected_calexp_ref, postisrccd_catalog_ref,
     injected_origin = injected_calexp_wcs.skyToPixelArray(np.array([injected_postisrccd_catalog["ra"]]),
                                                           np.array([injected_postisrccd_catalog["dec"]]),
                                                           degrees=True)
-    injected_angle = injected_postisrccd_catalog["beta"]
-    injected_length = injected_postisrccd_catalog["trail_length"]
+    injected_segments = tools.data.trail_segments(injected_postisrccd_catalog, injected_calexp_wcs)
+    line_thickness = 2
 
     for i, catalog_row in enumerate(injected_postisrccd_catalog):
-        injected_mask = tools.data.draw_one_line(np.zeros(calexp_dimensions),
-                                                 (injected_origin[0][i], injected_origin[1][i]),
-                                                 injected_angle[i], injected_length[i])
+        # draw the trail only into the window around it, the rest of the frame is empty
+        x0, y0, x1, y1 = injected_segments[i]
+        rows = slice(int(np.clip(min(y0, y1) - line_thickness, 0, calexp_dimensions[0])),
+                     int(np.clip(max(y0, y1) + line_thickness + 1, 0, calexp_dimensions[0])))
+        cols = slice(int(np.clip(min(x0, x1) - line_thickness, 0, calexp_dimensions[1])),
+                     int(np.clip(max(x0, x1) + line_thickness + 1, 0, calexp_dimensions[1])))
+        injected_mask = tools.data.draw_segments(injected_segments[i] - [cols.start, rows.start] * 2,
+                                                 (rows.stop - rows.start, cols.stop - cols.start),
+                                                 line_thickness=line_thickness)
         result = {'injection_id': catalog_row['injection_id'],
                   'ra': catalog_row['ra'],
                   'dec': catalog_row['dec'],
@@ -209,12 +374,12 @@ def one_image_hits(butler, injected_calexp_ref, postisrccd_catalog_ref,
 
         # Neural network detection flag
         if nn_predictions is not None:
-            result["NN_detected"] = int(((injected_mask == 1) & (nn_predictions == 1)).sum() > 0)
+            result["NN_detected"] = int(((injected_mask == 1) & (nn_predictions[rows, cols] == 1)).sum() > 0)
 
         # Stack detection processing
         if stack_source_catalog_id is not None:
-            if (injected_mask * stack_predictions).sum() > 0:
-                intersection_injection_stack = injected_mask * stack_predictions
+            intersection_injection_stack = injected_mask * stack_predictions[rows, cols]
+            if intersection_injection_stack.sum() > 0:
                 stack_index = int(intersection_injection_stack[np.where(intersection_injection_stack != 0)][0])
                 result["stack_detected"] = 1
                 result["stack_magnitude"] = magnitude[isc["id"] == stack_index].flatten()[0]
@@ -226,6 +391,9 @@ def one_image_hits(butler, injected_calexp_ref, postisrccd_catalog_ref,
 
         # Create cutout if cutouts_path is provided
         if cutouts_path != "":
+            frame_mask = np.zeros(calexp_dimensions, dtype=np.uint8)
+            frame_mask[rows, cols] = injected_mask
+            injected_mask = frame_mask
             calexp_image = image_data.image.array
             calexp_mask = image_data.mask
             if nn_predictions is None:
@@ -0,0 +1,96 @@
+import time
+import sys
+sys.path.append("..")
+import argparse
+import json
+import numpy as np
+import tensorflow as tf
+import tools
+
+
+def synthetic_dataset(tile_shape, output_shape, batch_size, seed=42):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(scale=20, size=(batch_size,) + tile_shape).astype(np.float32)
+    y = (rng.random((batch_size,) + output_shape) > 0.95).astype(np.float32)
+    return tf.data.Dataset.from_tensors((x, y)).repeat()
+
+
+def benchmark(arhitecture, args, jit_compile, steps_per_execution):
+    """
+    Returns the training and prediction throughput in tiles per second of a freshly built model. The first
+    compiled call (tracing and XLA compilation) is excluded from the timing.
+    """
+    tf.keras.backend.clear_session()
+    tile_shape = (args.tile_size, args.tile_size, 1)
+    model = tools.model.unet_model(tile_shape, dict(arhitecture), kernel_size=args.kernel_size)
+    jit_mode = tools.model.jit_compile_mode(model, jit_compile)
+    # auto-clustering is global, it is only enabled for the runs of models that fall back to it
+    tf.config.optimizer.set_jit("autoclustering" if jit_mode == "autoclustering" else False)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
+                  loss=tools.metrics.FocalTversky(alpha=0.9, gamma=3),
+                  metrics=[tools.metrics.ConfusionMetrics()],
+                  jit_compile=jit_mode == "xla",
+                  steps_per_execution=steps_per_execution)
+    dataset = synthetic_dataset(tile_shape, tuple(model.outputs[0].shape[1:]), args.batch_size)
+    steps = max(args.steps // steps_per_execution, 1) * steps_per_execution
+    model.fit(dataset, epochs=1, steps_per_epoch=steps_per_execution, verbose=0)
+    start = time.time()
+    model.fit(dataset, epochs=1, steps_per_epoch=steps, verbose=0)
+    train_throughput = steps * args.batch_size / (time.time() - start)
+
+    inputs = dataset.map(lambda x, y: x)
+    model.predict(inputs, steps=steps_per_execution, verbose=0)
+    start = time.time()
+    model.predict(inputs, steps=steps, verbose=0)
+    predict_throughput = steps * args.batch_size / (time.time() - start)
+    return train_throughput, predict_throughput
+
+
+def main(args):
+    with open(args.arhitecture) as f:
+        arhitecture = json.load(f)
+    if "0" in arhitecture.keys():
+        arhitecture = arhitecture["0"]
+    tools.model.set_precision_policy(args.mixed_precision)
+    model = tools.model.unet_model((args.tile_size, args.tile_size, 1), dict(arhitecture), kernel_size=args.kernel_size)
+    print("Whole model compiles with XLA:", tools.model.supports_jit_compile(model),
+          "(otherwise jit_compile uses XLA auto-clustering)", flush=True)
+    print("{:>12} {:>20} {:>18} {:>20}".format("jit_compile", "steps_per_execution", "train tiles/s",
+                                              "predict tiles/s"), flush=True)
+    for jit_compile in (False, True):
+        for steps_per_execution in args.steps_per_execution:
+            train_throughput, predict_throughput = benchmark(arhitecture, args, jit_compile, steps_per_execution)
+            print("{:>12} {:>20} {:>18.1f} {:>20.1f}".format(str(jit_compile), steps_per_execution, train_throughput,
+                                                              predict_throughput), flush=True)
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Throughput of the model with and without XLA compilation.")
+
+    parser.add_argument('--arhitecture', type=str,
+                        default="../arhitecture.json",
+                        help='Path to a JSON containing definition of an arhitecture.')
+    parser.add_argument('--tile_size', type=int,
+                        default=128,
+                        help='Size of the input tiles.')
+    parser.add_argument('--kernel_size', type=int,
+                        default=3,
+                        help='Size of the kernel.')
+    parser.add_argument('--batch_size', type=int,
+                        default=32,
+                        help='Batch size.')
+    parser.add_argument('--steps', type=int,
+                        default=20,
+                        help='Number of timed batches.')
+    parser.add_argument('--steps_per_execution', type=int, nargs="+",
+                        default=[1, 8],
+                        help='Values of steps_per_execution to compare.')
+    parser.add_argument('--mixed_precision', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Benchmark in mixed precision.')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,75 @@
+import time
+import sys
+sys.path.append("..")
+import argparse
+import numpy as np
+import tensorflow as tf
+import tools
+import evals.eval_tools
+
+
+def timed_prediction(predict, model, args):
+    """
+    Returns the predictions of a dataset and the number of frames predicted per second. A first untimed run traces and
+    compiles the prediction functions.
+    """
+    predict(model, args.dataset_path, threshold=args.threshold, batch_size=args.batch_size, verbose=False)
+    start = time.time()
+    for _ in range(args.repeats):
+        predictions = predict(model, args.dataset_path, threshold=args.threshold, batch_size=args.batch_size,
+                              verbose=False)
+    return predictions, args.repeats * len(predictions) / (time.time() - start)
+
+
+def main(args):
+    throughputs = {}
+    predictions = {}
+    for mode, predict in (("tiled", evals.eval_tools.tiled_prediction),
+                          ("full frame", evals.eval_tools.full_frame_prediction)):
+        tf.keras.backend.clear_session()
+        model = evals.eval_tools.load_prediction_model(args.model_path, mixed_precision=args.mixed_precision,
+                                                       full_frame=mode == "full frame", verbose=False)
+        predictions[mode], throughputs[mode] = timed_prediction(predict, model, args)
+    print("{:>12} {:>12}".format("mode", "frames/s"))
+    for mode, throughput in throughputs.items():
+        print("{:>12} {:>12.3f}".format(mode, throughput))
+    print("Full frame speed-up: {:.2f}x".format(throughputs["full frame"] / throughputs["tiled"]))
+
+    # the channel attention pools over the whole input, so the two modes do not predict exactly the same pixels
+    tiled = np.concatenate([np.ravel(frame) for frame in predictions["tiled"]])
+    full_frame = np.concatenate([np.ravel(frame) for frame in predictions["full frame"]])
+    if args.threshold > 0:
+        tp = np.count_nonzero((tiled > 0) & (full_frame > 0))
+        print("Pixels predicted equally: {:.4%}, F1 score of the full frame against the tiled masks: {:.4f}".format(
+            np.mean(tiled == full_frame), 2 * tp / max(np.count_nonzero(tiled) + np.count_nonzero(full_frame), 1)))
+    else:
+        print("Mean absolute difference of the probabilities: {:.6f}".format(np.mean(np.abs(tiled - full_frame))))
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Throughput of tiled and full frame prediction.")
+
+    parser.add_argument('--model_path', type=str,
+                        default="../DATA/Trained_model.keras",
+                        help='Path to the model.')
+    parser.add_argument('--dataset_path', type=str,
+                        default="../DATA/test1.tfrecord",
+                        help='Path to the TFRecord dataset.')
+    parser.add_argument('--batch_size', type=int,
+                        default=1024,
+                        help='Batch size of the tiled prediction.')
+    parser.add_argument('--threshold', type=float,
+                        default=0.5,
+                        help='Threshold for the predictions (0 compares the probabilities).')
+    parser.add_argument('--repeats', type=int,
+                        default=3,
+                        help='Number of timed predictions of the dataset.')
+    parser.add_argument('--mixed_precision', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Predict in mixed precision.')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
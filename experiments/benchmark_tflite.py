@@ -0,0 +1,98 @@
+import time
+import sys
+sys.path.append("..")
+import argparse
+import numpy as np
+import tensorflow as tf
+import tools
+import evals.eval_tools
+
+
+def timed_prediction(model, args):
+    """
+    Returns the tiled predictions of a dataset and the number of frames predicted per second. A first untimed run
+    traces the prediction function or allocates the interpreter tensors.
+    """
+    evals.eval_tools.tiled_prediction(model, args.dataset_path, threshold=args.threshold, batch_size=args.batch_size,
+                                      verbose=False)
+    start = time.time()
+    for _ in range(args.repeats):
+        predictions = evals.eval_tools.tiled_prediction(model, args.dataset_path, threshold=args.threshold,
+                                                        batch_size=args.batch_size, verbose=False)
+    return predictions, args.repeats * len(predictions) / (time.time() - start)
+
+
+def scores(truths, predictions):
+    """
+    Returns the pixel F1 score, the trail F1 score and the completeness (fraction of the true trails detected) of the
+    thresholded predictions of a dataset.
+    """
+    pixel_tp = pixel_fp = pixel_fn = tp = fp = fn = 0
+    for truth, prediction in zip(truths, predictions):
+        truth, prediction = truth != 0, prediction != 0
+        pixel_tp += np.count_nonzero(truth & prediction)
+        pixel_fp += np.count_nonzero(~truth & prediction)
+        pixel_fn += np.count_nonzero(truth & ~prediction)
+        frame_tp, frame_fp, frame_fn, _ = evals.eval_tools.get_one_image_mask(truth, prediction)
+        tp, fp, fn = tp + frame_tp, fp + frame_fp, fn + frame_fn
+    return {"F1": 2 * pixel_tp / max(2 * pixel_tp + pixel_fp + pixel_fn, 1),
+            "trail F1": 2 * tp / max(2 * tp + fp + fn, 1),
+            "completeness": tp / max(tp + fn, 1)}
+
+
+def main(args):
+    _, truths = tools.data.create_XY_pairs(args.dataset_path, batch_size=args.batch_size)
+    models = {"float32": lambda: evals.eval_tools.load_prediction_model(args.model_path, verbose=False)}
+    for path in args.tflite_paths:
+        models[path] = lambda path=path: tools.tflite.TFLiteModel(path, num_threads=args.num_threads)
+
+    results = {}
+    for name, load in models.items():
+        tf.keras.backend.clear_session()
+        model = load()
+        predictions, throughput = timed_prediction(model, args)
+        results[name] = dict(scores(truths, predictions), throughput=throughput)
+        if isinstance(model, tools.tflite.TFLiteModel) and model.delegate is None:
+            print(name, "runs without the XNNPACK delegate")
+
+    reference = results["float32"]
+    print("{:>40} {:>10} {:>9} {:>9} {:>10} {:>9} {:>12} {:>13}".format(
+        "model", "frames/s", "speed-up", "F1", "F1 drift", "trail F1", "completeness", "compl. drift"))
+    for name, result in results.items():
+        print("{:>40} {:>10.3f} {:>8.2f}x {:>9.4f} {:>+10.4f} {:>9.4f} {:>12.4f} {:>+13.4f}".format(
+            name[-40:], result["throughput"], result["throughput"] / reference["throughput"], result["F1"],
+            result["F1"] - reference["F1"], result["trail F1"], result["completeness"],
+            result["completeness"] - reference["completeness"]))
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Speed and accuracy drift of TensorFlow Lite models against the "
+                                                 "float32 Keras model on the CPU.")
+
+    parser.add_argument('--model_path', type=str,
+                        default="../DATA/Trained_model.keras",
+                        help='Path to the float32 Keras model.')
+    parser.add_argument('--tflite_paths', type=str, nargs="+",
+                        default=["../DATA/Trained_model_int8.tflite"],
+                        help='Paths to the models exported by tools/export_tflite.py.')
+    parser.add_argument('--dataset_path', type=str,
+                        default="../DATA/test1.tfrecord",
+                        help='Path to the TFRecord dataset.')
+    parser.add_argument('--batch_size', type=int,
+                        default=1024,
+                        help='Batch size of the tiled prediction.')
+    parser.add_argument('--threshold', type=float,
+                        default=0.5,
+                        help='Threshold for the predictions.')
+    parser.add_argument('--repeats', type=int,
+                        default=3,
+                        help='Number of timed predictions of the dataset.')
+    parser.add_argument('--num_threads', type=int,
+                        default=None,
+                        help='Number of TensorFlow Lite interpreter threads (default: all cores).')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
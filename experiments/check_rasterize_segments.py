@@ -0,0 +1,70 @@
+import sys
+sys.path.append("..")
+import argparse
+import numpy as np
+import tensorflow as tf
+import tools
+
+
+def random_segments(rng, frame_shape, n, margin):
+    """
+    Returns n random trails lying inside the frame, a quarter of them shorter than 5 pixels.
+    """
+    x0 = rng.integers(margin, frame_shape[1] - margin, n)
+    y0 = rng.integers(margin, frame_shape[0] - margin, n)
+    length = np.where(rng.random(n) < 0.25, rng.integers(0, 5, n), rng.integers(5, max(frame_shape), n))
+    angle = rng.uniform(0, 2 * np.pi, n)
+    x1 = np.clip(np.trunc(x0 + length * np.cos(angle)), margin, frame_shape[1] - margin - 1)
+    y1 = np.clip(np.trunc(y0 + length * np.sin(angle)), margin, frame_shape[0] - margin - 1)
+    return np.stack([x0, y0, x1, y1], axis=1).astype(np.float32)
+
+
+def check(args, line_thickness, output_shape, rng):
+    """
+    Returns the fraction of the output pixels rasterized from the segments of every tile which differ from the tiles of
+    the frame mask drawn with cv2, resized and ceiled to the output shape as by tools.model.reshape_outputs.
+    """
+    frame_shape = (args.frame_size, args.frame_size)
+    tile_shape = (args.tile_size, args.tile_size)
+    segments = random_segments(rng, frame_shape, args.n_trails, line_thickness + 1)
+    mask = tools.data.draw_segments(segments, frame_shape, line_thickness=line_thickness)
+    grid = tools.tiling.TileGrid(frame_shape, tile_shape)
+    targets = grid.tiles(mask).reshape((-1,) + tile_shape + (1,)).astype(np.float32)
+    targets = tf.math.ceil(tf.image.resize(targets, output_shape))
+    tile_segments = tools.data.tile_segments(segments, frame_shape, tile_shape, line_thickness=line_thickness)
+    n = max(max(len(s) for s in tile_segments), 1)
+    padded = np.full((len(tile_segments), n, 4), -1e9, dtype=np.float32)
+    for i, s in enumerate(tile_segments):
+        padded[i, :len(s)] = s
+    thickness = np.full(len(tile_segments), line_thickness, dtype=np.float32)
+    rasterized = tools.model.rasterize_segments(padded, thickness, tile_shape, output_shape)
+    return float(tf.reduce_mean(tf.cast(rasterized != targets, tf.float32)))
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    failed = False
+    for line_thickness in args.line_thickness:
+        for output_size in (args.tile_size, args.output_size):
+            mismatch = check(args, line_thickness, (output_size, output_size), rng)
+            failed |= mismatch > args.tolerance
+            print("thickness {} output {}x{}: {:.2e} of the pixels differ".format(line_thickness, output_size,
+                                                                                output_size, mismatch), flush=True)
+    if failed:
+        raise ValueError("rasterize_segments differs from the cv2 masks by more than {}".format(args.tolerance))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that rasterize_segments sets the same pixels as the "
+                                                 "labels drawn with cv2 and resized by reshape_outputs.")
+    parser.add_argument('--frame_size', type=int, default=512, help='Size of the synthetic frames')
+    parser.add_argument('--tile_size', type=int, default=128, help='Size of the tiles')
+    parser.add_argument('--output_size', type=int, default=32, help='Size of the model output')
+    parser.add_argument('--n_trails', type=int, default=200, help='Number of trails per frame')
+    parser.add_argument('--line_thickness', type=int, nargs='+', default=[1, 2, 3, 4, 5],
+                        help='Line thicknesses to check')
+    parser.add_argument('--tolerance', type=float, default=1e-5,
+                        help='Largest accepted fraction of differing output pixels')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    args = parser.parse_args()
+    main(args)
@@ -1,4 +1,8 @@
 import tools.model
 import tools.data
 import tools.hypertuneModels
-import tools.metrics
\ No newline at end of file
+import tools.metrics
+import tools.frames
+import tools.tiling
+import tools.profiling
+import tools.tflite
@@ -1,7 +1,5 @@
-from tensorflow.keras.layers import GlobalAveragePooling2D, GlobalMaxPooling2D, Reshape, Dense, multiply, Permute, Concatenate, \
-    Conv2D, Add, Activation, Lambda
-from tensorflow.keras import backend as K
-from tensorflow.keras.activations import sigmoid
+import tensorflow as tf
+from tensorflow.keras.layers import Dense, Conv2D
 
 
 def attach_attention_module(net, attention_module):
@@ -15,34 +13,143 @@ def attach_attention_module(net, attention_module):
     return net
 
 
+@tf.keras.utils.register_keras_serializable(package="tools")
+class SqueezeExcitation(tf.keras.layers.Layer):
+    """
+    Squeeze-and-Excitation (SE) block, as described in https://arxiv.org/abs/1709.01507. The channels (last axis) of
+    the input are rescaled by weights computed from their spatial average.
+
+    :param ratio: Reduction ratio of the number of channels in the hidden layer
+    """
+
+    def __init__(self, ratio=8, **kwargs):
+        super().__init__(**kwargs)
+        self.ratio = ratio
+
+    def build(self, input_shape):
+        channel = input_shape[-1]
+        self.dense_one = Dense(channel // self.ratio, activation='relu', kernel_initializer='he_normal',
+                               dtype=self.dtype_policy, name="dense_one")
+        self.dense_two = Dense(channel, activation='sigmoid', kernel_initializer='he_normal',
+                               dtype=self.dtype_policy, name="dense_two")
+        self.dense_one.build((None, 1, 1, channel))
+        self.dense_two.build((None, 1, 1, channel // self.ratio))
+
+    def call(self, inputs):
+        se_feature = tf.reduce_mean(inputs, axis=[1, 2], keepdims=True)
+        return inputs * self.dense_two(self.dense_one(se_feature))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"ratio": self.ratio})
+        return config
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class ChannelAttention(tf.keras.layers.Layer):
+    """
+    Channel attention of the Convolutional Block Attention Module (CBAM), as described in
+    https://arxiv.org/abs/1807.06521. The spatial average and maximum of every channel (last axis) are stacked and
+    passed through the shared MLP in one call, and the channels are rescaled by the sigmoid of the sum of both outputs.
+
+    :param ratio: Reduction ratio of the number of channels in the hidden layer of the shared MLP
+    """
+
+    def __init__(self, ratio=8, **kwargs):
+        super().__init__(**kwargs)
+        self.ratio = ratio
+
+    def build(self, input_shape):
+        channel = input_shape[-1]
+        self.shared_layer_one = Dense(channel // self.ratio, activation='relu', kernel_initializer='he_normal',
+                                      dtype=self.dtype_policy, name="shared_layer_one")
+        self.shared_layer_two = Dense(channel, kernel_initializer='he_normal', dtype=self.dtype_policy,
+                                      name="shared_layer_two")
+        self.shared_layer_one.build((None, 2, 1, channel))
+        self.shared_layer_two.build((None, 2, 1, channel // self.ratio))
+
+    def call(self, inputs):
+        pooled = tf.concat([tf.reduce_mean(inputs, axis=[1, 2], keepdims=True),
+                            tf.reduce_max(inputs, axis=[1, 2], keepdims=True)], axis=1)
+        attention = tf.reduce_sum(self.shared_layer_two(self.shared_layer_one(pooled)), axis=1, keepdims=True)
+        return inputs * tf.sigmoid(attention)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"ratio": self.ratio})
+        return config
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class SpatialAttention(tf.keras.layers.Layer):
+    """
+    Spatial attention of the Convolutional Block Attention Module (CBAM). The average and maximum over the channels
+    (last axis) of every pixel are convolved into a sigmoid mask which rescales the input.
+
+    :param kernel_size: Size of the kernel of the convolution
+    """
+
+    def __init__(self, kernel_size=7, **kwargs):
+        super().__init__(**kwargs)
+        self.kernel_size = kernel_size
+
+    def build(self, input_shape):
+        self.conv = Conv2D(filters=1, kernel_size=self.kernel_size, strides=1, padding='same', activation='sigmoid',
+                           kernel_initializer='he_normal', use_bias=False, dtype=self.dtype_policy, name="conv")
+        self.conv.build(tuple(input_shape[:-1]) + (2,))
+
+    def call(self, inputs):
+        pooled = tf.concat([tf.reduce_mean(inputs, axis=-1, keepdims=True),
+                            tf.reduce_max(inputs, axis=-1, keepdims=True)], axis=-1)
+        return inputs * self.conv(pooled)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"kernel_size": self.kernel_size})
+        return config
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class ChannelPool(tf.keras.layers.Layer):
+    """
+    Mean or maximum over the channels of every pixel. Replaces the Lambda layers of the spatial attention of models
+    saved before the attention modules were Keras layers, see tools.model.load_model.
+
+    :param reduction: "mean" or "max"
+    """
+
+    def __init__(self, reduction="mean", **kwargs):
+        super().__init__(**kwargs)
+        self.reduction = reduction
+
+    def call(self, inputs):
+        if self.reduction == "max":
+            return tf.reduce_max(inputs, axis=-1, keepdims=True)
+        return tf.reduce_mean(inputs, axis=-1, keepdims=True)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (1,)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"reduction": self.reduction})
+        return config
+
+
 def se_block(input_feature, ratio=8):
     """Contains the implementation of Squeeze-and-Excitation(SE) block.
     As described in https://arxiv.org/abs/1709.01507.
     """
-
-    channel_axis = 1 if K.image_data_format() == "channels_first" else -1
-    channel = input_feature.shape[channel_axis]
-
-    se_feature = GlobalAveragePooling2D()(input_feature)
-    se_feature = Reshape((1, 1, channel))(se_feature)
-    assert se_feature.shape[1:] == (1, 1, channel)
-    se_feature = Dense(channel // ratio,
-                       activation='relu',
-                       kernel_initializer='he_normal',
-                       use_bias=True,
-                       bias_initializer='zeros')(se_feature)
-    assert se_feature.shape[1:] == (1, 1, channel // ratio)
-    se_feature = Dense(channel,
-                       activation='sigmoid',
-                       kernel_initializer='he_normal',
-                       use_bias=True,
-                       bias_initializer='zeros')(se_feature)
-    assert se_feature.shape[1:] == (1, 1, channel)
-    if K.image_data_format() == 'channels_first':
-        se_feature = Permute((3, 1, 2))(se_feature)
-
-    se_feature = multiply([input_feature, se_feature])
-    return se_feature
+    return SqueezeExcitation(ratio)(input_feature)
 
 
 def cbam_block(cbam_feature, ratio=8):
@@ -56,71 +163,8 @@ def cbam_block(cbam_feature, ratio=8):
 
 
 def channel_attention(input_feature, ratio=8):
-    channel_axis = 1 if K.image_data_format() == "channels_first" else -1
-    channel = input_feature.shape[channel_axis]
-
-    shared_layer_one = Dense(channel // ratio,
-                             activation='relu',
-                             kernel_initializer='he_normal',
-                             use_bias=True,
-                             bias_initializer='zeros')
-    shared_layer_two = Dense(channel,
-                             kernel_initializer='he_normal',
-                             use_bias=True,
-                             bias_initializer='zeros')
-
-    avg_pool = GlobalAveragePooling2D()(input_feature)
-    avg_pool = Reshape((1, 1, channel))(avg_pool)
-    assert avg_pool.shape[1:] == (1, 1, channel)
-    avg_pool = shared_layer_one(avg_pool)
-    assert avg_pool.shape[1:] == (1, 1, channel // ratio)
-    avg_pool = shared_layer_two(avg_pool)
-    assert avg_pool.shape[1:] == (1, 1, channel)
-
-    max_pool = GlobalMaxPooling2D()(input_feature)
-    max_pool = Reshape((1, 1, channel))(max_pool)
-    assert max_pool.shape[1:] == (1, 1, channel)
-    max_pool = shared_layer_one(max_pool)
-    assert max_pool.shape[1:] == (1, 1, channel // ratio)
-    max_pool = shared_layer_two(max_pool)
-    assert max_pool.shape[1:] == (1, 1, channel)
-
-    cbam_feature = Add()([avg_pool, max_pool])
-    cbam_feature = Activation('sigmoid')(cbam_feature)
-
-    if K.image_data_format() == "channels_first":
-        cbam_feature = Permute((3, 1, 2))(cbam_feature)
-
-    return multiply([input_feature, cbam_feature])
+    return ChannelAttention(ratio)(input_feature)
 
 
 def spatial_attention(input_feature):
-    kernel_size = 7
-
-    if K.image_data_format() == "channels_first":
-        channel = input_feature.shape[1]
-        cbam_feature = Permute((2, 3, 1))(input_feature)
-    else:
-        channel = input_feature.shape[-1]
-        cbam_feature = input_feature
-
-    avg_pool = Lambda(lambda x: K.mean(x, axis=3, keepdims=True))(cbam_feature)
-    assert avg_pool.shape[-1] == 1
-    max_pool = Lambda(lambda x: K.max(x, axis=3, keepdims=True))(cbam_feature)
-    assert max_pool.shape[-1] == 1
-    concat = Concatenate(axis=3)([avg_pool, max_pool])
-    assert concat.shape[-1] == 2
-    cbam_feature = Conv2D(filters=1,
-                          kernel_size=kernel_size,
-                          strides=1,
-                          padding='same',
-                          activation='sigmoid',
-                          kernel_initializer='he_normal',
-                          use_bias=False)(concat)
-    assert cbam_feature.shape[-1] == 1
-
-    if K.image_data_format() == "channels_first":
-        cbam_feature = Permute((3, 1, 2))(cbam_feature)
-
-    return multiply([input_feature, cbam_feature])
-
+    return SpatialAttention(kernel_size=7)(input_feature)
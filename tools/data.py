@@ -1,17 +1,25 @@
 import numpy as np
 import tensorflow as tf
 import multiprocessing
+import multiprocessing.pool
 import cv2
 import os
 import time
 import pandas as pd
+import json
+import glob
+import hashlib
+from collections import deque
+from itertools import chain
 
 if __name__ == "__main__":
     import model as model
     import metrics
+    import tiling
 else:
     import tools.model as model
     import tools.metrics as metrics
+    import tools.tiling as tiling
 
 
 def split(arr, nrows, ncols):
@@ -20,56 +28,36 @@ def split(arr, nrows, ncols):
     n * nrows * ncols = arr.size
 
     If arr is a 2D array, the returned array should look like n sub blocks with
-    each sub block preserving the "physical" layout of arr.
+    each sub block preserving the "physical" layout of arr. The last row and column of
+    blocks are zero padded, see tools.tiling.TileGrid.
     """
-    if arr.shape[0] % nrows != 0:
-        arr = np.vstack([arr, np.zeros(shape=(nrows - (arr.shape[0] % nrows), arr.shape[1]))])
-    if arr.shape[1] % ncols != 0:
-        arr = np.hstack([arr, np.zeros(shape=(arr.shape[0], ncols - (arr.shape[1] % ncols)))])
-    return arr.reshape(arr.shape[0] // nrows, nrows, -1, ncols).swapaxes(1, 2).reshape(-1, nrows, ncols)
+    return tiling.TileGrid(arr.shape, (nrows, ncols)).split(arr)
 
 
 def tfdataset_merge(dataset, shape):
-    def y_tiles(_, y):
-        y_tiled = tf.reshape(y, (x_rows, y_rows, y.shape[1], y.shape[2]))
-        y_tiled = tf.transpose(y_tiled, perm=[0, 2, 1, 3])
-        y_tiled = tf.reshape(y_tiled, (x_rows * y.shape[1], y_rows * y.shape[2]))
-        return y_tiled[:shape[0], :shape[1]]
-
-    def x_tiles(x, _):
-        x_tiled = tf.reshape(x, (x_rows, y_rows, x.shape[1], x.shape[2]))
-        x_tiled = tf.transpose(x_tiled, perm=[0, 2, 1, 3])
-        x_tiled = tf.reshape(x_tiled, (x_rows * x.shape[1], y_rows * x.shape[2]))
-        return x_tiled[:shape[0], :shape[1]]
-
     if len(dataset.take(1).get_single_element()[0].shape) > 3:
         dataset = dataset.unbatch()
     image_x, image_y = dataset.take(1).get_single_element()
-    img_shape = image_x.shape
-    x_rows = int(np.ceil(shape[0] / img_shape[0]))
-    y_rows = int(np.ceil(shape[1] / img_shape[1]))
-    dataset = dataset.batch(x_rows * y_rows)
-    return dataset.map(x_tiles), dataset.map(y_tiles)
-
-
-def create_XY_pairs(dataset_path):
-    dataset_test = tf.data.TFRecordDataset([dataset_path])
-    tfrecord_shape = model.get_shape_of_quadratic_image_tfrecord(dataset_test)
-    dataset_test = dataset_test.map(model.parse_function(img_shape=tfrecord_shape, test=False))
-    dataset_test_x, dataset_test_y = tfdataset_merge(dataset_test, (4176, 2048))
-    inputs = dataset_to_numpy(dataset_test_x)
-    truths = dataset_to_numpy(dataset_test_y)
+    grid = tiling.TileGrid(shape, image_x.shape)
+    dataset = dataset.batch(len(grid))
+    return dataset.map(lambda x, _: grid.tf_merge(x)[..., 0]), dataset.map(lambda _, y: grid.tf_merge(y)[..., 0])
+
+
+def create_XY_pairs(dataset_path, batch_size=1024):
+    dataset_test = load_tfrecord_dataset(dataset_path, ordered=True)
+    schema = get_dataset_schema(dataset_path)
+    dataset_test = dataset_test.batch(batch_size).map(
+        model.parse_function(img_shape=schema["shape"], test=False, schema=schema, batched=True),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    x_tiles, y_tiles = zip(*[(x.numpy()[..., 0], y.numpy()[..., 0]) for x, y in dataset_test])
+    frame_shapes = get_frame_shapes(dataset_path)
+    inputs = tiling.merge_frames(np.concatenate(x_tiles), frame_shapes)
+    truths = tiling.merge_frames(np.concatenate(y_tiles), frame_shapes)
     return inputs, truths
 
 
 def npy_merge(array, shape):
-    img_shape = array.shape[1:]
-    x_rows = int(np.ceil(shape[0] / img_shape[0]))
-    y_rows = int(np.ceil(shape[1] / img_shape[1]))
-    array_tiled = np.reshape(array, (-1, x_rows, y_rows, img_shape[0], img_shape[1]))
-    array_tiled = np.transpose(array_tiled, axes=[0, 1, 3, 2, 4])
-    array_tiled = np.reshape(array_tiled, (-1, x_rows * img_shape[0], y_rows * img_shape[1]))
-    return array_tiled[:, :shape[0], :shape[1]]
+    return tiling.TileGrid(shape, array.shape[1:3]).merge(array)
 
 
 def get_mask_layer(calexp, mask_name):
@@ -101,49 +89,788 @@ def draw_one_line(mask, origin, angle, length, line_thickness=2):
     return line
 
 
-def draw_mask_lines(catalog, calexp):
-    mask = np.zeros(calexp.image.array.shape)
-    for k in range(len(catalog)):
-        origin = calexp.getWcs().skyToPixelArray(np.array([catalog[k]["ra"]]), np.array([catalog[k]["dec"]]),
-                                                 degrees=True)
-        angle = catalog[k]["beta"]
-        length = catalog[k]["trail_length"]
-        mask = draw_one_line(mask, origin, angle, length)
+def _draw_segments_into(mask, segments, line_thickness, labels):
+    points = segments.astype(np.int32).reshape(-1, 2, 2)
+    if labels is None:
+        cv2.polylines(mask, list(points), False, 1, thickness=line_thickness)
+    else:
+        for (x0, y0), (x1, y1), label in zip(points[:, 0], points[:, 1], labels):
+            cv2.line(mask, (int(x0), int(y0)), (int(x1), int(y1)), int(label), thickness=line_thickness)
     return mask
 
 
-def one_visit_io(exp_ref, cat_ref, butler, output_coll, shape=(512, 512)):
+def draw_segments(segments, shape, line_thickness=2, labels=None, n_threads=1):
+    """
+    Draws line segments into a frame in one pass, with the same pixels as drawing them one by one with draw_one_line.
+
+    :param segments: Array of shape (n, 4) with the integer endpoints (x0, y0, x1, y1) of the segments
+    :param shape: Shape of the frame
+    :param line_thickness: Line thickness
+    :param labels: Positive value drawn for every segment, e.g. its index in the catalog, where segments overlap the
+    largest label is kept (Optional, by default every segment is drawn as 1)
+    :param n_threads: Number of threads drawing the segments in parallel
+    :return: uint8 mask, or an int32 frame of labels if labels are given
+    """
+    segments = np.asarray(segments).reshape(-1, 4)
+    dtype = np.uint8 if labels is None else np.int32
+    if labels is not None:
+        order = np.argsort(labels, kind="stable")
+        segments = segments[order]
+        labels = np.asarray(labels)[order]
+    n_threads = max(min(n_threads, len(segments)), 1)
+    if n_threads == 1 or np.prod(shape[:2]) == 0:
+        mask = np.zeros(shape[:2], dtype=dtype)
+        if len(segments) == 0 or mask.size == 0:
+            return mask
+        return _draw_segments_into(mask, segments, line_thickness, labels)
+    # every thread draws its share of the segments into its own frame, cv2 releases the GIL while drawing. Drawing
+    # horizontal bands of one frame instead would change the pixels, because cv2 clips the lines to the image first.
+    chunks = np.array_split(np.arange(len(segments)), n_threads)
+    jobs = [(np.zeros(shape[:2], dtype=dtype), segments[chunk], line_thickness,
+             None if labels is None else labels[chunk]) for chunk in chunks]
+    with multiprocessing.pool.ThreadPool(n_threads) as pool:
+        frames = pool.starmap(_draw_segments_into, jobs)
+    mask = frames[0]
+    for frame in frames[1:]:
+        np.maximum(mask, frame, out=mask)
+    return mask
+
+
+def draw_mask_lines(catalog, calexp, line_thickness=2, labels=False, n_threads=1):
+    """
+    Draws the injected trails of a catalog into a mask of the calexp.
+
+    :param catalog: Injection catalog with "ra", "dec", "beta" and "trail_length" columns
+    :param calexp: Calexp into which the trails were injected
+    :param line_thickness: Line thickness
+    :param labels: If True every trail is drawn with its row index in the catalog plus one instead of 1
+    :param n_threads: Number of threads drawing the mask
+    :return: uint8 mask, or an int32 frame of labels
+    """
+    segments = trail_segments(catalog, calexp.getWcs())
+    return draw_segments(segments, calexp.image.array.shape, line_thickness=line_thickness,
+                         labels=np.arange(1, len(segments) + 1) if labels else None, n_threads=n_threads)
+
+
+def trail_segments(catalog, wcs):
+    """
+    Returns the pixel endpoints of the injected trails, the same endpoints that draw_one_line draws.
+
+    :param catalog: Injection catalog with "ra", "dec", "beta" and "trail_length" columns
+    :param wcs: WCS of the image
+    :return: Array of shape (n, 4) with the integer endpoints (x0, y0, x1, y1) of every trail
+    """
+    if len(catalog) == 0:
+        return np.zeros((0, 4))
+    x, y = wcs.skyToPixelArray(np.asarray(catalog["ra"], dtype=float), np.asarray(catalog["dec"], dtype=float),
+                               degrees=True)
+    angle = (np.pi / 180) * np.asarray(catalog["beta"], dtype=float)
+    length = np.asarray(catalog["trail_length"], dtype=float)
+    x_size = length * np.cos(angle)
+    y_size = length * np.sin(angle)
+    segments = np.stack([x + x_size / 2, y + y_size / 2, x - x_size / 2, y - y_size / 2], axis=1)
+    return np.trunc(segments)
+
+
+def tile_segments(segments, frame_shape, tile_shape, line_thickness=2, stride=None):
+    """
+    Distributes trail segments over the tiles of a tools.tiling.TileGrid, in tile pixel coordinates.
+
+    :param segments: Array of shape (n, 4) with the endpoints (x0, y0, x1, y1) in frame pixel coordinates
+    :param frame_shape: Shape of the frame
+    :param tile_shape: Shape of the tiles
+    :param line_thickness: Line thickness, segments passing this close to a tile are added to it
+    :param stride: Offset between neighbouring tiles (default is the tile shape)
+    :return: List with an array of shape (m, 4) of the segments crossing every tile
+    """
+    grid = tiling.TileGrid(frame_shape, tile_shape, stride)
+    tile_rows, tile_cols = grid.grid_shape
+    tiles = [[] for _ in range(len(grid))]
+    for x0, y0, x1, y1 in segments:
+        # tile r covers the rows [r * stride, r * stride + tile_shape)
+        row_start = max(int(np.floor((min(y0, y1) - line_thickness - tile_shape[0]) / grid.stride[0])) + 1, 0)
+        row_stop = min(int(np.floor((max(y0, y1) + line_thickness) / grid.stride[0])), tile_rows - 1)
+        col_start = max(int(np.floor((min(x0, x1) - line_thickness - tile_shape[1]) / grid.stride[1])) + 1, 0)
+        col_stop = min(int(np.floor((max(x0, x1) + line_thickness) / grid.stride[1])), tile_cols - 1)
+        for r in range(row_start, row_stop + 1):
+            for c in range(col_start, col_stop + 1):
+                row0 = r * grid.stride[0]
+                col0 = c * grid.stride[1]
+                tiles[r * tile_cols + c].append((x0 - col0, y0 - row0, x1 - col0, y1 - row0))
+    return [np.array(t, dtype=np.float32).reshape(-1, 4) for t in tiles]
+
+
+def one_visit_frames(exp_ref, cat_ref, butler, output_coll, return_segments=False):
     injected_calexp = butler.get("injected_calexp",
                                  dataId=exp_ref.dataId,
                                  collections=output_coll)
     catalog = butler.get("injected_postISRCCD_catalog",
                          dataId=cat_ref.dataId,
                          collections=output_coll)
-    mask = draw_mask_lines(catalog, injected_calexp)
-    split_injected_calexp = split(injected_calexp.image.array, shape[0], shape[1])
+    segments = trail_segments(catalog, injected_calexp.getWcs())
+    mask = draw_segments(segments, injected_calexp.image.array.shape)
+    if return_segments:
+        return injected_calexp.image.array, mask, segments
+    return injected_calexp.image.array, mask
+
+
+def one_visit_io(exp_ref, cat_ref, butler, output_coll, shape=(512, 512)):
+    image, mask = one_visit_frames(exp_ref, cat_ref, butler, output_coll)
+    split_injected_calexp = split(image, shape[0], shape[1])
     split_mask = split(mask, shape[0], shape[1])
     return split_injected_calexp, split_mask
 
 
-def one_iteration(i, exp_ref, cat_ref, butler, output_coll, shape):
-    inp, outp = one_visit_io(exp_ref, cat_ref, butler, output_coll, shape)
-    serialized_list = [""] * len(inp)
-    counter = 0
-    for x, y in zip(inp, outp):
-        x = x[:, :, np.newaxis]
-        y = y[:, :, np.newaxis].astype(int)
+def serialize_example(x, y, schema_version=model.TFRECORD_SCHEMA_VERSION, x_dtype="float16", y_encoding="packbits",
+                      segments=None, line_thickness=2):
+    """
+    Serializes one tile and its label into a tf.train.Example string.
+
+    :param x: 2D image tile
+    :param y: 2D label tile (not used by version 3)
+    :param schema_version: TFRecord schema version, 1 is the legacy FloatList/Int64List layout
+    :param x_dtype: Dtype in which the image bytes are stored ("float16" or "float32"), only for version 2 and 3
+    :param y_encoding: Label encoding ("packbits" or "uint8"), only for version 2
+    :param segments: Array of shape (n, 4) with the trail segments in tile pixel coordinates, only for version 3
+    :param line_thickness: Thickness of the trail segments, only for version 3
+    :return: Serialized example
+    """
+    if schema_version == 1:
         feature = {'x': tf.train.Feature(float_list=tf.train.FloatList(value=x.flatten())),
-                   'y': tf.train.Feature(int64_list=tf.train.Int64List(value=y.flatten()))}
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
-        serialized = example.SerializeToString()
-        serialized_list[counter] = serialized
-        counter += 1
-    return serialized_list
+                   'y': tf.train.Feature(int64_list=tf.train.Int64List(value=y.astype(int).flatten()))}
+    elif schema_version in (2, 3):
+        if x_dtype == "float16":
+            x = np.clip(x, np.finfo(np.float16).min, np.finfo(np.float16).max)
+        elif x_dtype != "float32":
+            raise ValueError("x_dtype must be float16 or float32")
+        if schema_version == 3:
+            y_encoding = "segments"
+        feature = {'schema_version': tf.train.Feature(int64_list=tf.train.Int64List(value=[schema_version])),
+                   'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=[x.shape[0], x.shape[1], 1])),
+                   'x_dtype': tf.train.Feature(bytes_list=tf.train.BytesList(value=[x_dtype.encode()])),
+                   'y_encoding': tf.train.Feature(bytes_list=tf.train.BytesList(value=[y_encoding.encode()])),
+                   'x': tf.train.Feature(bytes_list=tf.train.BytesList(
+                       value=[x.astype(np.dtype(x_dtype).newbyteorder("<")).tobytes()]))}
+        if schema_version == 3:
+            segments = np.zeros((0, 4)) if segments is None else np.asarray(segments)
+            feature['segments'] = tf.train.Feature(float_list=tf.train.FloatList(value=segments.flatten()))
+            feature['thickness'] = tf.train.Feature(float_list=tf.train.FloatList(value=[line_thickness]))
+        elif y_encoding == "packbits":
+            y_bytes = np.packbits(y.astype(bool)).tobytes()
+            feature['y'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[y_bytes]))
+        elif y_encoding == "uint8":
+            y_bytes = y.astype(bool).astype(np.uint8).tobytes()
+            feature['y'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[y_bytes]))
+        else:
+            raise ValueError("y_encoding must be packbits or uint8")
+    else:
+        raise ValueError("Unsupported TFRecord schema version: {}".format(schema_version))
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString()
+
+
+def one_iteration(i, exp_ref, cat_ref, butler, output_coll, shape, schema_version=model.TFRECORD_SCHEMA_VERSION,
+                  x_dtype="float16"):
+    image, mask, segments = one_visit_frames(exp_ref, cat_ref, butler, output_coll, return_segments=True)
+    grid = tiling.TileGrid(image.shape, shape)
+    inp = grid.tiles(image)
+    outp = grid.tiles(mask)
+    segments = tile_segments(segments, image.shape, shape) if schema_version == 3 else [None] * len(grid)
+    serialized_list = [""] * len(grid)
+    # the tiles are views of frames that are a whole number of tiles, they are only copied when serialized
+    for counter, (x, y, s) in enumerate(zip(chain.from_iterable(inp), chain.from_iterable(outp), segments)):
+        serialized_list[counter] = serialize_example(x, y, schema_version=schema_version, x_dtype=x_dtype, segments=s)
+    positive_pixels = np.count_nonzero(outp, axis=(2, 3)).ravel()
+    return serialized_list, positive_pixels, image.shape
+
+
+def manifest_path(filename):
+    """
+    Returns the path of the JSON manifest that describes the shards of a TFRecord dataset.
+
+    :param filename: Name of the dataset (e.g. "train.tfrecord")
+    :return: Path of the manifest (e.g. "train.manifest.json")
+    """
+    if filename.endswith(".tfrecord"):
+        filename = filename[:-len(".tfrecord")]
+    return filename + ".manifest.json"
+
+
+def read_manifest(filename, arrays=False):
+    """
+    Reads the manifest of a TFRecord dataset. The JSON manifest holds the shards, record counts, schema and frame
+    shape, the per-visit tile offsets and per-tile positive pixel counts are stored next to it in a NPZ file.
+
+    :param filename: Name of the dataset or path of the manifest itself
+    :param arrays: Also load the per-visit and per-tile arrays from the NPZ sidecar
+    :return: Manifest dictionary or None if the dataset has no manifest
+    """
+    path = filename if filename.endswith(".manifest.json") else manifest_path(filename)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if arrays:
+        with np.load(path[:-len(".json")] + ".npz") as f:
+            manifest.update({key: f[key] for key in f.files})
+    return manifest
+
+
+def shard_filenames(filename, num_shards):
+    """
+    Returns the names of the shards of a TFRecord dataset, a dataset with one shard is written to filename itself.
+
+    :param filename: Name of the dataset ending with ".tfrecord"
+    :param num_shards: Number of shards
+    :return: List of shard filenames
+    """
+    if num_shards <= 1:
+        return [filename]
+    base = filename[:-len(".tfrecord")]
+    return ["{}-{:05d}-of-{:05d}.tfrecord".format(base, i, num_shards) for i in range(num_shards)]
+
+
+def _save_npz_atomic(path, **arrays):
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+class ShardedTFRecordWriter:
+    """
+    Writes the tiles of a list of visits to num_shards TFRecord files and a manifest describing the dataset.
+    Consecutive visits are written to the same shard, so reading the shards in the manifest order returns the visits
+    in the order of the list.
+
+    Every shard is written to a temporary file and renamed only once all of its visits are written, together with a
+    "<shard>.done.npz" file recording the visits it contains. Until then, every written visit is appended to the
+    "<shard>.log" file. With resume=True the shards finalised by a previous run are kept, the visits logged in the
+    unfinished shards are recovered from their temporary files, and both are listed in completed_visits, so only the
+    missing visits have to be written. The schema is recorded with the visits, shards and logs of a different schema
+    (e.g. another schema version, tile shape or image dtype) are not resumed but written again.
+    """
+
+    def __init__(self, filename, num_shards=1, num_visits=1, schema=None, visits=None, resume=False):
+        self.filename = filename
+        self.schema = schema
+        self.visits = list(range(num_visits)) if visits is None else [int(v) for v in visits]
+        self.position = {v: p for p, v in enumerate(self.visits)}
+        self.num_visits = max(len(self.visits), 1)
+        self.shards = shard_filenames(filename, max(1, min(num_shards, self.num_visits)))
+        self.shard_visits = [[] for _ in self.shards]
+        for p, v in enumerate(self.visits):
+            self.shard_visits[self._shard_of(p)].append(v)
+        self.metadata = [None] * len(self.shards)
+        self.completed_visits = set()
+        self.logged_visits = {}
+        if resume:
+            for k, shard in enumerate(self.shards):
+                done = self._done_path(shard)
+                if os.path.isfile(shard) and os.path.isfile(done):
+                    with np.load(done) as f:
+                        metadata = {key: f[key] for key in f.files}
+                    if (list(metadata["visit_index"]) == self.shard_visits[k] and
+                            str(metadata.get("schema", "")) == self._schema_json()):
+                        self.metadata[k] = metadata
+                        self.completed_visits.update(self.shard_visits[k])
+                        continue
+                logged = self._read_visit_log(k)
+                if len(logged) > 0:
+                    self.logged_visits[k] = logged
+                    self.completed_visits.update(entry[0] for entry in logged)
+        self.visit_counter = 0
+        self.shard = -1
+        self.writer = None
+        self.log = None
+        self._reset_shard_metadata()
+
+    def _shard_of(self, position):
+        return position * len(self.shards) // self.num_visits
+
+    @staticmethod
+    def _done_path(shard):
+        return shard[:-len(".tfrecord")] + ".done.npz"
+
+    def _schema_json(self):
+        return json.dumps(self.schema, sort_keys=True)
+
+    @staticmethod
+    def _log_path(shard):
+        return shard[:-len(".tfrecord")] + ".log"
+
+    def _read_visit_log(self, k):
+        """
+        Reads the visits logged while shard k was written by a previous run with the same schema, keeping those that
+        continue the visits of the shard in order and whose tiles were all written to the temporary file of the shard.
+
+        :return: List of (visit, number of tiles, frame shape, positive pixels)
+        """
+        shard = self.shards[k]
+        if not (os.path.isfile(shard + ".tmp") and os.path.isfile(self._log_path(shard))):
+            return []
+        logged = []
+        with open(self._log_path(shard), "rb") as f:
+            try:
+                schema = str(np.load(f))
+            except (EOFError, ValueError):
+                return []
+            if schema != self._schema_json():
+                return []
+            while True:
+                try:
+                    visit, tiles, height, width = np.load(f)
+                    positive_pixels = np.load(f)
+                except (EOFError, ValueError):
+                    # the end of the log, or the entry of a visit interrupted while it was logged
+                    break
+                logged.append((int(visit), int(tiles), (int(height), int(width)), positive_pixels))
+        num_records = 0
+        try:
+            for _ in tf.data.TFRecordDataset(shard + ".tmp"):
+                num_records += 1
+        except tf.errors.DataLossError:
+            pass
+        recovered = []
+        for entry in logged:
+            if len(recovered) >= len(self.shard_visits[k]) or entry[0] != self.shard_visits[k][len(recovered)]:
+                break
+            num_records -= entry[1]
+            if num_records < 0:
+                break
+            recovered.append(entry)
+        return recovered
+
+    def _reset_shard_metadata(self):
+        self.visit_index = []
+        self.visit_tiles = []
+        self.visit_shape = []
+        self.positive_pixels = []
+
+    def _open_shard(self, k):
+        self._reset_shard_metadata()
+        self.shard = k
+        shard = self.shards[k]
+        logged = self.logged_visits.pop(k, [])
+        if len(logged) > 0:
+            os.replace(shard + ".tmp", shard + ".partial")
+        self.writer = tf.io.TFRecordWriter(shard + ".tmp")
+        self.log = open(self._log_path(shard), "wb")
+        np.save(self.log, np.array(self._schema_json()))
+        if len(logged) > 0:
+            for record in tf.data.TFRecordDataset(shard + ".partial").take(sum(entry[1] for entry in logged)):
+                self.writer.write(record.numpy())
+            self.writer.flush()
+            for visit, tiles, frame_shape, positive_pixels in logged:
+                self._log_visit(visit, tiles, frame_shape, positive_pixels)
+            os.remove(shard + ".partial")
+
+    def _log_visit(self, visit, tiles, frame_shape, positive_pixels):
+        self.visit_index.append(visit)
+        self.visit_tiles.append(tiles)
+        self.visit_shape.append(frame_shape)
+        self.positive_pixels.append(positive_pixels)
+        np.save(self.log, np.array([visit, tiles, frame_shape[0], frame_shape[1]], dtype=np.int64))
+        np.save(self.log, positive_pixels)
+        self.log.flush()
+
+    def _close_shard(self):
+        self.writer.close()
+        self.writer = None
+        self.log.close()
+        self.log = None
+
+    def _finalise_shard(self):
+        self._close_shard()
+        shard = self.shards[self.shard]
+        if self.visit_index != self.shard_visits[self.shard]:
+            return
+        os.replace(shard + ".tmp", shard)
+        metadata = {"schema": np.array(self._schema_json()),
+                    "visit_index": np.array(self.visit_index, dtype=np.int64),
+                    "visit_tiles": np.array(self.visit_tiles, dtype=np.int64),
+                    "visit_shape": np.array(self.visit_shape, dtype=np.int64).reshape(-1, 2),
+                    "positive_pixels": np.concatenate([np.zeros(0, dtype=np.int32)] +
+                                                      self.positive_pixels).astype(np.int32)}
+        _save_npz_atomic(self._done_path(shard), **metadata)
+        os.remove(self._log_path(shard))
+        self.metadata[self.shard] = metadata
+        self.completed_visits.update(self.visit_index)
+
+    def write_visit(self, serialized_list, visit=None, positive_pixels=None, frame_shape=None):
+        visit = self.visits[self.visit_counter] if visit is None else visit
+        shard = self._shard_of(self.position[visit])
+        if visit in self.completed_visits:
+            raise ValueError("Visit {} was already written to {}".format(visit, self.shards[shard]))
+        if shard != self.shard:
+            if self.writer is not None:
+                self._finalise_shard()
+            self._open_shard(shard)
+        for s in serialized_list:
+            self.writer.write(s)
+        # the tiles reach the file before the visit is logged, a logged visit is always complete
+        self.writer.flush()
+        self._log_visit(visit, len(serialized_list), (0, 0) if frame_shape is None else tuple(frame_shape[:2]),
+                        np.full(len(serialized_list), -1, dtype=np.int32) if positive_pixels is None
+                        else np.asarray(positive_pixels, dtype=np.int32))
+        self.completed_visits.add(visit)
+        self.visit_counter += 1
+
+    def manifest(self):
+        frame_shapes = set(tuple(shape) for m in self.metadata for shape in m["visit_shape"].tolist())
+        return {"shards": [os.path.basename(s) for s in self.shards],
+                "num_records": [int(m["visit_tiles"].sum()) for m in self.metadata],
+                "total_records": int(sum(m["visit_tiles"].sum() for m in self.metadata)),
+                "num_visits": len(self.visits),
+                "schema": self.schema,
+                "frame_shape": list(frame_shapes.pop()) if len(frame_shapes) == 1 else None}
+
+    def close(self):
+        if self.writer is not None:
+            self._finalise_shard()
+        # shards without visits, or whose visits were all logged by a previous run, are finalised here
+        for k, shard_visits in enumerate(self.shard_visits):
+            if self.metadata[k] is None and (len(shard_visits) == 0 or
+                                             len(self.logged_visits.get(k, [])) == len(shard_visits)):
+                self._open_shard(k)
+                self._finalise_shard()
+        missing = [shard for shard, m in zip(self.shards, self.metadata) if m is None]
+        if len(missing) > 0:
+            raise RuntimeError("Shards {} are incomplete, rerun the conversion to finish them".format(missing))
+        path = manifest_path(self.filename)
+        with open(path, "w") as f:
+            json.dump(self.manifest(), f, indent=2)
+        visit_tiles = np.concatenate([m["visit_tiles"] for m in self.metadata])
+        _save_npz_atomic(path[:-len(".json")] + ".npz",
+                         visit_index=np.concatenate([m["visit_index"] for m in self.metadata]),
+                         visit_offset=np.cumsum(visit_tiles) - visit_tiles,
+                         visit_tiles=visit_tiles,
+                         visit_shape=np.concatenate([m["visit_shape"] for m in self.metadata]),
+                         positive_pixels=np.concatenate([m["positive_pixels"] for m in self.metadata]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self._close_shard()
+
+
+def get_tfrecord_files(dataset_path):
+    """
+    Resolves a dataset path to the list of its TFRecord files. The path can be a single TFRecord file, a dataset with
+    a manifest, a glob pattern or a list of those.
+
+    :param dataset_path: Path or list of paths
+    :return: List of TFRecord filenames
+    """
+    if isinstance(dataset_path, str):
+        dataset_path = [dataset_path]
+    files = []
+    for path in dataset_path:
+        manifest = read_manifest(path)
+        if manifest is not None:
+            directory = os.path.dirname(path)
+            files += [os.path.join(directory, shard) for shard in manifest["shards"]]
+        elif glob.has_magic(path):
+            files += sorted(glob.glob(path))
+        else:
+            files.append(path)
+    return files
+
+
+def shard_files(files, num_shards=1, shard_index=0):
+    """
+    Selects the files read by one of num_shards workers, every num_shards-th file starting at shard_index. Sharding by
+    file lets every worker read only its own files, instead of reading all records and discarding all but every
+    num_shards-th of them.
+
+    :param files: List of TFRecord filenames
+    :param num_shards: Number of workers
+    :param shard_index: Index of the worker
+    :return: List of the files of the shard
+    """
+    if num_shards <= 1:
+        return files
+    if len(files) < num_shards:
+        raise ValueError("Cannot shard {} files between {} workers, write the dataset with at least as many "
+                         "shards".format(len(files), num_shards))
+    return files[shard_index::num_shards]
+
+
+def get_dataset_size(dataset_path):
+    """
+    Returns the number of records of a dataset, read from the manifests when available and counted otherwise.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :return: Number of records
+    """
+    if isinstance(dataset_path, str):
+        dataset_path = [dataset_path]
+    size = 0
+    for path in dataset_path:
+        manifest = read_manifest(path)
+        if manifest is not None and "total_records" in manifest:
+            size += manifest["total_records"]
+        else:
+            size += model.get_tfrecords_size(load_tfrecord_dataset(path))
+    return size
+
+
+def get_dataset_schema(dataset_path):
+    """
+    Returns the schema of a dataset (see tools.model.get_tfrecord_schema), read from the manifest when available.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :return: Schema dictionary
+    """
+    path = dataset_path if isinstance(dataset_path, str) else dataset_path[0]
+    manifest = read_manifest(path)
+    if manifest is not None and manifest.get("schema") is not None:
+        schema = dict(manifest["schema"])
+        schema["shape"] = tuple(schema["shape"])
+        return schema
+    return model.get_tfrecord_schema(load_tfrecord_dataset(path, ordered=True))
+
+
+def get_frame_shape(dataset_path, default=(4176, 2048)):
+    """
+    Returns the shape of the full images from which the tiles of a dataset were cut.
+
+    :param dataset_path: Path of the dataset
+    :param default: Shape returned if the manifest does not record it (HSC detector)
+    :return: Frame shape
+    """
+    manifest = read_manifest(dataset_path)
+    if manifest is None or manifest.get("frame_shape") is None:
+        return default
+    return tuple(manifest["frame_shape"])
+
+
+def get_frame_shapes(dataset_path, default=(4176, 2048)):
+    """
+    Returns the shape of every full image from which the tiles of a dataset were cut, in the order of the tiles.
+
+    :param dataset_path: Path of the dataset
+    :param default: Shape of all images if the manifest does not record them (HSC detector)
+    :return: List of frame shapes
+    """
+    manifest = read_manifest(dataset_path, arrays=True)
+    if manifest is None or "visit_shape" not in manifest or not np.all(manifest["visit_shape"] > 0):
+        frame_shape = get_frame_shape(dataset_path, default)
+        return [frame_shape] * int(np.ceil(get_dataset_size(dataset_path) /
+                                           len(tiling.TileGrid(frame_shape, get_dataset_schema(dataset_path)["shape"]))))
+    return [tuple(shape) for shape in manifest["visit_shape"].tolist()]
+
+
+def load_tfrecord_dataset(dataset_path, ordered=False, cycle_length=None, num_parallel_calls=tf.data.AUTOTUNE,
+                          num_shards=1, shard_index=0):
+    """
+    Creates a raw TFRecord dataset reading all shards of a dataset. Unordered datasets interleave the shards with
+    parallel readers and can be auto-sharded by FILE between workers, ordered datasets read the shards one after the
+    other so the tiles of every visit stay consecutive (needed for merging the tiles back into images).
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :param ordered: Read the records in the order in which they were written
+    :param cycle_length: Number of shards read concurrently (default is the number of CPU cores)
+    :param num_parallel_calls: Number of parallel reader threads
+    :param num_shards: Number of workers between which the files are sharded, see shard_files
+    :param shard_index: Index of the worker reading the dataset
+    :return: Dataset of serialized examples
+    """
+    files = shard_files(get_tfrecord_files(dataset_path), num_shards, shard_index)
+    for file in files:
+        if not os.path.exists(file):
+            raise FileNotFoundError(f"Dataset {file} not found")
+    if ordered or len(files) == 1:
+        return tf.data.TFRecordDataset(files)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    return dataset.interleave(tf.data.TFRecordDataset, cycle_length=cycle_length,
+                              num_parallel_calls=num_parallel_calls, deterministic=False)
+
+
+def _positive_pixels_per_file(dataset_path, batch_size=1024):
+    files = get_tfrecord_files(dataset_path)
+    paths = [dataset_path] if isinstance(dataset_path, str) else list(dataset_path)
+    counts = []
+    for path in paths:
+        manifest = read_manifest(path, arrays=True)
+        if manifest is not None and "positive_pixels" in manifest and np.all(manifest["positive_pixels"] >= 0):
+            counts += np.split(manifest["positive_pixels"], np.cumsum(manifest["num_records"])[:-1])
+        else:
+            counts = None
+            break
+    if counts is not None and len(counts) == len(files):
+        return counts
+    # count once from the labels if the dataset was written without them
+    schema = get_dataset_schema(dataset_path)
+    parse = model.parse_function(img_shape=schema["shape"], test=False, clip=False, schema=schema, batched=True)
+    counts = []
+    for file in files:
+        dataset = tf.data.TFRecordDataset(file).batch(batch_size).map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+        counts.append(np.concatenate([np.count_nonzero(y.numpy().reshape(len(y), -1), axis=1) for _, y in dataset]
+                                     + [np.zeros(0, dtype=np.int64)]))
+    return counts
+
+
+def get_positive_pixels(dataset_path):
+    """
+    Returns the number of trail pixels in the label of every record, in the order of an ordered read. The counts are
+    read from the manifest when the conversion recorded them and counted from the labels otherwise.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :return: Array with the number of positive pixels of every record
+    """
+    return np.concatenate(_positive_pixels_per_file(dataset_path))
+
+
+def load_balanced_tfrecord_dataset(dataset_path, positive_fraction=0.5, shuffle_buffer=1000, seed=None,
+                                   cycle_length=None, num_parallel_calls=tf.data.AUTOTUNE, num_shards=1, shard_index=0):
+    """
+    Creates an infinite dataset of serialized records in which a positive_fraction of the records have trail pixels
+    in their label. The positive and the empty tiles are read as two shuffled and repeated streams, selected by the
+    per-tile counts of get_positive_pixels before any parsing, and sampled with the target weights.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :param positive_fraction: Fraction of returned records with trail pixels
+    :param shuffle_buffer: Shuffle buffer of each stream
+    :param seed: Seed of the shuffling and sampling
+    :param cycle_length: Number of shards read concurrently (default is the number of CPU cores)
+    :param num_parallel_calls: Number of parallel reader threads
+    :param num_shards: Number of workers between which the files are sharded, see shard_files
+    :param shard_index: Index of the worker reading the dataset
+    :return: Dataset of serialized examples
+    """
+    if not 0 < positive_fraction < 1:
+        raise ValueError("positive_fraction must be between 0 and 1")
+    files = get_tfrecord_files(dataset_path)
+    counts = _positive_pixels_per_file(dataset_path)
+    offsets = np.cumsum([len(c) for c in counts]) - [len(c) for c in counts]
+    is_positive = np.concatenate(counts) > 0
+    if is_positive.all() or not is_positive.any():
+        raise ValueError("Dataset {} has only {} tiles".format(dataset_path, "positive" if is_positive.all() else
+                                                                "empty"))
+    is_positive = tf.constant(is_positive)
+    files = shard_files(files, num_shards, shard_index)
+    offsets = shard_files(offsets, num_shards, shard_index)
+
+    def stream(label):
+        dataset = tf.data.Dataset.from_tensor_slices((files, offsets))
+        dataset = dataset.interleave(lambda file, offset: tf.data.TFRecordDataset(file).enumerate(offset),
+                                     cycle_length=cycle_length, num_parallel_calls=num_parallel_calls,
+                                     deterministic=False)
+        dataset = dataset.filter(lambda index, _: tf.equal(tf.gather(is_positive, index), label))
+        return dataset.map(lambda _, record: record).shuffle(shuffle_buffer, seed=seed).repeat()
+
+    return tf.data.Dataset.sample_from_datasets([stream(True), stream(False)],
+                                                weights=[positive_fraction, 1 - positive_fraction], seed=seed)
+
+
+def rebalance_dataset(dataset, positive_fraction=0.5, seed=None):
+    """
+    Rejection resamples a dataset of parsed (x, y) tiles so that a positive_fraction of the tiles have trail pixels,
+    for sources without per-tile counts (snapshots, frame stores).
+
+    :param dataset: Dataset of (x, y) tiles
+    :param positive_fraction: Fraction of returned tiles with trail pixels
+    :param seed: Seed of the resampling
+    :return: Dataset of (x, y) tiles
+    """
+    dataset = dataset.rejection_resample(lambda x, y: tf.cast(tf.reduce_any(y > 0), tf.int32),
+                                         target_dist=[1 - positive_fraction, positive_fraction], seed=seed)
+    return dataset.map(lambda _, example: example)
+
+
+def preprocessing_key(dataset_path, schema=None, output_shape=None, clip=True):
+    """
+    Returns a hash identifying a TFRecord dataset together with the preprocessing applied by model.parse_function.
+    The files are identified by their path, size and modification time, so the key changes if they are rewritten.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :param schema: Schema of the dataset (default is read from the dataset)
+    :param output_shape: Shape of the labels returned by the parser
+    :param clip: Whether the inputs are clipped
+    :return: Hexadecimal key
+    """
+    schema = get_dataset_schema(dataset_path) if schema is None else schema
+    files = [os.path.abspath(file) for file in get_tfrecord_files(dataset_path)]
+    description = {"files": [(file, os.path.getsize(file), os.path.getmtime(file)) for file in files],
+                   "schema": {key: list(value) if isinstance(value, tuple) else value for key, value in schema.items()},
+                   "output_shape": None if output_shape is None else [int(i) for i in output_shape[:2]],
+                   "clip": list(model.CLIP_RANGE) if clip else None}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def snapshot_tfrecord_dataset(dataset_path, cache_dir, schema=None, output_shape=None, clip=True, batch_size=256,
+                              num_parallel_calls=tf.data.AUTOTUNE, num_shards=1, shard_index=0):
+    """
+    Returns the parsed (x, y) tiles of a TFRecord dataset through a GZIP compressed tf.data snapshot. The first pass
+    parses the records and writes the snapshot to cache_dir/<preprocessing_key>, later epochs and later runs with the
+    same files and preprocessing read the parsed tensors from the snapshot and skip parsing.
+
+    :param dataset_path: Path or list of paths, see get_tfrecord_files
+    :param cache_dir: Directory of the snapshots
+    :param schema: Schema of the dataset (default is read from the dataset)
+    :param output_shape: Shape of the labels, e.g. the model output (default is the tile shape)
+    :param clip: Clip the inputs to model.CLIP_RANGE
+    :param batch_size: Number of records parsed and stored in the snapshot together
+    :param num_parallel_calls: Number of batches parsed in parallel
+    :param num_shards: Number of workers between which the files are sharded, every worker snapshots its own files
+    :param shard_index: Index of the worker reading the dataset
+    :return: Dataset of parsed (x, y) tiles
+    """
+    schema = get_dataset_schema(dataset_path) if schema is None else schema
+    files = shard_files(get_tfrecord_files(dataset_path), num_shards, shard_index)
+    path = os.path.join(cache_dir, preprocessing_key(files, schema, output_shape, clip))
+    dataset = load_tfrecord_dataset(files).batch(batch_size)
+    dataset = dataset.map(model.parse_function(img_shape=schema["shape"], test=False, clip=clip, schema=schema,
+                                               output_shape=output_shape, batched=True),
+                          num_parallel_calls=num_parallel_calls)
+    return dataset.snapshot(path, compression="GZIP").unbatch()
+
+
+_worker_butler = None
+
+
+def _init_worker_butler(repo):
+    global _worker_butler
+    from lsst.daf.butler import Butler
+    _worker_butler = Butler(repo)
+
+
+def _one_iteration_worker(i, exp_ref, cat_ref, output_coll, shape, schema_version, x_dtype):
+    return one_iteration(i, exp_ref, cat_ref, _worker_butler, output_coll, shape, schema_version=schema_version,
+                         x_dtype=x_dtype)
 
 
 def convert_butler_tfrecords(repo, output_coll, shape, filename_train, filename_test="", train_split=0.25,
                              batch_size=None,
-                             verbose=True, seed=42, maxlen=None):
+                             verbose=True, seed=42, maxlen=None, schema_version=model.TFRECORD_SCHEMA_VERSION,
+                             x_dtype="float16", num_shards=1, queue_depth=None, resume=False):
+    """
+    Converts the injected calexps of a Butler collection into train and test TFRecord datasets of tiles. Visits are
+    processed by a pool of batch_size worker processes, each with its own Butler, and streamed to the writers in visit
+    order. At most queue_depth visits are in flight, which bounds the memory held by finished but unwritten visits.
+
+    :param repo: Path to the Butler repository
+    :param output_coll: Name of the collection with the injected calexps and catalogs
+    :param shape: Shape of the tiles
+    :param filename_train: Filename of the train dataset
+    :param filename_test: Filename of the test dataset
+    :param train_split: Fraction of visits put into the test dataset
+    :param batch_size: Number of worker processes (default is the number of CPUs - 1)
+    :param verbose: Print progress
+    :param seed: Seed of the train/test split
+    :param maxlen: Interval of visits to convert (Optional)
+    :param schema_version: TFRecord schema version
+    :param x_dtype: Dtype in which the images are stored
+    :param num_shards: Number of shards per dataset
+    :param queue_depth: Maximum number of visits in flight (default is 2 * batch_size)
+    :param resume: Keep the visits converted by a previous run with the same arguments and convert only the missing
+        visits
+    :return: Indices of the visits in the test dataset
+    """
     from lsst.daf.butler import Butler
     butler = Butler(repo)
     catalog_ref = np.unique(np.array(list(butler.registry.queryDatasets("injected_postISRCCD_catalog",
@@ -169,7 +896,6 @@ def convert_butler_tfrecords(repo, output_coll, shape, filename_train, filename_
         elif not filename_test.endswith(".tfrecord"):
             filename_test += ".tfrecord"
     else:
-        filename_test = "/dev/null"
         index = []
 
     if filename_train == "":
@@ -178,30 +904,44 @@ def convert_butler_tfrecords(repo, output_coll, shape, filename_train, filename_
         filename_train += ".tfrecord"
     if batch_size is None:
         batch_size = os.cpu_count() - 1
+    if queue_depth is None:
+        queue_depth = 2 * batch_size
     counter = 0
     if verbose:
         print("Train dataset size: ", len(ref) - len(index))
         print("Test dataset size: ", len(index))
-    with tf.io.TFRecordWriter(filename_train) as writer_train:
-        with tf.io.TFRecordWriter(filename_test) as writer_test:
-            while counter < len(ref):
-                difference = min(len(ref) - counter, batch_size)
-                data_ref = [(i, ref[i], catalog_ref[i], butler, output_coll, shape) for i in
-                            range(counter, counter + difference)]
-                pool = multiprocessing.Pool(batch_size)
-                serialized_tf = pool.starmap(one_iteration, data_ref)
-                pool.close()
-                pool.join()
-                for c, serialized in enumerate(serialized_tf):
-                    if counter + c in index:
-                        for s in serialized:
-                            writer_test.write(s)
-                    else:
-                        for s in serialized:
-                            writer_train.write(s)
-                    if verbose:
-                        print("\r", counter + c + 1, "/", len(ref), end="")
-                counter += difference
+    schema = {"version": schema_version, "shape": [shape[0], shape[1], 1],
+              "x_dtype": x_dtype if schema_version > 1 else "float32",
+              "y_encoding": {1: "int64", 2: "packbits", 3: "segments"}[schema_version]}
+    offset = maxlen[0] if maxlen is not None else 0
+    writer_train = ShardedTFRecordWriter(filename_train, num_shards, schema=schema, resume=resume,
+                                         visits=[offset + i for i in range(len(ref)) if i not in index])
+    writer_test = ShardedTFRecordWriter(filename_test, num_shards, schema=schema, resume=resume,
+                                        visits=[offset + i for i in sorted(index)]) if len(index) > 0 else None
+    completed = writer_train.completed_visits | (writer_test.completed_visits if writer_test is not None else set())
+    todo = [i for i in range(len(ref)) if offset + i not in completed]
+    if verbose and len(completed) > 0:
+        print("Skipping", len(completed), "visits converted by a previous run")
+    pending = deque()
+    with multiprocessing.Pool(batch_size, initializer=_init_worker_butler, initargs=(repo,)) as pool:
+        while counter < len(todo) or len(pending) > 0:
+            if counter < len(todo) and len(pending) < queue_depth:
+                i = todo[counter]
+                pending.append(pool.apply_async(_one_iteration_worker,
+                                                (i, ref[i], catalog_ref[i], output_coll, shape,
+                                                 schema_version, x_dtype)))
+                counter += 1
+                continue
+            i = todo[counter - len(pending)]
+            serialized, positive_pixels, frame_shape = pending.popleft().get()
+            writer = writer_test if i in index else writer_train
+            writer.write_visit(serialized, visit=offset + i, positive_pixels=positive_pixels,
+                               frame_shape=frame_shape)
+            if verbose:
+                print("\r", len(completed) + counter - len(pending), "/", len(ref), end="")
+    writer_train.close()
+    if writer_test is not None:
+        writer_test.close()
     index = index + maxlen[0] if maxlen is not None else index
     return index
 
@@ -237,7 +977,8 @@ def convert_butler_numpy(repo, output_coll, shape=(512, 512), parallelize=True):
     return np.concatenate(inputs), np.concatenate(outputs)
 
 
-def convert_npy_tfrecords(inputs, labels, filename_train, filename_test):
+def convert_npy_tfrecords(inputs, labels, filename_train, filename_test, schema_version=model.TFRECORD_SCHEMA_VERSION,
+                          x_dtype="float16"):
     i = 0
     index = np.arange(0, inputs.shape[0])
     np.random.shuffle(index)
@@ -247,15 +988,7 @@ def convert_npy_tfrecords(inputs, labels, filename_train, filename_test):
             for X, y in zip(inputs, labels):
                 i += 1
                 print("\r", i, "/", inputs.shape[0], end="")
-                # Feature contains a map of string to feature proto objects
-                feature = {'X': tf.train.Feature(float_list=tf.train.FloatList(value=X.flatten())),
-                           'y': tf.train.Feature(int64_list=tf.train.Int64List(value=y.flatten()))}
-
-                # Construct the Example proto object
-                example = tf.train.Example(features=tf.train.Features(feature=feature))
-
-                # Serialize the example to a string
-                serialized = example.SerializeToString()
+                serialized = serialize_example(X, y, schema_version=schema_version, x_dtype=x_dtype)
 
                 # write the serialized object to the disk
                 if i in index:
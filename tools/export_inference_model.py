@@ -0,0 +1,67 @@
+import sys
+sys.path.append("../")
+import os
+import time
+import argparse
+import numpy as np
+import tools.model
+import tools.tflite
+
+
+def main(args):
+    start = time.time()
+    model = tools.model.load_model(args.model_path)
+    load_time = time.time() - start
+    model = tools.model.cast_model(model, tools.model.precision_policy(False))
+    folded = tools.model.inference_model(model)
+    print("Layers: {} -> {}, parameters: {} -> {}".format(len(list(tools.model._flatten_layers(model))),
+                                                        len(list(tools.model._flatten_layers(folded))),
+                                                        model.count_params(), folded.count_params()))
+
+    tiles = tools.tflite.representative_tiles(args.dataset_path, n_tiles=args.n_tiles)
+    expected = model.predict(tiles, batch_size=args.batch_size, verbose=0)
+    predicted = folded.predict(tiles, batch_size=args.batch_size, verbose=0)
+    difference = float(np.max(np.abs(expected - predicted)))
+    print("Maximum difference of the probabilities on {} tiles: {:.2e}, thresholded pixels predicted equally: "
+          "{:.4%}".format(len(tiles), difference, np.mean((expected > 0.5) == (predicted > 0.5))))
+    if difference > args.tolerance:
+        raise ValueError("The inference model differs from the original by {:.2e}, more than the tolerance {:.2e}"
+                         .format(difference, args.tolerance))
+
+    destination = args.destination
+    if destination == "":
+        destination = os.path.splitext(args.model_path)[0] + "_inference.keras"
+    folded.save(destination)
+    start = time.time()
+    tools.model.load_model(destination)
+    print("Saved {}, size {:.1f} kB -> {:.1f} kB, load time {:.2f} s -> {:.2f} s".format(
+        destination, os.path.getsize(args.model_path) / 1024, os.path.getsize(destination) / 1024, load_time,
+        time.time() - start))
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Exports an inference-only model with the batch normalizations "
+                                                 "folded into the convolutions, without dropout and optimizer.")
+    parser.add_argument('--model_path', type=str,
+                        default="../DATA/Trained_model.keras",
+                        help='Path to the trained model.')
+    parser.add_argument('--destination', type=str,
+                        default="",
+                        help='Path of the exported model (default: next to the model, suffixed by _inference).')
+    parser.add_argument('--dataset_path', type=str,
+                        default="../DATA/test1.tfrecord",
+                        help='TFRecord dataset of the tiles on which the exported model is verified.')
+    parser.add_argument('--n_tiles', type=int,
+                        default=256,
+                        help='Number of verification tiles.')
+    parser.add_argument('--batch_size', type=int,
+                        default=64,
+                        help='Batch size of the verification.')
+    parser.add_argument('--tolerance', type=float,
+                        default=1e-3,
+                        help='Maximum difference of the predicted probabilities.')
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,46 @@
+import sys
+sys.path.append("../")
+import os
+import argparse
+import tools.model
+import tools.tflite
+
+
+def main(args):
+    model = tools.model.load_model(args.model_path)
+    model = tools.model.cast_model(model, tools.model.precision_policy(False))
+    calibration_tiles = None
+    if args.quantization == "int8":
+        calibration_tiles = tools.tflite.representative_tiles(args.calibration_dataset, n_tiles=args.calibration_tiles)
+        print("Calibrating on {} tiles of {}".format(len(calibration_tiles), args.calibration_dataset))
+    destination = args.destination
+    if destination == "":
+        destination = os.path.splitext(args.model_path)[0] + "_" + args.quantization + ".tflite"
+    size = tools.tflite.export_model(model, destination, quantization=args.quantization,
+                                     calibration_tiles=calibration_tiles)
+    print("Saved {} ({:.1f} kB)".format(destination, size / 1024))
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Exports a trained model to TensorFlow Lite for CPU inference.")
+    parser.add_argument('--model_path', type=str,
+                        default="../DATA/Trained_model.keras",
+                        help='Path to the trained model.')
+    parser.add_argument('--destination', type=str,
+                        default="",
+                        help='Path of the .tflite model (default: next to the model, suffixed by the quantization).')
+    parser.add_argument('--quantization', type=str, choices=tools.tflite.QUANTIZATIONS,
+                        default="int8",
+                        help='none: float32, dynamic: int8 weights, int8: int8 weights and activations calibrated on '
+                             'the calibration dataset.')
+    parser.add_argument('--calibration_dataset', type=str,
+                        default="../DATA/test1.tfrecord",
+                        help='TFRecord dataset of the int8 calibration tiles.')
+    parser.add_argument('--calibration_tiles', type=int,
+                        default=256,
+                        help='Number of calibration tiles.')
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
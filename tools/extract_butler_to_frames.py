@@ -0,0 +1,44 @@
+import sys
+sys.path.append("../")
+import tools.frames
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+import numpy as np
+import argparse
+
+
+def main(args):
+    if args.index_interval[1]-args.index_interval[0] <= 0:
+        args.index_interval = None
+    val_index = tools.frames.convert_butler_frames(args.repo, args.coll, args.directory,
+                                                   train_split=args.split,
+                                                   batch_size=args.cpu_count,
+                                                   verbose=True,
+                                                   seed=args.seed,
+                                                   maxlen=args.index_interval,
+                                                   image_dtype=args.image_dtype)
+    if len(val_index) > 0 and args.filename_index != "":
+        val_index = np.array(val_index)
+        val_index.sort()
+        with open(args.filename_index, 'wb') as f:
+            np.save(f, val_index)
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repo", type=str, help="Path to the repo", required=True)
+    parser.add_argument("--coll", type=str, help="Name of the collection", required=True)
+    parser.add_argument("--directory", type=str, help="Directory of the frame store", required=True)
+    parser.add_argument("--filename_index", type=str, help="Filename of the index", default="")
+    parser.add_argument("--cpu_count", type=int, help="Number of CPUs to use", default=1)
+    parser.add_argument("--split", type=float, help="Split ratio", default=0.25)
+    parser.add_argument("--seed", type=int, help="Seed for random split", default=42)
+    parser.add_argument("--index_interval", type=int, nargs=2, help="Interval from which to create data",
+                        default=[0, 0])
+    parser.add_argument("--image_dtype", type=str, choices=["float16", "float32"],
+                        help="Dtype in which the images are stored", default="float32")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
@@ -19,7 +19,12 @@ def main(args):
                                                     batch_size=args.cpu_count,
                                                     verbose=True,
                                                     seed=args.seed,
-                                                    maxlen=args.index_interval)
+                                                    maxlen=args.index_interval,
+                                                    schema_version=args.schema_version,
+                                                    x_dtype=args.x_dtype,
+                                                    num_shards=args.num_shards,
+                                                    queue_depth=args.queue_depth,
+                                                    resume=args.resume)
     if len(val_index) > 0:
         val_index = np.array(val_index)
         val_index.sort()
@@ -40,6 +45,14 @@ def parse_arguments(args):
     parser.add_argument("--seed", type=int, help="Seed for random split", default=42)
     parser.add_argument("--index_interval", type=int, nargs=2, help="Interval from which to create data",
                         default=[0, 0])
+    parser.add_argument("--schema_version", type=int, choices=[1, 2, 3], default=2,
+                        help="TFRecord schema version (1 is the legacy layout, 3 stores trail segments as labels)")
+    parser.add_argument("--x_dtype", type=str, choices=["float16", "float32"],
+                        help="Dtype in which the images are stored", default="float16")
+    parser.add_argument("--num_shards", type=int, help="Number of TFRecord shards per dataset", default=1)
+    parser.add_argument("--queue_depth", type=int, help="Maximum number of visits in flight", default=None)
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction,
+                        help="Keep visits converted by a previous run and convert only the missing visits", default=True)
     return parser.parse_args(args)
 
 
@@ -0,0 +1,365 @@
+import numpy as np
+import tensorflow as tf
+import multiprocessing
+import threading
+import tempfile
+import json
+import os
+from collections import OrderedDict
+
+if __name__ == "__main__":
+    import data
+    import model
+    import tiling
+else:
+    import tools.data as data
+    import tools.model as model
+    import tools.tiling as tiling
+
+
+def _save_npy_atomic(path, array):
+    # a temporary file of its own, writers of the same frame in other threads or processes do not share it
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _frame_paths(directory, visit):
+    return (os.path.join(directory, "images", "{:06d}.npy".format(visit)),
+            os.path.join(directory, "labels", "{:06d}.npy".format(visit)))
+
+
+def _one_visit_frames_worker(visit, exp_ref, cat_ref, output_coll, directory, image_dtype):
+    image_path, label_path = _frame_paths(directory, visit)
+    if os.path.isfile(image_path) and os.path.isfile(label_path):
+        return np.load(image_path, mmap_mode="r").shape
+    image, mask = data.one_visit_frames(exp_ref, cat_ref, data._worker_butler, output_coll)
+    _save_npy_atomic(label_path, mask)
+    _save_npy_atomic(image_path, image.astype(image_dtype))
+    return image.shape
+
+
+def _star_one_visit_frames_worker(args):
+    return _one_visit_frames_worker(*args)
+
+
+def is_frame_store(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, "frames.json"))
+
+
+def convert_butler_frames(repo, output_coll, directory, train_split=0.25, batch_size=None, verbose=True, seed=42,
+                          maxlen=None, image_dtype="float32"):
+    """
+    Writes the full injected calexps of a Butler collection and their label masks to a frame store, one .npy file per
+    visit under directory/images and directory/labels, and an index directory/frames.json. The frames are read back as
+    memory maps, so the tiling is chosen at training time (see random_crop_dataset). Visits already present in the
+    store are not converted again.
+
+    :param repo: Path to the Butler repository
+    :param output_coll: Name of the collection with the injected calexps and catalogs
+    :param directory: Directory of the frame store
+    :param train_split: Fraction of visits put into the test subset
+    :param batch_size: Number of worker processes (default is the number of CPUs - 1)
+    :param verbose: Print progress
+    :param seed: Seed of the train/test split (the same split as convert_butler_tfrecords)
+    :param maxlen: Interval of visits to convert (Optional)
+    :param image_dtype: Dtype in which the images are stored
+    :return: Indices of the visits in the test subset
+    """
+    from lsst.daf.butler import Butler
+    butler = Butler(repo)
+    catalog_ref = np.unique(np.array(list(butler.registry.queryDatasets("injected_postISRCCD_catalog",
+                                                                        collections=output_coll,
+                                                                        instrument='HSC',
+                                                                        findFirst=True))))
+    ref = np.unique(np.array(list(butler.registry.queryDatasets("injected_calexp",
+                                                                collections=output_coll,
+                                                                instrument='HSC',
+                                                                findFirst=True))))
+    offset = 0
+    if maxlen is not None:
+        ref = ref[maxlen[0]:maxlen[1]]
+        catalog_ref = catalog_ref[maxlen[0]:maxlen[1]]
+        offset = maxlen[0]
+    if train_split < 0 or train_split > 1:
+        raise ValueError("train_split must be between 0 and 1")
+    index = np.random.RandomState(seed).permutation(len(ref))[:int(len(ref) * train_split)]
+    if batch_size is None:
+        batch_size = os.cpu_count() - 1
+    os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "labels"), exist_ok=True)
+    data_ref = [(offset + i, ref[i], catalog_ref[i], output_coll, directory, image_dtype) for i in range(len(ref))]
+    shapes = [None] * len(ref)
+    with multiprocessing.Pool(batch_size, initializer=data._init_worker_butler, initargs=(repo,)) as pool:
+        for i, shape in enumerate(pool.imap(_star_one_visit_frames_worker, data_ref)):
+            shapes[i] = list(shape)
+            if verbose:
+                print("\r", i + 1, "/", len(ref), end="")
+    info = {"visits": [offset + i for i in range(len(ref))],
+            "shapes": shapes,
+            "test_visits": sorted(int(offset + i) for i in index),
+            "image_dtype": image_dtype,
+            "label_dtype": "uint8"}
+    with open(os.path.join(directory, "frames.json.tmp"), "w") as f:
+        json.dump(info, f, indent=2)
+    os.replace(os.path.join(directory, "frames.json.tmp"), os.path.join(directory, "frames.json"))
+    return index + offset
+
+
+def _select_visits(visits, test_visits, subset):
+    test_visits = set(test_visits)
+    if subset is None:
+        return list(visits)
+    elif subset == "train":
+        return [v for v in visits if v not in test_visits]
+    elif subset == "test":
+        return [v for v in visits if v in test_visits]
+    raise ValueError("subset must be train, test or None")
+
+
+class FrameStore:
+    """
+    Full detector images and labels written by convert_butler_frames. Frames are opened as read-only memory maps, so
+    only the pixels that are actually read are loaded into memory.
+    """
+
+    def __init__(self, directory, subset=None):
+        """
+        :param directory: Directory of the frame store
+        :param subset: "train", "test" or None for all visits
+        """
+        with open(os.path.join(directory, "frames.json")) as f:
+            info = json.load(f)
+        self.directory = directory
+        self.visits = _select_visits(info["visits"], info["test_visits"], subset)
+        shapes = dict(zip(info["visits"], info["shapes"]))
+        self.shapes = [tuple(shapes[v]) for v in self.visits]
+
+    def __len__(self):
+        return len(self.visits)
+
+    def get(self, i):
+        image_path, label_path = _frame_paths(self.directory, self.visits[i])
+        return np.load(image_path, mmap_mode="r"), np.load(label_path, mmap_mode="r")
+
+
+class _DiskLRU:
+    """
+    Size bounded least recently used bookkeeping of the frames in a cache directory. Shared by all ButlerFrameCache
+    objects using the same directory, access times are persisted as file modification times.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "labels"), exist_ok=True)
+        files = []
+        for name in os.listdir(os.path.join(directory, "images")):
+            if not name.endswith(".npy"):
+                continue
+            visit = int(name[:-len(".npy")])
+            image_path, label_path = _frame_paths(directory, visit)
+            if os.path.isfile(label_path):
+                files.append((os.path.getmtime(image_path), visit,
+                              os.path.getsize(image_path) + os.path.getsize(label_path)))
+        for _, visit, size in sorted(files):
+            self.entries[visit] = size
+        self.size = sum(self.entries.values())
+
+    def hit(self, visit):
+        with self.lock:
+            if visit not in self.entries:
+                return False
+            self.entries.move_to_end(visit)
+        try:
+            os.utime(_frame_paths(self.directory, visit)[0])
+        except FileNotFoundError:
+            return False
+        return True
+
+    def add(self, visit, size):
+        with self.lock:
+            self.size += size - self.entries.get(visit, 0)
+            self.entries[visit] = size
+            self.entries.move_to_end(visit)
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        # the most recently used frame is kept even if it alone exceeds the limit
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            old_visit, old_size = self.entries.popitem(last=False)
+            self.size -= old_size
+            for path in _frame_paths(self.directory, old_visit):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+
+_disk_lru_caches = {}
+
+
+class ButlerFrameCache:
+    """
+    Frames read lazily from a Butler collection (see tools.data.one_visit_frames) and cached on disk in the frame store
+    layout. A frame is extracted from the Butler the first time it is requested and read from the cache afterwards,
+    the cache is limited to max_bytes and evicts the least recently used frames first. Can be used as the source of
+    random_crop_dataset and tile_frame_dataset, so extraction overlaps with the first epoch of training.
+    """
+
+    def __init__(self, repo, output_coll, cache_dir, max_bytes=100 * 2 ** 30, subset=None, train_split=0.25, seed=42,
+                 maxlen=None):
+        """
+        :param repo: Path to the Butler repository
+        :param output_coll: Name of the collection with the injected calexps and catalogs
+        :param cache_dir: Directory of the on-disk cache
+        :param max_bytes: Maximum size of the cache in bytes. Caches on the same directory share it, the value given
+        last applies to all of them
+        :param subset: "train", "test" or None for all visits
+        :param train_split: Fraction of visits put into the test subset
+        :param seed: Seed of the train/test split (the same split as convert_butler_tfrecords)
+        :param maxlen: Interval of visits to use (Optional)
+        """
+        from lsst.daf.butler import Butler
+        butler = Butler(repo)
+        catalog_ref = np.unique(np.array(list(butler.registry.queryDatasets("injected_postISRCCD_catalog",
+                                                                            collections=output_coll,
+                                                                            instrument='HSC',
+                                                                            findFirst=True))))
+        ref = np.unique(np.array(list(butler.registry.queryDatasets("injected_calexp",
+                                                                    collections=output_coll,
+                                                                    instrument='HSC',
+                                                                    findFirst=True))))
+        offset = 0
+        if maxlen is not None:
+            ref = ref[maxlen[0]:maxlen[1]]
+            catalog_ref = catalog_ref[maxlen[0]:maxlen[1]]
+            offset = maxlen[0]
+        index = np.random.RandomState(seed).permutation(len(ref))[:int(len(ref) * train_split)]
+        self.repo = repo
+        self.output_coll = output_coll
+        self.cache_dir = cache_dir
+        self.refs = {offset + i: (ref[i], catalog_ref[i]) for i in range(len(ref))}
+        self.visits = _select_visits(sorted(self.refs), [offset + i for i in index], subset)
+        key = os.path.abspath(cache_dir)
+        if key not in _disk_lru_caches:
+            _disk_lru_caches[key] = _DiskLRU(cache_dir, max_bytes)
+        else:
+            _disk_lru_caches[key].set_max_bytes(max_bytes)
+        self.lru = _disk_lru_caches[key]
+        self.local = threading.local()
+
+    def _butler(self):
+        if not hasattr(self.local, "butler"):
+            from lsst.daf.butler import Butler
+            self.local.butler = Butler(self.repo)
+        return self.local.butler
+
+    def __len__(self):
+        return len(self.visits)
+
+    def get(self, i):
+        visit = self.visits[i]
+        image_path, label_path = _frame_paths(self.cache_dir, visit)
+        if self.lru.hit(visit):
+            try:
+                return np.load(image_path, mmap_mode="r"), np.load(label_path, mmap_mode="r")
+            except FileNotFoundError:
+                # evicted by another thread or process after the hit, extracted again like a miss
+                pass
+        exp_ref, cat_ref = self.refs[visit]
+        image, mask = data.one_visit_frames(exp_ref, cat_ref, self._butler(), self.output_coll)
+        image = image.astype(np.float32)
+        _save_npy_atomic(label_path, mask)
+        _save_npy_atomic(image_path, image)
+        self.lru.add(visit, os.path.getsize(image_path) + os.path.getsize(label_path))
+        return image, mask
+
+
+def random_crop_dataset(source, crop_shape=(128, 128), crops_per_frame=16, clip=True, seed=None,
+                        num_parallel_calls=tf.data.AUTOTUNE):
+    """
+    Creates a dataset of random crops of the frames of a frame source. Every pass over the dataset
+    visits the frames in a new random order and draws crops_per_frame crops at random positions from each of them.
+    The positions are drawn from a generator seeded with the seed, the frame index and the number of the pass, so
+    they do not depend on the order in which the parallel calls read the frames.
+
+    :param source: Object with __len__ and get(i) returning the (image, label) frames, e.g. FrameStore
+    :param crop_shape: Shape of the crops
+    :param crops_per_frame: Number of crops drawn from every frame per pass
+    :param clip: Clip the inputs to model.CLIP_RANGE
+    :param seed: Seed of the frame order and crop positions (Optional)
+    :param num_parallel_calls: Number of frames read in parallel
+    :return: Dataset of (x, y) crops with shape crop_shape + (1,)
+    """
+    crop_shape = tuple(crop_shape)
+    crop_seed = np.random.SeedSequence(seed).entropy
+    # every frame is read once per pass, the number of times it was read is the number of the pass
+    passes = np.zeros(len(source), dtype=np.int64)
+    lock = threading.Lock()
+
+    def crops(i):
+        image, label = source.get(int(i))
+        if image.shape[0] < crop_shape[0] or image.shape[1] < crop_shape[1]:
+            raise ValueError("Frame {} of shape {} is smaller than the crop".format(int(i), image.shape))
+        with lock:
+            epoch = passes[i]
+            passes[i] += 1
+        rng = np.random.default_rng([crop_seed, int(i), int(epoch)])
+        rows = rng.integers(0, image.shape[0] - crop_shape[0] + 1, crops_per_frame)
+        cols = rng.integers(0, image.shape[1] - crop_shape[1] + 1, crops_per_frame)
+        x = np.stack([image[r:r + crop_shape[0], c:c + crop_shape[1]] for r, c in zip(rows, cols)])
+        y = np.stack([label[r:r + crop_shape[0], c:c + crop_shape[1]] for r, c in zip(rows, cols)])
+        return x.astype(np.float32)[..., np.newaxis], y.astype(np.float32)[..., np.newaxis]
+
+    return _frame_dataset(source, crops, crop_shape, clip, seed, num_parallel_calls)
+
+
+def tile_frame_dataset(source, tile_shape=(128, 128), clip=True, num_parallel_calls=tf.data.AUTOTUNE):
+    """
+    Creates a dataset of all tiles of the frames of a frame source, in frame order and in the same tile order as
+    tools.data.split. Used for validation and prediction on a frame store.
+
+    :param source: Object with __len__ and get(i) returning the (image, label) frames, e.g. FrameStore
+    :param tile_shape: Shape of the tiles
+    :param clip: Clip the inputs to model.CLIP_RANGE
+    :param num_parallel_calls: Number of frames read in parallel
+    :return: Dataset of (x, y) tiles with shape tile_shape + (1,)
+    """
+    tile_shape = tuple(tile_shape)
+
+    def tiles(i):
+        image, label = source.get(int(i))
+        grid = tiling.TileGrid(image.shape, tile_shape)
+        # the tiles are copied only once, cast to float32 while they are cut out of the frames
+        x = grid.split(image, dtype=np.float32).reshape((len(grid),) + tile_shape + (1,))
+        y = grid.split(label, dtype=np.float32).reshape((len(grid),) + tile_shape + (1,))
+        return x, y
+
+    return _frame_dataset(source, tiles, tile_shape, clip, None, num_parallel_calls, shuffle=False)
+
+
+def _frame_dataset(source, function, shape, clip, seed, num_parallel_calls, shuffle=True):
+    def load(i):
+        x, y = tf.numpy_function(function, [i], (tf.float32, tf.float32))
+        x = tf.ensure_shape(x, (None,) + shape + (1,))
+        y = tf.ensure_shape(y, (None,) + shape + (1,))
+        if clip:
+            x = tf.clip_by_value(x, *model.CLIP_RANGE)
+        return x, y
+
+    dataset = tf.data.Dataset.range(len(source))
+    if shuffle:
+        dataset = dataset.shuffle(len(source), seed=seed, reshuffle_each_iteration=True)
+    return dataset.map(load, num_parallel_calls=num_parallel_calls, deterministic=not shuffle).unbatch()
@@ -98,7 +98,7 @@ class StockHyperModel(kt.HyperModel):
             print()
         model = m.unet_model(self.input_shape, self.arhitecture)
         model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=self.training_parameters["LR"]), loss=loss,
-                      metrics=["Precision", "Recall", metrics.F1_Score()])
+                      metrics=[metrics.ConfusionMetrics()])
         return model
 
 
@@ -22,8 +22,9 @@ def tversky(y_true, y_pred, alpha=0.9):
     :return: Tversky coefficient
     """
     smooth = 1
-    y_true_pos = tf.reshape(y_true, [-1])
-    y_pred_pos = tf.reshape(y_pred, [-1])
+    # the sums run over all pixels of the batch, they are always reduced in float32
+    y_true_pos = tf.reshape(tf.cast(y_true, tf.float32), [-1])
+    y_pred_pos = tf.reshape(tf.cast(y_pred, tf.float32), [-1])
     true_pos = tf.reduce_sum(y_true_pos * y_pred_pos, axis=None)
     false_neg = tf.reduce_sum(y_true_pos * (1-y_pred_pos), axis=None)
     false_pos = tf.reduce_sum((1-y_true_pos)*y_pred_pos, axis=None)
@@ -51,33 +52,100 @@ def FocalTversky (alpha=0.9, gamma=2):
     return focal_tversky
 
 
-class F1_Score(tf.keras.metrics.Metric):
+def threshold_for_recall(scores, labels, recall=0.99):
     """
-    Pixel-wise F1 score metric, passed to model as metric.
+    Highest threshold at which at least a recall fraction of the positive samples have a score >= threshold, used to
+    calibrate the tile gate.
+    :param scores: Predicted scores
+    :param labels: True labels (0 or 1) of the samples
+    :param recall: Target recall
+    :return: Threshold (0 if there are no positive samples)
     """
-    def __init__(self, name='f1_score', **kwargs):
+    positive_scores = np.sort(np.asarray(scores, dtype=np.float64)[np.asarray(labels) > 0])
+    if len(positive_scores) == 0:
+        return 0.
+    missed = int(np.floor((1 - recall) * len(positive_scores) + 1e-9))
+    return float(positive_scores[min(missed, len(positive_scores) - 1)])
+
+
+class ConfusionMetrics(tf.keras.metrics.Metric):
+    """
+    Pixel-wise precision, recall and F1 score, passed to model as metric. The true positive, false positive and false
+    negative pixels are counted over all batches since the last reset (the epoch) and the scores are computed from the
+    totals. The scores at the first threshold are named "Precision", "Recall" and "f1_score", the scores at the other
+    thresholds get the threshold as suffix (e.g. "f1_score_0.3"). The pixels are counted in float64, float32 stops
+    counting single pixels above 2**24.
+    :param thresholds: Threshold or list of thresholds above which a predicted pixel is positive
+    """
+    def __init__(self, thresholds=0.5, name='confusion_metrics', **kwargs):
         super().__init__(name=name, **kwargs)
-        self.f1 = self.add_weight(name='f1', initializer='zeros')
-        self.counter = self.add_weight(name='counter', initializer='zeros')
-        self.precision_fn = tf.keras.metrics.Precision(thresholds=0.5)
-        self.recall_fn = tf.keras.metrics.Recall(thresholds=0.5)
-        self.count = self.add_weight(name='F1ScoreCount', initializer='zeros')
+        self.thresholds = [float(t) for t in np.atleast_1d(thresholds)]
+        self.true_positives = self.add_weight(name='true_positives', shape=(len(self.thresholds),),
+                                              initializer='zeros', dtype='float64')
+        self.false_positives = self.add_weight(name='false_positives', shape=(len(self.thresholds),),
+                                               initializer='zeros', dtype='float64')
+        self.false_negatives = self.add_weight(name='false_negatives', shape=(len(self.thresholds),),
+                                               initializer='zeros', dtype='float64')
 
     def update_state(self, y_true, y_pred, sample_weight=None):
-        self.precision_fn.reset_state()
-        self.recall_fn.reset_state()
-        p = self.precision_fn(y_true, y_pred)
-        r = self.recall_fn(y_true, y_pred)
-        self.f1.assign_add(2 * ((p * r) / (p + r + 1e-6)))
-        self.count.assign_add(1)
+        y_true = tf.reshape(tf.cast(tf.cast(y_true, tf.bool), tf.float64), [-1, 1])
+        if sample_weight is None:
+            weight = tf.ones_like(y_true)
+        else:
+            # weights of shape (batch,) apply to all pixels of the example
+            sample_weight = tf.cast(sample_weight, tf.float64)
+            sample_weight = tf.reshape(sample_weight, tf.concat(
+                [tf.shape(sample_weight), tf.ones([tf.rank(y_pred) - tf.rank(sample_weight)], tf.int32)], axis=0))
+            weight = tf.reshape(tf.broadcast_to(sample_weight, tf.shape(y_pred)), [-1, 1])
+        y_pred = tf.reshape(tf.cast(y_pred, tf.float32), [-1, 1])
+        # (pixels, thresholds)
+        predicted = tf.cast(y_pred > tf.constant(self.thresholds), tf.float64) * weight
+        true_positives = tf.reduce_sum(predicted * y_true, axis=0)
+        self.true_positives.assign_add(true_positives)
+        self.false_positives.assign_add(tf.reduce_sum(predicted, axis=0) - true_positives)
+        self.false_negatives.assign_add(tf.reduce_sum(y_true * weight) - true_positives)
 
+    def scores(self):
+        """
+        Returns the precision, recall and F1 score at every threshold.
+        """
+        precision = tf.math.divide_no_nan(self.true_positives, self.true_positives + self.false_positives)
+        recall = tf.math.divide_no_nan(self.true_positives, self.true_positives + self.false_negatives)
+        f1 = tf.math.divide_no_nan(2 * precision * recall, precision + recall)
+        return tuple(tf.cast(score, tf.float32) for score in (precision, recall, f1))
 
     def result(self):
-        return self.f1/self.count
+        precision, recall, f1 = self.scores()
+        results = {}
+        for i, threshold in enumerate(self.thresholds):
+            suffix = "" if i == 0 else "_{:g}".format(threshold)
+            results["Precision" + suffix] = precision[i]
+            results["Recall" + suffix] = recall[i]
+            results["f1_score" + suffix] = f1[i]
+        return results
 
     def reset_state(self):
-        # we also need to reset the state of the precision and recall objects
-        self.precision_fn.reset_state()
-        self.recall_fn.reset_state()
-        self.f1.assign(0)
-        self.count.assign(0)
+        for variable in (self.true_positives, self.false_positives, self.false_negatives):
+            variable.assign(tf.zeros_like(variable))
+
+    def get_config(self):
+        config = super().get_config()
+        config["thresholds"] = self.thresholds
+        return config
+
+
+class F1_Score(ConfusionMetrics):
+    """
+    Pixel-wise F1 score metric over all batches since the last reset, passed to model as metric.
+    :param threshold: Threshold above which a predicted pixel is positive
+    """
+    def __init__(self, name='f1_score', threshold=0.5, **kwargs):
+        super().__init__(thresholds=threshold, name=name, **kwargs)
+
+    def result(self):
+        return self.scores()[2][0]
+
+    def get_config(self):
+        config = super().get_config()
+        config["threshold"] = config.pop("thresholds")[0]
+        return config
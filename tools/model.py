@@ -1,32 +1,354 @@
+import json
+import re
+import tempfile
+import zipfile
 import tensorflow as tf
 import numpy as np
 from tools.attention_module import attach_attention_module
 
 
-def parse_function(img_shape=(128, 128, 1), test=False, clip=True):
+CLIP_RANGE = (-166.43, 169.96)
+"""Range of pixel values to which the inputs are clipped, the range of values seen in the training set."""
+
+TFRECORD_SCHEMA_VERSION = 2
+"""Current version of the TFRecord example layout written by :func:`tools.data.serialize_example`.
+
+Version 1 stores the tile as a ``FloatList`` and the label as an ``Int64List``. Version 2 stores the tile as raw
+``float16``/``float32`` bytes and the label as bit-packed (or ``uint8``) bytes, together with the schema version,
+tile shape, image dtype and label encoding of every example. Version 3 stores the tile as in version 2 and the label
+as the trail segments crossing the tile (endpoints in tile pixel coordinates and line thickness), which are rasterized
+by :func:`rasterize_segments` at the resolution of the model output.
+"""
+
+_XY_ONE = 1 << 16
+"""One pixel in the fixed point coordinates cv2 draws thick lines in."""
+
+_MAX_CAP_RADIUS = 128
+"""Largest radius of the round line caps rasterized by :func:`rasterize_segments`."""
+
+
+def get_tfrecord_schema(raw_dataset):
     """
+    Reads the first record of a TFRecord dataset and returns the description of its example layout. Legacy (version 1)
+    records carry no schema information, their shape is taken as the square root of the number of pixels.
 
-    :param img_shape:
-    :param test:
-    :param clip:
-    :return:
+    :param raw_dataset: Unparsed TFRecord dataset
+    :return: Dictionary with the schema "version", the tile "shape", the "x_dtype" and the "y_encoding"
     """
-    def parsing(example_proto):
+    for record in raw_dataset.take(1):
+        example = tf.train.Example.FromString(record.numpy())
+        feature = example.features.feature
+        if "schema_version" not in feature:
+            side = int(np.sqrt(len(feature["x"].float_list.value)))
+            return {"version": 1, "shape": (side, side, 1), "x_dtype": "float32", "y_encoding": "int64"}
+        return {"version": int(feature["schema_version"].int64_list.value[0]),
+                "shape": tuple(int(i) for i in feature["shape"].int64_list.value),
+                "x_dtype": feature["x_dtype"].bytes_list.value[0].decode(),
+                "y_encoding": feature["y_encoding"].bytes_list.value[0].decode()}
+    raise ValueError("TFRecord dataset is empty")
+
+
+def unpack_bits(packed, size):
+    """
+    Inverse of ``np.packbits`` along the last axis of a uint8 tensor.
+
+    :param packed: uint8 tensor with 8 pixels per byte (big endian bit order)
+    :param size: Number of pixels to return
+    :return: uint8 tensor of 0/1 values with size elements along the last axis
+    """
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(packed[..., tf.newaxis], shifts), 1)
+    return tf.reshape(bits, tf.concat([tf.shape(packed)[:-1], [-1]], axis=0))[..., :size]
+
+
+def _resize_sources(size, output_size):
+    """
+    Returns the pixels read by tf.image.resize (bilinear, half pixel centers) along one axis, and for every output
+    pixel the positions in them of its lower and upper neighbour (the same pixel where the upper one has no weight).
+    """
+    position = (np.arange(output_size) + 0.5) * size / output_size - 0.5
+    lower = np.clip(np.floor(position), 0, size - 1)
+    upper = np.where(position > np.floor(position), np.clip(np.ceil(position), 0, size - 1), lower)
+    pixels = np.unique(np.concatenate([lower, upper]))
+    return pixels.astype(np.float32), np.searchsorted(pixels, lower), np.searchsorted(pixels, upper)
+
+
+def _cap_half_widths(max_radius):
+    """
+    Returns the half widths of the rows of the filled circles cv2 draws as round caps (midpoint algorithm), indexed by
+    radius and row offset from the centre, -1 for rows outside of the circle.
+    """
+    table = np.full((max_radius + 1, max_radius + 2), -1, dtype=np.int64)
+    for radius in range(max_radius + 1):
+        err, dx, dy, plus, minus = 0, radius, 0, 1, 2 * radius - 1
+        while dx >= dy:
+            table[radius, dy] = max(table[radius, dy], dx)
+            table[radius, dx] = max(table[radius, dx], dy)
+            dy += 1
+            err += plus
+            plus += 2
+            step = int(err <= 0) - 1
+            err -= minus & step
+            dx += step
+            minus -= step & 2
+    return table
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def _empty_span(like):
+    return tf.ones_like(like), tf.zeros_like(like)
+
+
+def _select_span(condition, span, other):
+    return tf.where(condition, span[0], other[0]), tf.where(condition, span[1], other[1])
+
+
+def _line_spans(x1, y1, x2, y2, rows):
+    """
+    Returns the first and last column cv2 sets in every row when drawing the outline of a polygon between two fixed
+    point vertices (Line2), for the pixels along the line and for its end point.
+    """
+    half = _XY_ONE // 2
+    dx = x2 - x1
+    dy = y2 - y1
+    x_major = tf.abs(dx) > tf.abs(dy)
+    swap = tf.where(x_major, dx < 0, dy < 0)
+    x1, x2 = tf.where(swap, x2, x1), tf.where(swap, x1, x2)
+    y1, y2 = tf.where(swap, y2, y1), tf.where(swap, y1, y2)
+    dx = x2 - x1
+    dy = y2 - y1
+    step = tf.where(x_major, tf.truncatediv(dy * _XY_ONE, tf.bitwise.bitwise_or(dx, 1)),
+                    tf.truncatediv(dx * _XY_ONE, tf.bitwise.bitwise_or(dy, 1)))
+    count = tf.where(x_major, dx, dy) // _XY_ONE
+    x1 += half
+    y1 += half
+    # the k-th pixel of a line along x is in the row (y1 + k * step) // ONE, solved for the k of every row
+    top = rows * _XY_ONE - y1
+    bottom = top + _XY_ONE - 1
+    size = tf.maximum(tf.abs(step), 1)
+    first = tf.where(step > 0, _ceil_div(top, size), _ceil_div(-bottom, size))
+    last = tf.where(step > 0, bottom // size, -top // size)
+    flat = (top <= 0) & (bottom >= 0)
+    first = tf.maximum(tf.where(step == 0, tf.where(flat, tf.zeros_like(first), count + 1), first), 0)
+    last = tf.minimum(tf.where(step == 0, count + tf.zeros_like(last), last), count)
+    along_x = (x1 // _XY_ONE + first, x1 // _XY_ONE + last)
+    # a line along y has one pixel in every row it crosses
+    k = rows - y1 // _XY_ONE
+    column = (x1 + k * step) // _XY_ONE
+    along_y = _select_span((k >= 0) & (k <= count), (column, column), _empty_span(column))
+    end_column = (x2 + half) // _XY_ONE + tf.zeros_like(rows)
+    end = _select_span(rows == (y2 + half) // _XY_ONE, (end_column, end_column), _empty_span(end_column))
+    return [_select_span(x_major, along_x, along_y), end]
+
+
+def _convex_fill_span(vx, vy, rows):
+    """
+    Returns the first and last column of the span cv2 fills in every row for a convex polygon given by fixed point
+    vertices of shape (..., 4) (FillConvexPoly, without its outline). The edge of each of the two chains of vertices
+    walking down from the top vertex is the one ending at the first vertex below the row, its x is advanced row by row
+    from the vertex it starts at.
+    """
+    half = _XY_ONE // 2
+    top = tf.zeros_like(vy[..., 0])
+    top_y = vy[..., 0]
+    for i in range(1, 4):
+        above = vy[..., i] < top_y
+        top = tf.where(above, tf.constant(i, tf.int64), top)
+        top_y = tf.where(above, vy[..., i], top_y)
+    vertex_rows = (vy + half) // _XY_ONE
+    first_row = (top_y[..., tf.newaxis] + half) // _XY_ONE
+    last_row = (tf.reduce_max(vy, axis=-1, keepdims=True) + half) // _XY_ONE
+    edge_x = []
+    for direction in (1, -1):
+        chain = (top[..., tf.newaxis] + direction * tf.range(4, dtype=tf.int64)) % 4
+        chain_rows = tf.gather(vertex_rows, chain, batch_dims=2)
+        chain_x = tf.gather(vx, chain, batch_dims=2)
+        below = tf.cast(chain_rows[..., 1:, tf.newaxis] > rows[..., tf.newaxis, :], tf.int64)
+        end = tf.minimum(1 + tf.reduce_sum(tf.math.cumprod(1 - below, axis=-2), axis=-2), 3)
+        start_row = tf.gather(chain_rows, end - 1, batch_dims=2)
+        end_row = tf.gather(chain_rows, end, batch_dims=2)
+        start_x = tf.gather(chain_x, end - 1, batch_dims=2)
+        end_x = tf.gather(chain_x, end, batch_dims=2)
+        step = tf.truncatediv((end_x - start_x) * 2 + (end_row - start_row), 2 * tf.maximum(end_row - start_row, 1))
+        edge_x.append(start_x + (rows - start_row) * step)
+    span = ((tf.minimum(*edge_x) + half) // _XY_ONE, (tf.maximum(*edge_x) + half) // _XY_ONE)
+    return _select_span((rows >= first_row) & (rows < last_row), span, _empty_span(span[0]))
+
+
+def rasterize_segments(segments, thickness, tile_shape, output_shape):
+    """
+    Rasterizes line segments given in tile pixel coordinates onto a grid of output_shape pixels covering the tile, in
+    place of drawing the lines at full resolution with cv2 and then resizing and ceiling the mask (reshape_outputs).
+    A batch of tiles is rasterized at once if segments and thickness have leading batch dimensions.
+
+    The tile pixels are set exactly as by cv2.line (8-connected) on the frame the segments were cut from: lines of
+    thickness 1 follow Bresenham's algorithm, thicker lines are the polygon cv2 fills in fixed point arithmetic
+    together with its outline and the round caps of the endpoints. Only trails leaving the frame differ, cv2 clips
+    their outline to the frame before drawing it. Every part of a line covers a span of columns in each row, the spans
+    are summed up as the steps of a difference array. An output pixel is set if one of the tile pixels the bilinear
+    resize interpolates it from is set, which is what the ceil of the resized mask sets.
+
+    :param segments: Tensor of shape (..., n, 4) with the segment endpoints (x0, y0, x1, y1), x along columns
+    :param thickness: Line thickness in tile pixels, of shape (...)
+    :param tile_shape: Shape (rows, columns) of the tile
+    :param output_shape: Shape (rows, columns) of the rasterized mask
+    :return: float32 mask of shape (...) + output_shape + (1,)
+    """
+    rows, row_lower, row_upper = _resize_sources(tile_shape[0], output_shape[0])
+    cols, col_lower, col_upper = _resize_sources(tile_shape[1], output_shape[1])
+    width = tile_shape[1]
+    batch_shape = tf.shape(segments)[:-2]
+    segments = tf.reshape(tf.cast(tf.round(segments), tf.int64), tf.concat([[-1], tf.shape(segments)[-2:]], axis=0))
+    thickness = tf.reshape(tf.cast(tf.round(thickness), tf.int64), [-1, 1, 1])
+    thickness = tf.clip_by_value(thickness, 1, 2 * _MAX_CAP_RADIUS)
+    rows = tf.constant(rows.astype(np.int64).reshape(1, 1, -1))
+    x0, y0, x1, y1 = [v[..., tf.newaxis] for v in tf.unstack(segments, num=4, axis=-1)]
+
+    # Lines of thickness 1: Bresenham's algorithm from the left endpoint, the k-th pixel along the major axis is offset
+    # by (2 * minor * k + major - 1) // (2 * major) along the minor axis
+    swap = x1 < x0
+    left_x, left_y = tf.where(swap, x1, x0), tf.where(swap, y1, y0)
+    dx = tf.abs(x1 - x0)
+    dy = tf.where(swap, y0, y1) - left_y
+    sign = 1 - 2 * tf.cast(dy < 0, tf.int64)
+    major = tf.maximum(dx, tf.abs(dy))
+    minor = tf.minimum(dx, tf.abs(dy))
+    k = sign * (rows - left_y)
+    size = tf.maximum(2 * minor, 1)
+    first = tf.where(minor > 0, _ceil_div(2 * major * k - major + 1, size), tf.where(k == 0, 0 * k, major + 1))
+    last = tf.where(minor > 0, (2 * major * k + major) // size, major + 0 * k)
+    along_x = (left_x + tf.maximum(first, 0), left_x + tf.minimum(last, major))
+    column = left_x + (2 * minor * k + major - 1) // tf.maximum(2 * major, 1)
+    along_y = _select_span((k >= 0) & (k <= major), (column, column), _empty_span(column))
+    spans = [_select_span(thickness > 1, _empty_span(column),
+                          _select_span(dx >= tf.abs(dy), along_x, along_y))]
+
+    # Thicker lines: the polygon of the line offset by half the thickness on both sides, filled row by row and
+    # outlined in fixed point, and filled circles around both endpoints
+    length = tf.sqrt(tf.cast(tf.square(x0 - x1) + tf.square(y1 - y0), tf.float64))
+    width_offset = tf.cast(thickness * (_XY_ONE // 2) + (thickness % 2) * (_XY_ONE // 2), tf.float64)
+    scale = width_offset / tf.maximum(length, 1e-300)
+    offset_x = tf.cast(tf.math.rint(tf.cast(y1 - y0, tf.float64) * scale), tf.int64)
+    offset_y = tf.cast(tf.math.rint(tf.cast(x0 - x1, tf.float64) * scale), tf.int64)
+    vx = tf.concat([x0 * _XY_ONE + offset_x, x0 * _XY_ONE - offset_x, x1 * _XY_ONE - offset_x,
+                    x1 * _XY_ONE + offset_x], axis=-1)
+    vy = tf.concat([y0 * _XY_ONE + offset_y, y0 * _XY_ONE - offset_y, y1 * _XY_ONE - offset_y,
+                    y1 * _XY_ONE + offset_y], axis=-1)
+    polygon = [_convex_fill_span(vx, vy, rows)]
+    for i in range(4):
+        polygon += _line_spans(vx[..., i - 1:i if i else None], vy[..., i - 1:i if i else None],
+                               vx[..., i:i + 1], vy[..., i:i + 1], rows)
+    has_polygon = (thickness > 1) & (length > np.finfo(np.float64).eps)
+    spans += [_select_span(has_polygon, span, _empty_span(span[0])) for span in polygon]
+    radius = (thickness + 1) // 2
+    cap_widths = tf.constant(_cap_half_widths(_MAX_CAP_RADIUS).reshape(-1))
+    for x, y in ((x0, y0), (x1, y1)):
+        half_width = tf.gather(cap_widths, radius * (_MAX_CAP_RADIUS + 2) + tf.minimum(tf.abs(rows - y), radius + 1))
+        spans.append(_select_span(thickness > 1, (x - half_width, x + half_width), _empty_span(half_width)))
+
+    # +1 at the first and -1 after the last column of every span, the cumulative sum counts the spans covering a pixel
+    start = tf.clip_by_value(tf.stack([span[0] for span in spans], axis=-1), 0, width)
+    stop = tf.clip_by_value(tf.stack([span[1] for span in spans], axis=-1) + 1, 0, width)
+    step = tf.cast(start < stop, tf.int32)
+    n_rows = tf.shape(segments, out_type=tf.int64)[0] * rows.shape[-1]
+    offset = tf.reshape(tf.range(n_rows), [-1, 1, rows.shape[-1], 1]) * (width + 1)
+    counts = tf.math.unsorted_segment_sum(tf.reshape(tf.stack([step, -step]), [-1]),
+                                          tf.reshape(tf.stack([offset + start, offset + stop]), [-1]),
+                                          n_rows * (width + 1))
+    mask = tf.cumsum(tf.reshape(counts, [-1, rows.shape[-1], width + 1]), axis=-1)[..., :width] > 0
+    mask = tf.reshape(mask, tf.concat([batch_shape, tf.shape(mask)[1:]], axis=0))
+    mask = tf.gather(mask, row_lower, axis=-2) | tf.gather(mask, row_upper, axis=-2)
+    col_lower, col_upper = cols[col_lower].astype(np.int64), cols[col_upper].astype(np.int64)
+    mask = tf.gather(mask, col_lower, axis=-1) | tf.gather(mask, col_upper, axis=-1)
+    return tf.cast(mask, tf.float32)[..., tf.newaxis]
+
+
+def parse_function(img_shape=(128, 128, 1), test=False, clip=True, schema=None, output_shape=None, batched=False):
+    """
+    Returns the parsing function for serialized examples. The example layout is given by the schema returned by
+    :func:`get_tfrecord_schema`, if no schema is given the legacy (version 1) layout is assumed.
+
+    With batched=True the function parses a whole batch of serialized examples with one ``tf.io.parse_example`` call
+    and decodes, clips, casts and resizes the batch at once. Map it after batching the raw TFRecord dataset, which
+    removes the per-example overhead of the input pipeline.
+
+    :param img_shape: Shape of one tile
+    :param test: If True only the inputs are returned
+    :param clip: Clip the inputs to the range of values seen in the training set
+    :param schema: Schema dictionary of the TFRecord (Optional)
+    :param output_shape: Shape (rows, columns) of the returned labels, e.g. the model output (default is the tile shape)
+    :param batched: Parse a batch (1D tensor) of serialized examples instead of a single one
+    :return: Parsing function
+    """
+    version = 1 if schema is None else schema["version"]
+    img_shape = tuple(img_shape)
+    n_pixels = int(np.prod(img_shape))
+    shape = (-1,) + img_shape if batched else img_shape
+    if output_shape is not None:
+        output_shape = tuple(output_shape[:2])
+    resize_labels = output_shape is not None and output_shape != img_shape[:2]
+
+    def parsing_v1(example_proto):
         keys_to_features = {'x': tf.io.FixedLenFeature(shape=img_shape, dtype=tf.float32),
                             'y': tf.io.FixedLenFeature(shape=img_shape, dtype=tf.int64)}
-        parsed_features = tf.io.parse_single_example(example_proto, keys_to_features)
-        parsed_features['y'] = tf.cast(parsed_features['y'], tf.float32)
+        return tf.io.parse_example(example_proto, keys_to_features)
+
+    def parsing_v2(example_proto):
+        keys_to_features = {'x': tf.io.FixedLenFeature(shape=[], dtype=tf.string),
+                            'y': tf.io.FixedLenFeature(shape=[], dtype=tf.string)}
+        parsed_features = tf.io.parse_example(example_proto, keys_to_features)
+        x = tf.io.decode_raw(parsed_features['x'], tf.dtypes.as_dtype(schema["x_dtype"]))
+        y = tf.io.decode_raw(parsed_features['y'], tf.uint8)
+        if schema["y_encoding"] == "packbits":
+            y = unpack_bits(y, n_pixels)
+        return {'x': tf.reshape(x, shape), 'y': tf.reshape(y, shape)}
+
+    def parsing_v3(example_proto):
+        keys_to_features = {'x': tf.io.FixedLenFeature(shape=[], dtype=tf.string)}
+        if not test:
+            keys_to_features.update({'segments': tf.io.RaggedFeature(dtype=tf.float32),
+                                     'thickness': tf.io.FixedLenFeature(shape=[], dtype=tf.float32)})
+        parsed_features = tf.io.parse_example(example_proto, keys_to_features)
+        x = tf.io.decode_raw(parsed_features['x'], tf.dtypes.as_dtype(schema["x_dtype"]))
+        if test:
+            # only the inputs are returned, the labels are not rasterized
+            return {'x': tf.reshape(x, shape)}
+        segments = parsed_features['segments']
+        if batched:
+            # tiles with fewer segments are padded with a point far outside of the tile
+            segments = segments.to_tensor(default_value=-1e9)
+        segments = tf.reshape(segments, tf.concat([tf.shape(segments)[:-1], [-1, 4]], axis=0))
+        y = rasterize_segments(segments, parsed_features['thickness'], img_shape[:2],
+                               img_shape[:2] if output_shape is None else output_shape)
+        return {'x': tf.reshape(x, shape), 'y': y}
+
+    if version == 1:
+        parse = parsing_v1
+    elif version == 2:
+        parse = parsing_v2
+    elif version == 3:
+        parse = parsing_v3
+    else:
+        raise ValueError("Unsupported TFRecord schema version: {}".format(version))
+
+    def parsing(example_proto):
+        parsed_features = parse(example_proto)
+        x = tf.cast(parsed_features['x'], tf.float32)
         if clip:
-            parsed_features['x'] = tf.clip_by_value(parsed_features['x'], -166.43, 169.96)
+            x = tf.clip_by_value(x, *CLIP_RANGE)
         if test:
-            return parsed_features['x']
-        else:
-            return parsed_features['x'], parsed_features['y']
+            return x
+        y = tf.cast(parsed_features['y'], tf.float32)
+        if resize_labels and version != 3:
+            y = tf.math.ceil(tf.image.resize(y, output_shape))
+        return x, y
 
     return parsing
 
 
-
 def reshape_outputs(img_shape=(32, 32)):
     def reshaping(inputs, targets):
         targets = tf.image.resize(targets, img_shape)
@@ -37,11 +359,7 @@ def reshape_outputs(img_shape=(32, 32)):
 
 
 def get_shape_of_quadratic_image_tfrecord(raw_dataset):
-    keys_to_features = {'x': tf.io.VarLenFeature(dtype=tf.float32),
-                        'y': tf.io.VarLenFeature(dtype=tf.int64)}
-    for i in raw_dataset.take(1):
-        parsed_features = tf.io.parse_single_example(i, keys_to_features)
-        return int(np.sqrt(parsed_features["x"].shape[0])), int(np.sqrt(parsed_features["x"].shape[0])), 1
+    return get_tfrecord_schema(raw_dataset)["shape"]
 
 
 def get_tfrecords_size(dataset):
@@ -51,42 +369,493 @@ def get_tfrecords_size(dataset):
     return size
 
 
+def precision_policy(mixed_precision=False):
+    """
+    Returns the name of the Keras dtype policy to use. Mixed precision computes in float16 on GPUs and in bfloat16 on
+    CPUs (which have no fast float16 arithmetic), variables are always kept in float32.
+
+    :param mixed_precision: Use mixed precision
+    :return: Name of the dtype policy
+    """
+    if not mixed_precision:
+        return "float32"
+    if len(tf.config.list_physical_devices('GPU')) > 0:
+        return "mixed_float16"
+    return "mixed_bfloat16"
+
+
+def set_precision_policy(mixed_precision=False):
+    """
+    Sets the global Keras dtype policy used by the layers of models built afterwards (see precision_policy).
+
+    :param mixed_precision: Use mixed precision
+    :return: Name of the dtype policy
+    """
+    policy = precision_policy(mixed_precision)
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def _flatten_layers(model):
+    for layer in model.layers:
+        if isinstance(layer, RecomputeGrad):
+            yield from _flatten_layers(layer.block)
+        else:
+            yield layer
+
+
+def cast_model(model, policy):
+    """
+    Returns the model with every layer in the given dtype policy, except output_sigmoid which is kept in float32 for
+    numerical safety of the loss. Used to run a model saved in another precision, the model is returned unchanged if
+    its layers already use the policy.
+
+    :param model: Keras model
+    :param policy: Name of the dtype policy
+    :return: Model with the same weights in the given precision
+    """
+    def layer_policy(layer):
+        return "float32" if layer.name == "output_sigmoid" else policy
+
+    if all(layer.dtype_policy.name == layer_policy(layer) for layer in _flatten_layers(model)
+           if not isinstance(layer, tf.keras.layers.InputLayer)):
+        return model
+
+    def clone(layer):
+        if isinstance(layer, RecomputeGrad):
+            return RecomputeGrad(cast_model(layer.block, policy), name=layer.name)
+        config = layer.get_config()
+        config["dtype"] = layer_policy(layer)
+        return layer.__class__.from_config(config)
+
+    cast = tf.keras.models.clone_model(model, clone_function=clone)
+    cast.set_weights(model.get_weights())
+    return cast
+
+
+def supports_jit_compile(model):
+    """
+    Returns whether the forward pass of a model can be compiled with XLA as a whole. The lanczos5 Resizing layers of
+    models built with multi_input have no XLA kernel.
+
+    :param model: Keras model
+    :return: True if the model compiles with XLA
+    """
+    function = tf.function(lambda x: model(x, training=False), jit_compile=True)
+    try:
+        shape = [size or frame_multiple(model) for size in model.inputs[0].shape[1:]]
+        function.experimental_get_compiler_ir(tf.zeros([1] + shape))(stage="hlo")
+    except (ValueError, tf.errors.InvalidArgumentError):
+        return False
+    return True
+
+
+def jit_compile_mode(model, jit_compile=True):
+    """
+    Returns how a model is compiled with XLA. Models that cannot be compiled with XLA as a whole fall back to XLA
+    auto-clustering, which compiles the supported clusters of ops and leaves the rest to TensorFlow. Auto-clustering is
+    a global setting, the caller enables it with ``tf.config.optimizer.set_jit("autoclustering")``.
+
+    :param model: Keras model
+    :param jit_compile: Use XLA
+    :return: "xla" if the whole model is compiled with XLA (jit_compile=True in model.compile), "autoclustering" or
+    None without XLA
+    """
+    if not jit_compile:
+        return None
+    if supports_jit_compile(model):
+        return "xla"
+    return "autoclustering"
+
+
 def get_architecture_from_model(model):
     """
     Extracts the architecture of a model and returns it as a dictionary.
     :param model: tensorflow model
     :return: dictionary with the architecture
     """
+    encoder, decoder = {}, {}
+    for layer in _flatten_layers(model):
+        match = re.fullmatch(r"([ed])block(\d+)_(\w+)", layer.name)
+        if match is None:
+            continue
+        blocks = encoder if match.group(1) == "e" else decoder
+        block = blocks.setdefault(int(match.group(2)), {"dropout": 0, "pool": False})
+        part = match.group(3)
+        if part == "conv1":
+            block["filters"] = layer.filters
+        elif isinstance(layer, tf.keras.layers.Activation) and part.endswith("1"):
+            # the convolutions are linear, the activation of the block is a separate layer named after it
+            block["activation"] = part[:-1]
+        elif part == "dropout":
+            block["dropout"] = layer.rate
+        elif part == "pool":
+            block["pool"] = True
+    # decoder blocks are numbered from the output, the architecture lists them from the bottleneck
+    encoder = [encoder[i] for i in sorted(encoder)]
+    decoder = [decoder[i] for i in sorted(decoder, reverse=True)]
     architecture = {
-        "downFilters": [],
-        "downActivation": [],
-        "downDropout": [],
-        "downMaxPool": [],
-        "upFilters": [],
-        "upActivation": [],
-        "upDropout": [], }
-    for layer in model.layers:
-        if ("block" in layer.name.lower()) and ("conv1" in layer.name.lower()):
-            if layer.name.lower()[0] == "e":
-                architecture["downFilters"].append(layer.filters)
-                architecture["downActivation"].append(layer.activation.__name__)
-            elif layer.name.lower()[0] == "d":
-                architecture["upFilters"].append(layer.filters)
-                architecture["upActivation"].append(layer.activation.__name__)
-        elif ("block" in layer.name.lower()) and ("drop" in layer.name.lower()):
-            if layer.name.lower()[0] == "e":
-                architecture["downDropout"].append(layer.rate)
-            elif layer.name.lower()[0] == "d":
-                architecture["upDropout"].append(layer.rate)
-        elif ("eblock" in layer.name.lower()) and ("pool" in layer.name.lower()):
-            current_layer = int(layer.name.lower()[6])
-            if len(architecture["downMaxPool"]) < current_layer:
-                for i in range(current_layer - len(architecture["downMaxPool"])):
-                    architecture["downMaxPool"].append(False)
-            architecture["downMaxPool"].append(True)
+        "downFilters": [block["filters"] for block in encoder],
+        "downActivation": [block["activation"] for block in encoder],
+        "downDropout": [block["dropout"] for block in encoder],
+        "downMaxPool": [block["pool"] for block in encoder],
+        "upFilters": [block["filters"] for block in decoder],
+        "upActivation": [block["activation"] for block in decoder],
+        "upDropout": [block["dropout"] for block in decoder], }
     return architecture
 
 
+def frame_multiple(model):
+    """
+    Returns the number of which the sides of the inputs of a U-Net must be a multiple, 2 to the number of its max
+    pooling layers.
+
+    :param model: U-Net model
+    :return: Multiple of the input sides
+    """
+    return 2 ** sum(isinstance(layer, tf.keras.layers.MaxPooling2D) for layer in _flatten_layers(model))
+
+
+def full_frame_model(model):
+    """
+    Rebuilds a trained U-Net with inputs of any spatial shape and copies its weights, so that a whole detector frame
+    (padded to a multiple of frame_multiple) is predicted in one call instead of tile by tile. The channel attention
+    modules pool over the whole input, so the predictions differ slightly from those of the tiles the model was
+    trained on.
+
+    :param model: U-Net model built by unet_model
+    :return: Fully convolutional model with the weights of model
+    """
+    return _rebuild_unet(model, (None, None) + tuple(model.inputs[0].shape[3:]))
+
+
+def _rebuild_unet(model, input_size, checkpoint_blocks=()):
+    """
+    Builds a U-Net with the architecture of model and the given input size and copies the weights of model.
+    """
+    layers = list(_flatten_layers(model))
+    kernel_size = next(layer for layer in layers if layer.name == "eblock0_conv1").kernel_size[0]
+    multi_input = any(isinstance(layer, (tf.keras.layers.Resizing, ResizeToMatch)) for layer in layers)
+    rebuilt = unet_model(input_size, get_architecture_from_model(model), kernel_size=kernel_size,
+                         multi_input=multi_input, checkpoint_blocks=checkpoint_blocks)
+    if len(rebuilt.weights) != len(model.weights):
+        # the model was exported by inference_model, its batch normalizations are folded
+        rebuilt = inference_model(rebuilt)
+    rebuilt.set_weights(model.get_weights())
+    return rebuilt
+
+
+def _replace_attention_lambdas(config):
+    """
+    Replaces the Lambda layers of the spatial attention in a saved model configuration by ChannelPool layers, also in
+    the configurations of nested blocks. The mean is the first input of the Concatenate layer following the Lambda
+    layers and the maximum the second.
+
+    :param config: Model configuration read from config.json of a .keras file, modified in place
+    :return: Whether any Lambda layer was replaced
+    """
+    replaced = False
+    if isinstance(config, list):
+        for item in config:
+            replaced = _replace_attention_lambdas(item) or replaced
+        return replaced
+    if not isinstance(config, dict):
+        return False
+    layers = config.get("layers")
+    if isinstance(layers, list):
+        reductions = {}
+        for layer in layers:
+            if layer.get("class_name") == "Concatenate" and layer.get("inbound_nodes"):
+                for tensor, reduction in zip(layer["inbound_nodes"][0]["args"][0], ("mean", "max")):
+                    reductions[tensor["config"]["keras_history"][0]] = reduction
+        for layer in layers:
+            if layer.get("class_name") != "Lambda":
+                continue
+            if layer["name"] not in reductions:
+                raise ValueError("Lambda layer {} is not part of a spatial attention".format(layer["name"]))
+            layer.update({"module": "tools.attention_module", "class_name": "ChannelPool",
+                          "registered_name": "tools>ChannelPool"})
+            layer["config"] = {"name": layer["config"]["name"], "trainable": layer["config"]["trainable"],
+                               "dtype": layer["config"]["dtype"], "reduction": reductions[layer["name"]]}
+            for node in layer.get("inbound_nodes", []):
+                node.get("kwargs", {}).pop("mask", None)
+            replaced = True
+    for value in config.values():
+        replaced = _replace_attention_lambdas(value) or replaced
+    return replaced
+
+
+def load_model(model_path):
+    """
+    Loads a model saved by this package, without compiling it. Models saved before the attention modules were Keras
+    layers contain Lambda layers, which cannot be deserialized in safe mode. They are loaded with their Lambda layers
+    replaced by ChannelPool layers and migrated to a U-Net built with the current attention layers, save the returned
+    model to complete the migration.
+
+    :param model_path: Path to the .keras model
+    :return: Model
+    """
+    with zipfile.ZipFile(model_path) as archive:
+        config = json.loads(archive.read("config.json"))
+        if not _replace_attention_lambdas(config):
+            return tf.keras.models.load_model(model_path, compile=False)
+        legacy = tf.keras.models.model_from_json(json.dumps(config))
+        with tempfile.TemporaryDirectory() as directory:
+            legacy.load_weights(archive.extract("model.weights.h5", directory))
+    checkpoint_blocks = [layer.block.name for layer in legacy.layers if isinstance(layer, RecomputeGrad)]
+    return _rebuild_unet(legacy, tuple(legacy.inputs[0].shape[1:]), checkpoint_blocks=checkpoint_blocks)
+
+
+def _folded_batch_normalizations(model):
+    """
+    Returns the BatchNormalization layers of a model that can be folded into the preceding convolution, by name of
+    the convolution. The convolution must be linear and feed only the BatchNormalization layer.
+    """
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, tf.keras.layers.BatchNormalization) \
+                or layer.axis not in (-1, len(layer.input.shape) - 1):
+            continue
+        source = layer.input._keras_history.operation
+        if isinstance(source, (tf.keras.layers.Conv2D, tf.keras.layers.Conv2DTranspose)) \
+                and source.get_config()["activation"] == "linear" and len(source._outbound_nodes) == 1:
+            folds[source.name] = layer
+    return folds
+
+
+def _fold_weights(conv, batch_normalization):
+    """
+    Returns the kernel and bias of a convolution followed by a BatchNormalization layer in inference mode.
+    """
+    def weight(variable):
+        # folded in float64 and rounded once to the dtype of the variables
+        return np.asarray(variable, dtype=np.float64)
+
+    mean, variance = weight(batch_normalization.moving_mean), weight(batch_normalization.moving_variance)
+    gamma = weight(batch_normalization.gamma) if batch_normalization.scale else np.ones_like(mean)
+    beta = weight(batch_normalization.beta) if batch_normalization.center else np.zeros_like(mean)
+    scale = gamma / np.sqrt(variance + batch_normalization.epsilon)
+    kernel = weight(conv.kernel)
+    bias = weight(conv.bias) if conv.use_bias else np.zeros_like(mean)
+    # the output channels are the last axis of a Conv2D kernel and the one before the last of a Conv2DTranspose kernel
+    if isinstance(conv, tf.keras.layers.Conv2DTranspose):
+        kernel = kernel * scale[:, np.newaxis]
+    else:
+        kernel = kernel * scale
+    dtype = conv.kernel.dtype
+    return [kernel.astype(dtype), ((bias - mean) * scale + beta).astype(dtype)]
+
+
+def inference_model(model):
+    """
+    Returns an inference-only copy of a model: the BatchNormalization layers following a convolution are folded into
+    its kernel and bias and the Dropout layers are removed. The input_normalisation layer and the normalisations of the
+    resized inputs are kept, folding them into the next convolution is not exact at the zero padded borders. The copy
+    is not compiled, so it is saved without the optimizer state. The model is returned unchanged if it has nothing to
+    fold or remove.
+
+    :param model: Keras model
+    :return: Model predicting the same as model in inference mode
+    """
+    folds = _folded_batch_normalizations(model)
+    removed = {layer.name for layer in folds.values()}
+    removed.update(layer.name for layer in model.layers if isinstance(layer, tf.keras.layers.Dropout))
+    if not removed and not any(isinstance(layer, RecomputeGrad) for layer in model.layers):
+        return model
+
+    def clone(layer):
+        if isinstance(layer, RecomputeGrad):
+            return RecomputeGrad(inference_model(layer.block), name=layer.name)
+        config = layer.get_config()
+        if layer.name in folds:
+            config["use_bias"] = True
+        return layer.__class__.from_config(config)
+
+    def call(layer, *args, **kwargs):
+        if layer.name in removed:
+            return args[0]
+        return layer(*args, **kwargs)
+
+    folded = tf.keras.models.clone_model(model, clone_function=clone, call_function=call)
+    layers = {layer.name: layer for layer in model.layers}
+    for layer in folded.layers:
+        if isinstance(layer, RecomputeGrad) or not layer.weights:
+            continue
+        if layer.name in folds:
+            layer.set_weights(_fold_weights(layers[layer.name], folds[layer.name]))
+        else:
+            layer.set_weights(layers[layer.name].get_weights())
+    return folded
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class RecomputeGrad(tf.keras.layers.Layer):
+    """
+    Runs a block (a Keras model) without storing its intermediate activations for the backward pass, they are
+    recomputed from the block inputs when the gradients are computed (``tf.recompute_grad``). Trades one extra forward
+    pass of the block for the activation memory of its layers.
+
+    Blocks must not contain random layers (e.g. Dropout), the recomputation would draw different random numbers.
+    The moving statistics of the BatchNormalization layers of the block are updated once per step: the recomputation
+    restores the values they had before it.
+
+    :param block: Keras model of the block
+    """
+
+    def __init__(self, block, **kwargs):
+        kwargs.setdefault("name", block.name + "_recompute")
+        super().__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        moving_statistics = [variable for layer in self.block.layers
+                             if isinstance(layer, tf.keras.layers.BatchNormalization)
+                             for variable in (layer.moving_mean, layer.moving_variance)]
+        # the first call of forward computes the outputs, the second one recomputes them for the gradients
+        calls = []
+
+        @tf.recompute_grad
+        def forward(*block_inputs):
+            recomputing = len(calls) > 0
+            calls.append(None)
+            if recomputing:
+                statistics = [tf.identity(variable) for variable in moving_statistics]
+            outputs = self.block(list(block_inputs) if len(block_inputs) > 1 else block_inputs[0], training=training)
+            if recomputing and moving_statistics:
+                with tf.control_dependencies(tf.nest.flatten(outputs)):
+                    restored = [variable.assign(value) for variable, value in zip(moving_statistics, statistics)]
+                with tf.control_dependencies(restored):
+                    outputs = tf.nest.map_structure(tf.identity, outputs)
+            return outputs
+
+        if isinstance(inputs, (list, tuple)):
+            return forward(*inputs)
+        return forward(inputs)
+
+    def compute_output_spec(self, inputs, training=None):
+        return self.block.compute_output_spec(inputs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["block"] = tf.keras.utils.serialize_keras_object(self.block)
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config["block"] = tf.keras.utils.deserialize_keras_object(config["block"])
+        return cls(**config)
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class AccumulatingModel(tf.keras.Model):
+    """
+    Functional model whose training step splits every batch into accumulate_steps equal micro-batches, sums their
+    gradients and applies the optimizer once per batch. Only the activations of one micro-batch are alive at a time,
+    so the effective batch size grows without a proportional growth of the peak memory.
+
+    BatchNormalization layers normalise with the statistics of each micro-batch and update their moving statistics
+    once per micro-batch, the loss and the metrics are accumulated over all micro-batches. The Focal-Tversky loss is
+    computed over all pixels of a batch, with accumulation it is the mean of the micro-batch losses instead. The
+    training and validation losses are tracked by the loss_tracker metric, which takes the place of the loss tracker
+    of the compiled model in the logs.
+
+    :param accumulate_steps: Number of micro-batches, the batch size must be a multiple of it
+    """
+
+    def __init__(self, *args, accumulate_steps=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accumulate_steps = accumulate_steps
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        # (accumulate_steps, micro batch size, ...), so that slicing a micro-batch keeps static shapes
+        micro_batches = tf.nest.map_structure(
+            lambda t: None if t is None else tf.reshape(t, tf.concat([[self.accumulate_steps, -1],
+                                                                       tf.shape(t)[1:]], axis=0)),
+            (x, y, sample_weight))
+        trainable_weights = self.trainable_weights
+        num_replicas = tf.distribute.get_strategy().num_replicas_in_sync
+
+        def micro_step(i, gradients):
+            x_micro, y_micro, weight_micro = tf.nest.map_structure(lambda t: None if t is None else t[i],
+                                                                   micro_batches)
+            with tf.GradientTape() as tape:
+                y_pred = self(x_micro, training=True)
+                loss = self.compute_loss(x_micro, y_micro, y_pred, weight_micro, training=True)
+                self.loss_tracker.update_state(loss * num_replicas,
+                                                sample_weight=tf.shape(tf.nest.flatten(x_micro)[0])[0])
+                loss = self.optimizer.scale_loss(loss) / self.accumulate_steps
+            micro_gradients = tape.gradient(loss, trainable_weights)
+            self.compute_metrics(x_micro, y_micro, y_pred, sample_weight=weight_micro)
+            # some gradients lose their static shape, the loop needs it back
+            return i + 1, [g if mg is None else g + tf.reshape(mg, g.shape)
+                           for g, mg in zip(gradients, micro_gradients)]
+
+        # one micro-batch after the other, a parallel loop would keep the activations of several of them alive
+        _, gradients = tf.while_loop(lambda i, gradients: i < self.accumulate_steps, micro_step,
+                                     (tf.constant(0), [tf.zeros(w.shape, w.dtype) for w in trainable_weights]),
+                                     parallel_iterations=1)
+        self.optimizer.apply_gradients(zip(gradients, trainable_weights))
+        return self.get_metrics_result()
+
+    def test_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        y_pred = self(x, training=False)
+        loss = self.compute_loss(x, y, y_pred, sample_weight, training=False)
+        self.loss_tracker.update_state(loss * tf.distribute.get_strategy().num_replicas_in_sync,
+                                       sample_weight=tf.shape(tf.nest.flatten(x)[0])[0])
+        self.compute_metrics(x, y, y_pred, sample_weight=sample_weight)
+        return self.get_metrics_result()
+
+    def get_config(self):
+        config = super().get_config()
+        config["accumulate_steps"] = self.accumulate_steps
+        return config
+
+
+def accumulating_model(model, accumulate_steps):
+    """
+    Wraps the graph of a functional model into an AccumulatingModel sharing its layers and weights.
+
+    :param model: Functional Keras model
+    :param accumulate_steps: Number of micro-batches every training batch is split into
+    :return: AccumulatingModel, the model itself if accumulate_steps is 1
+    """
+    if accumulate_steps <= 1:
+        return model
+    return AccumulatingModel(inputs=model.inputs, outputs=model.outputs, name=model.name,
+                             accumulate_steps=accumulate_steps)
+
+
+@tf.keras.utils.register_keras_serializable(package="tools")
+class ResizeToMatch(tf.keras.layers.Layer):
+    """
+    Resizes images to the spatial shape of a reference tensor, the counterpart of the Resizing layer for inputs whose
+    shape is only known when the model is called.
+
+    :param interpolation: Interpolation method of tf.image.resize
+    """
+
+    def __init__(self, interpolation="bilinear", **kwargs):
+        super().__init__(**kwargs)
+        self.interpolation = interpolation
+
+    def call(self, inputs):
+        images, reference = inputs
+        return tf.cast(tf.image.resize(images, tf.shape(reference)[1:3], method=self.interpolation),
+                       self.compute_dtype)
+
+    def compute_output_shape(self, input_shape):
+        images_shape, reference_shape = input_shape
+        return tuple(images_shape[:1]) + tuple(reference_shape[1:3]) + tuple(images_shape[3:])
+
+    def get_config(self):
+        config = super().get_config()
+        config["interpolation"] = self.interpolation
+        return config
+
+
 def attention_gate(g, s, num_filters, kernel_size=1, name=""):
     wg = tf.keras.layers.Conv2D(num_filters, kernel_size, padding="same", name="attention" + name + "_sconv")(g)
     wg = tf.keras.layers.BatchNormalization(name="attention" + name + "_snorm")(wg)
@@ -222,7 +991,52 @@ def decoder_mini_block(prev_layer_input, skip_layer_input=None, n_filters=32, ke
     return conv
 
 
-def unet_model(input_size, arhitecture, kernel_size=3, multi_input=True):
+def checkpointed_encoder_block(inputs, n_filters=32, kernel_size=3, activation="relu", dropout_prob=0.3,
+                               max_pooling=True, attention=True, name=""):
+    """
+    Encoder mini block whose convolutions and attention are recomputed in the backward pass (see RecomputeGrad), the
+    dropout and max pooling layers stay outside of the recomputed part. Takes the same arguments as encoder_mini_block.
+
+    :return: The output tensor of the block and the skip connection tensor
+    """
+    block_input = tf.keras.layers.Input(inputs.shape[1:], name="eblock" + name + "_input")
+    conv, _ = encoder_mini_block(block_input, n_filters=n_filters, kernel_size=kernel_size, activation=activation,
+                                 dropout_prob=0, max_pooling=False, attention=attention, name=name)
+    conv = RecomputeGrad(tf.keras.Model(block_input, conv, name="eblock" + name))(inputs)
+    if dropout_prob > 0:
+        conv = tf.keras.layers.Dropout(dropout_prob, name="eblock" + name + "_dropout")(conv)
+    if max_pooling:
+        next_layer = tf.keras.layers.MaxPooling2D(pool_size=(2, 2), name="eblock" + name + "_pool")(conv)
+    else:
+        next_layer = conv
+    return next_layer, conv
+
+
+def checkpointed_decoder_block(prev_layer_input, skip_layer_input=None, n_filters=32, kernel_size=3,
+                               activation="relu", dropout_prob=0.3, max_pooling=True, attention=True, name=""):
+    """
+    Decoder mini block whose layers are recomputed in the backward pass (see RecomputeGrad), the dropout layer stays
+    outside of the recomputed part. Takes the same arguments as decoder_mini_block.
+
+    :return: The output tensor of the block
+    """
+    block_inputs = [tf.keras.layers.Input(prev_layer_input.shape[1:], name="dblock" + name + "_input")]
+    if skip_layer_input is not None:
+        block_inputs.append(tf.keras.layers.Input(skip_layer_input.shape[1:], name="dblock" + name + "_skip"))
+    conv = decoder_mini_block(block_inputs[0], block_inputs[1] if skip_layer_input is not None else None,
+                              n_filters=n_filters, kernel_size=kernel_size, activation=activation, dropout_prob=0,
+                              max_pooling=max_pooling, attention=attention, name=name)
+    block = RecomputeGrad(tf.keras.Model(block_inputs, conv, name="dblock" + name))
+    if skip_layer_input is not None:
+        conv = block([prev_layer_input, skip_layer_input])
+    else:
+        conv = block(prev_layer_input)
+    if dropout_prob > 0:
+        conv = tf.keras.layers.Dropout(dropout_prob, name="dblock" + name + "_dropout")(conv)
+    return conv
+
+
+def unet_model(input_size, arhitecture, kernel_size=3, multi_input=True, checkpoint_blocks=()):
     """
     U-Net model for semantic segmentation. The model consists of an encoder and a decoder. The encoder downsamples the
     input image and extracts features. The decoder upsamples the features and generates the segmentation mask. Skip
@@ -230,10 +1044,15 @@ def unet_model(input_size, arhitecture, kernel_size=3, multi_input=True):
     architecture dictionary that contains the number of filters, activation functions, dropout probabilities, and max
     pooling for each mini block.
 
-    :param input_size: Size of the input image
+    :param input_size: Size of the input image, (None, None, channels) for inputs of any size
     :param arhitecture: Dictionary containing the architecture of the U-Net model
+    :param checkpoint_blocks: Names of the mini blocks (e.g. "eblock5", "dblock0") whose activations are recomputed in
+    the backward pass instead of stored (gradient checkpointing), "all" for every block
     :return: U-Net model
     """
+    def checkpointed(block_name):
+        return checkpoint_blocks == "all" or block_name in checkpoint_blocks
+
     inputs = tf.keras.layers.Input(input_size, name="input")
     layer = tf.keras.layers.BatchNormalization(name="input_normalisation")(inputs)
     #layer = inputs
@@ -242,17 +1061,21 @@ def unet_model(input_size, arhitecture, kernel_size=3, multi_input=True):
     # Encoder
     for i in range(len(arhitecture["downFilters"])):
         if multi_input and i != 0 and i != len(arhitecture["downFilters"])-1:
-            down_input = tf.keras.layers.Resizing(layer.shape[1], layer.shape[2], interpolation="lanczos5")(inputs)
+            if layer.shape[1] is None or layer.shape[2] is None:
+                down_input = ResizeToMatch(interpolation="lanczos5")([inputs, layer])
+            else:
+                down_input = tf.keras.layers.Resizing(layer.shape[1], layer.shape[2], interpolation="lanczos5")(inputs)
             down_input = tf.keras.layers.BatchNormalization()(down_input)
             layer = tf.keras.layers.concatenate([down_input, layer])
-        layer, skip = encoder_mini_block(layer,
-                                         kernel_size=kernel_size,
-                                         n_filters=arhitecture["downFilters"][i],
-                                         activation=arhitecture["downActivation"][i],
-                                         dropout_prob=arhitecture["downDropout"][i],
-                                         max_pooling=arhitecture["downMaxPool"][i],
-                                         attention=False if i == 0 else True,
-                                         name=str(i))
+        encoder_block = checkpointed_encoder_block if checkpointed("eblock" + str(i)) else encoder_mini_block
+        layer, skip = encoder_block(layer,
+                                    kernel_size=kernel_size,
+                                    n_filters=arhitecture["downFilters"][i],
+                                    activation=arhitecture["downActivation"][i],
+                                    dropout_prob=arhitecture["downDropout"][i],
+                                    max_pooling=arhitecture["downMaxPool"][i],
+                                    attention=False if i == 0 else True,
+                                    name=str(i))
         if i != len(arhitecture["downFilters"])-1:
             skip_connections.append(skip)
         else:
@@ -261,23 +1084,60 @@ def unet_model(input_size, arhitecture, kernel_size=3, multi_input=True):
     # Decoder
     for i in range(len(arhitecture["upFilters"])):
         skip_con = skip_connections[len(skip_connections) - 1 - i]
-        layer = decoder_mini_block(layer,
-                                   skip_con,
-                                   kernel_size=kernel_size,
-                                   n_filters=arhitecture["upFilters"][i],
-                                   activation=arhitecture["upActivation"][i],
-                                   attention=True,
-                                   dropout_prob=arhitecture["upDropout"][i],
-                                   max_pooling=arhitecture["downMaxPool"][len(arhitecture["downMaxPool"]) - 1 - i],
-                                   name=str(len(arhitecture["upFilters"]) - 1 - i))
+        block_name = str(len(arhitecture["upFilters"]) - 1 - i)
+        decoder_block = checkpointed_decoder_block if checkpointed("dblock" + block_name) else decoder_mini_block
+        layer = decoder_block(layer,
+                              skip_con,
+                              kernel_size=kernel_size,
+                              n_filters=arhitecture["upFilters"][i],
+                              activation=arhitecture["upActivation"][i],
+                              attention=True,
+                              dropout_prob=arhitecture["upDropout"][i],
+                              max_pooling=arhitecture["downMaxPool"][len(arhitecture["downMaxPool"]) - 1 - i],
+                              name=block_name)
 
     outputs = tf.keras.layers.Conv2D(1, kernel_size, padding='same', name="output_conv")(layer)
     #outputs = tf.keras.layers.LayerNormalization(name="output_norm")(outputs)
-    outputs = tf.keras.layers.Activation(activation="sigmoid", name="output_sigmoid")(outputs)
+    outputs = tf.keras.layers.Activation(activation="sigmoid", dtype="float32", name="output_sigmoid")(outputs)
     model = tf.keras.Model(inputs=[inputs], outputs=[outputs], name="AsteroidNET")
     return model
 
 
+
+def tile_gate_model(input_size, filters=(8, 16, 32, 32), kernel_size=3):
+    """
+    Lightweight tile classifier that predicts whether a tile may contain a trail, used as a gate in front of the U-Net
+    so that the tiles without trails are not segmented (see evals.eval_tools.tiled_prediction). A few strided
+    convolutions reduce the tile and a global max pooling keeps the strongest response anywhere in it.
+
+    :param input_size: Size of the input tile
+    :param filters: Number of filters of every strided convolution
+    :param kernel_size: Size of the kernel
+    :return: Gate model with one sigmoid output per tile
+    """
+    inputs = tf.keras.layers.Input(input_size, name="input")
+    layer = tf.keras.layers.BatchNormalization(name="input_normalisation")(inputs)
+    for i, n_filters in enumerate(filters):
+        layer = tf.keras.layers.Conv2D(n_filters, kernel_size, strides=2, padding="same",
+                                       kernel_initializer='HeNormal', name="gate_conv" + str(i))(layer)
+        layer = tf.keras.layers.BatchNormalization(name="gate_norm" + str(i))(layer)
+        layer = tf.keras.layers.Activation(activation="relu", name="gate_relu" + str(i))(layer)
+    layer = tf.keras.layers.GlobalMaxPooling2D(name="gate_pool")(layer)
+    outputs = tf.keras.layers.Dense(1, activation="sigmoid", dtype="float32", name="gate_output")(layer)
+    return tf.keras.Model(inputs=[inputs], outputs=[outputs], name="TileGate")
+
+
+def gate_calibration_path(gate_path):
+    """
+    Returns the path of the JSON file with the validation scores used to choose the threshold of a tile gate.
+
+    :param gate_path: Path of the gate model
+    :return: Path of the calibration file
+    """
+    if gate_path.endswith(".keras"):
+        gate_path = gate_path[:-len(".keras")]
+    return gate_path + "_calibration.json"
+
 if __name__ == "__main__":
     import json
     with open("../arhitecture_tuned.json") as f:
@@ -0,0 +1,193 @@
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class StepProfiler(tf.keras.callbacks.Callback):
+    """
+    Records the wall time of every training step and captures a TensorFlow profiler trace of a window of steps, which
+    can be opened in the profile tab of TensorBoard. Keras reads the next batch inside the compiled training function,
+    so the step time includes the time spent waiting for the input pipeline.
+
+    :param log_dir: Directory of the profiler trace (no trace is captured if empty)
+    :param profile_steps: First and last step (counted from 1, inclusive) of the traced window
+
+    The index in step_times of the first step of every epoch is recorded in epoch_starts.
+    """
+
+    def __init__(self, log_dir="", profile_steps=(10, 20)):
+        super().__init__()
+        self.log_dir = log_dir
+        self.profile_steps = tuple(profile_steps)
+        self.step_times = []
+        self.epoch_starts = []
+        self._steps = 0
+        self._tracing = False
+        self._trace = None
+        self._begin = 0
+        self._start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_starts.append(len(self.step_times))
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._begin = batch
+        if self.log_dir and not self._tracing and self.profile_steps[0] <= self._steps + 1 <= self.profile_steps[1]:
+            tf.profiler.experimental.start(self.log_dir)
+            self._tracing = True
+        if self._tracing:
+            # marks the step boundaries for the step time and input pipeline analysis of the TensorBoard profiler
+            self._trace = tf.profiler.experimental.Trace("train", step_num=self._steps + 1, _r=1)
+            self._trace.__enter__()
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if logs and "loss" in logs:
+            # waits for the step to finish on devices that run asynchronously
+            float(logs["loss"])
+        elapsed = time.perf_counter() - self._start
+        # with steps_per_execution > 1 one call runs several steps
+        n_steps = batch - self._begin + 1
+        self.step_times += [elapsed / n_steps] * n_steps
+        self._steps += n_steps
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace = None
+        if self._tracing and self._steps >= self.profile_steps[1]:
+            self._stop_trace()
+
+    def on_train_end(self, logs=None):
+        self._stop_trace()
+
+    def _stop_trace(self):
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+
+
+def time_dataset(dataset, steps=50, warmup=1):
+    """
+    Returns the latency of every batch produced by a dataset iterated on its own, without the model. The first warmup
+    batches, which include filling the shuffle and prefetch buffers, are not timed.
+
+    :param dataset: Batched dataset
+    :param steps: Number of timed batches
+    :param warmup: Number of batches read before timing
+    :return: Array of batch latencies in seconds
+    """
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+    latencies = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        next(iterator)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def time_train_steps(model, batch, steps=20, warmup=2):
+    """
+    Returns the time of training steps on one batch repeated from memory, i.e. the step time of the model without
+    waiting for the input pipeline. The weights of the model and the state of its optimizer are restored after the
+    timed steps, so the model is left as it was trained.
+
+    :param model: Compiled model
+    :param batch: One batch of (x, y)
+    :param steps: Number of timed steps
+    :param warmup: Number of steps run before timing (retracing for the fixed batch shape)
+    :return: Array of step times in seconds
+    """
+    profiler = StepProfiler()
+    variables = list(model.weights) + list(model.optimizer.variables)
+    values = [variable.numpy() for variable in variables]
+    try:
+        model.fit(tf.data.Dataset.from_tensors(batch).repeat(), epochs=1, steps_per_epoch=steps + warmup,
+                  callbacks=[profiler], verbose=0)
+    finally:
+        for variable, value in zip(variables, values):
+            variable.assign(value)
+    return np.array(profiler.step_times[warmup:])
+
+
+def bottleneck_report(step_times, compute_times, stage_latencies=None, warmup=1, threshold=0.1, epoch_starts=None):
+    """
+    Summarises the step times of a training run. The input wait of a step is the part of its time above the median
+    time of a step on a batch held in memory, the run is input-bound if the median step waits for the input for more
+    than threshold of the median step time. The first steps of every epoch, which also create the iterator and fill
+    the shuffle buffer, are excluded. The stage latencies are the batch latencies of the input pipeline cut after each
+    stage, the stage adding the most latency is reported as the slowest stage.
+
+    :param step_times: Times of the training steps (StepProfiler.step_times)
+    :param compute_times: Times of training steps without input (time_train_steps)
+    :param stage_latencies: Dictionary of batch latencies (time_dataset) of the pipeline up to each stage, in pipeline
+    order (Optional)
+    :param warmup: Number of first steps of every epoch excluded (tracing, compilation and filling the buffers)
+    :param threshold: Fraction of the step time spent waiting for the input above which the run is input-bound
+    :param epoch_starts: Index of the first step of every epoch (StepProfiler.epoch_starts), the steps are one epoch
+    if not given
+    :return: Dictionary of the summary
+    """
+    step_times = np.asarray(step_times, dtype=np.float64)
+    excluded = np.zeros(len(step_times), dtype=bool)
+    for start in (epoch_starts or [0]):
+        excluded[start:start + warmup] = True
+    if not excluded.all():
+        step_times = step_times[~excluded]
+    compute_time = float(np.median(compute_times))
+    input_wait = np.maximum(step_times - compute_time, 0)
+    input_wait_fraction = float(input_wait.sum() / max(step_times.sum(), 1e-12))
+    report = {"steps": int(len(step_times)),
+              "step_time_median": float(np.median(step_times)),
+              "step_time_p90": float(np.percentile(step_times, 90)),
+              "compute_time_median": compute_time,
+              "input_wait_median": float(np.median(input_wait)),
+              "input_wait_fraction": input_wait_fraction,
+              "input_bound": float(np.median(input_wait)) > threshold * float(np.median(step_times)),
+              "step_times": step_times.tolist(),
+              "input_wait": input_wait.tolist()}
+    if stage_latencies:
+        medians = {name: float(np.median(latencies)) for name, latencies in stage_latencies.items()}
+        added = np.diff([0.] + list(medians.values()))
+        report["stage_latency_median"] = medians
+        report["slowest_stage"] = list(medians.keys())[int(np.argmax(added))]
+    return report
+
+
+def format_report(report):
+    """
+    Formats the summary returned by bottleneck_report as short text.
+
+    :param report: Dictionary returned by bottleneck_report
+    :return: Text of the summary
+    """
+    lines = ["Steps: {}, median step time {:.4f} s (p90 {:.4f} s), median compute time {:.4f} s".format(
+                 report["steps"], report["step_time_median"], report["step_time_p90"], report["compute_time_median"]),
+             "Waiting for input: {:.1%} of the step time, median {:.4f} s per step -> {}".format(
+                 report["input_wait_fraction"], report["input_wait_median"],
+                 "input-bound" if report["input_bound"] else "compute-bound")]
+    if "stage_latency_median" in report:
+        lines.append("tf.data median batch latency up to each stage: " + ", ".join(
+            "{} {:.4f} s".format(name, latency) for name, latency in report["stage_latency_median"].items()))
+        lines.append("Slowest stage: " + report["slowest_stage"])
+    return "\n".join(lines)
+
+
+def write_report(report, directory, name="profile_summary"):
+    """
+    Writes the summary returned by bottleneck_report as JSON and text files to a directory.
+
+    :param report: Dictionary returned by bottleneck_report
+    :param directory: Output directory
+    :param name: Name of the files without extension
+    :return: Text of the summary
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name + ".json"), "w") as f:
+        json.dump(report, f, indent=2)
+    text = format_report(report)
+    with open(os.path.join(directory, name + ".txt"), "w") as f:
+        f.write(text + "\n")
+    return text
@@ -0,0 +1,173 @@
+import numpy as np
+import tensorflow as tf
+import tools.data
+import tools.model
+
+try:
+    from ai_edge_litert.interpreter import Interpreter, OpResolverType
+except ImportError:
+    Interpreter, OpResolverType = tf.lite.Interpreter, tf.lite.experimental.OpResolverType
+
+QUANTIZATIONS = ("none", "dynamic", "int8")
+
+
+def _input_resizings(model):
+    """
+    Returns the Resizing layers that resize the input of a multi input U-Net to the size of the deeper blocks.
+    """
+    return [layer for layer in model.layers if isinstance(layer, tf.keras.layers.Resizing)]
+
+
+def representative_tiles(dataset_path, n_tiles=256, batch_size=256):
+    """
+    Returns the first tiles containing data (not only zeros from padding or NO_DATA) of a TFRecord dataset, used to
+    calibrate the ranges of the activations of a full integer model.
+
+    :param dataset_path: Path to the TFRecord dataset
+    :param n_tiles: Number of tiles
+    :param batch_size: Number of tiles parsed at once
+    :return: Array of tiles
+    """
+    schema = tools.data.get_dataset_schema(dataset_path)
+    dataset = tools.data.load_tfrecord_dataset(dataset_path, ordered=True).batch(batch_size).map(
+        tools.model.parse_function(img_shape=schema["shape"], test=True, schema=schema, batched=True),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    tiles = []
+    n = 0
+    for x in dataset:
+        x = x.numpy()
+        x = x[np.any(np.isfinite(x) & (x != 0), axis=(1, 2, 3))]
+        tiles.append(x)
+        n += len(x)
+        if n >= n_tiles:
+            break
+    if n == 0:
+        raise ValueError("No tiles with data in " + dataset_path)
+    return np.concatenate(tiles)[:n_tiles]
+
+
+def convert_model(model, quantization="dynamic", calibration_tiles=None):
+    """
+    Converts a tile model to a TensorFlow Lite flatbuffer. TensorFlow Lite has no lanczos5 resize, so the resized
+    inputs of the multi input U-Net are cut from the graph into additional inputs, computed by TFLiteModel before
+    invoking the interpreter.
+
+    :param model: Keras model with a fixed tile size, in float32
+    :param quantization: "none" keeps float32, "dynamic" stores the weights in int8 and quantizes the activations on
+    the fly, "int8" quantizes weights and activations with ranges calibrated on calibration_tiles
+    :param calibration_tiles: Array of tiles (see representative_tiles), required for "int8"
+    :return: Bytes of the TensorFlow Lite model
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Unknown quantization {}, expected one of {}".format(quantization, QUANTIZATIONS))
+    if None in model.inputs[0].shape[1:]:
+        raise ValueError("TensorFlow Lite export needs a model with a fixed tile size")
+    resizings = _input_resizings(model)
+    graph = tf.keras.Model([model.inputs[0]] + [layer.output for layer in resizings], model.outputs)
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(graph)
+    if quantization != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "int8":
+        if calibration_tiles is None:
+            raise ValueError("int8 quantization needs calibration tiles")
+
+        # the calibrator orders the inputs by signature name, not in the order of graph.inputs
+        names = [tensor.name for tensor in graph.inputs]
+
+        def representative_dataset():
+            for tile in calibration_tiles:
+                tile = tile[np.newaxis].astype(np.float32)
+                yield dict(zip(names, [tile] + [layer(tile).numpy() for layer in resizings]))
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+def export_model(model, path, quantization="dynamic", calibration_tiles=None):
+    """
+    Converts a model with convert_model and writes it to path.
+
+    :return: Size of the written model in bytes
+    """
+    flatbuffer = convert_model(model, quantization=quantization, calibration_tiles=calibration_tiles)
+    with open(path, "wb") as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+class TFLiteModel:
+    """
+    Runs a model exported by export_model on the CPU with a multi-threaded TensorFlow Lite interpreter. Models that
+    the XNNPACK delegate can not prepare (some full integer graphs) run with the builtin kernels instead.
+
+    :param model_path: Path to the .tflite model
+    :param num_threads: Number of interpreter threads (None uses all cores)
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.delegate = "XNNPACK"
+        self._interpreter = Interpreter(model_path, num_threads=num_threads)
+        self._batch_size = None
+        self._resize(1)
+        inputs = self._interpreter.get_input_details()
+        # the tile input is the largest one, the others are its lanczos5 resizes
+        inputs = sorted(inputs, key=lambda detail: -int(np.prod(detail["shape"][1:])))
+        self._input = inputs[0]["index"]
+        self._resized_inputs = [(detail["index"], tuple(detail["shape"][1:3])) for detail in inputs[1:]]
+        self.input_shape = (None,) + tuple(inputs[0]["shape"][1:])
+        self.output_shape = (None,) + tuple(self._interpreter.get_output_details()[0]["shape"][1:])
+
+    def _resize(self, batch_size):
+        if batch_size == self._batch_size:
+            return
+        for detail in self._interpreter.get_input_details():
+            self._interpreter.resize_tensor_input(detail["index"], [batch_size] + list(detail["shape"][1:]))
+        try:
+            self._interpreter.allocate_tensors()
+            self._interpreter.invoke()
+        except RuntimeError:
+            if self.delegate is None:
+                raise
+            self.delegate = None
+            resolver = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+            self._interpreter = Interpreter(self.model_path, num_threads=self.num_threads,
+                                            experimental_op_resolver_type=resolver)
+            self._batch_size = None
+            return self._resize(batch_size)
+        self._batch_size = batch_size
+
+    def predict_on_batch(self, x):
+        """
+        Predicts one batch of tiles.
+
+        :param x: Batch of tiles
+        :return: Array of predictions
+        """
+        x = np.asarray(x, dtype=np.float32)
+        self._resize(len(x))
+        self._interpreter.set_tensor(self._input, x)
+        for index, size in self._resized_inputs:
+            self._interpreter.set_tensor(index, tf.image.resize(x, size, method="lanczos5").numpy())
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._interpreter.get_output_details()[0]["index"]).copy()
+
+    def predict(self, dataset, verbose=0):
+        """
+        Predicts a dataset of batches of tiles.
+
+        :param dataset: Dataset of batches of tiles
+        :param verbose: Print the progress
+        :return: Array of predictions of all tiles
+        """
+        predictions = []
+        for i, x in enumerate(dataset):
+            predictions.append(self.predict_on_batch(x))
+            if verbose:
+                print("\rPredicted {} batches".format(i + 1), end="", flush=True)
+        if verbose:
+            print()
+        return np.concatenate(predictions)
@@ -0,0 +1,205 @@
+import numpy as np
+import tensorflow as tf
+
+
+class TileGrid:
+    """
+    Geometry of a grid of tiles covering a frame. Tiles are taken every stride pixels in row-major order, the frame is
+    padded with zeros at the bottom and on the right so that the last row and column of tiles fit. Tiles are strided
+    views of the frame and merging writes them directly into the output frame, so neither direction makes an
+    intermediate full-frame copy. If the frame is not a whole number of tiles, the tiles are copied once without
+    padding the frame first, only the last row and column of tiles are zero padded.
+
+    :param frame_shape: Shape (rows, columns) of the frame
+    :param tile_shape: Shape (rows, columns) of the tiles
+    :param stride: Offset (rows, columns) between neighbouring tiles (default is the tile shape, i.e. no overlap)
+    """
+
+    def __init__(self, frame_shape, tile_shape, stride=None):
+        self.frame_shape = tuple(int(s) for s in frame_shape[:2])
+        self.tile_shape = tuple(int(s) for s in tile_shape[:2])
+        self.stride = self.tile_shape if stride is None else tuple(int(s) for s in stride[:2])
+        if any(s <= 0 or s > t for s, t in zip(self.stride, self.tile_shape)):
+            raise ValueError("The stride must be positive and not larger than the tile shape")
+        self.grid_shape = tuple(max(int(np.ceil((f - t) / s)), 0) + 1
+                                for f, t, s in zip(self.frame_shape, self.tile_shape, self.stride))
+        self.padded_shape = tuple((g - 1) * s + t for g, s, t in zip(self.grid_shape, self.stride, self.tile_shape))
+        self.padding = tuple(p - f for p, f in zip(self.padded_shape, self.frame_shape))
+
+    def __len__(self):
+        return self.grid_shape[0] * self.grid_shape[1]
+
+    def __repr__(self):
+        return "TileGrid(frame_shape={}, tile_shape={}, stride={})".format(self.frame_shape, self.tile_shape,
+                                                                           self.stride)
+
+    @property
+    def overlapping(self):
+        return self.stride != self.tile_shape
+
+    def origins(self):
+        """
+        Returns the (row, column) of the top left pixel of every tile in the frame.
+
+        :return: Array of shape (len(self), 2)
+        """
+        rows, cols = np.meshgrid(np.arange(self.grid_shape[0]) * self.stride[0],
+                                 np.arange(self.grid_shape[1]) * self.stride[1], indexing="ij")
+        return np.stack([rows.ravel(), cols.ravel()], axis=1)
+
+    def pad(self, frame):
+        """
+        Pads a frame with zeros to the padded shape, keeping its dtype.
+
+        :param frame: Array of shape frame_shape (+ channels)
+        :return: Padded frame, the frame itself if it needs no padding
+        """
+        frame = np.asarray(frame)
+        if frame.shape[:2] != self.frame_shape:
+            raise ValueError("Frame of shape {} does not match {}".format(frame.shape[:2], self))
+        if self.padding == (0, 0):
+            return frame
+        padded = np.zeros(self.padded_shape + frame.shape[2:], dtype=frame.dtype)
+        padded[:self.frame_shape[0], :self.frame_shape[1]] = frame
+        return padded
+
+    def _strided_tiles(self, frame, grid_shape):
+        row_stride, col_stride = frame.strides[:2]
+        return np.lib.stride_tricks.as_strided(frame,
+                                               shape=grid_shape + self.tile_shape + frame.shape[2:],
+                                               strides=(row_stride * self.stride[0], col_stride * self.stride[1],
+                                                        row_stride, col_stride) + frame.strides[2:],
+                                               writeable=False)
+
+    def tiles(self, frame, dtype=None):
+        """
+        Returns the tiles of a frame as a read-only strided view, which shares memory with the frame. If the frame has
+        to be padded or the tiles cast, they are copied instead: the tiles lying inside the frame through one strided
+        view of it and only the last row and column of tiles are cropped and padded with zeros.
+
+        :param frame: Array of shape frame_shape (+ channels)
+        :param dtype: Dtype of the tiles (default is the dtype of the frame)
+        :return: Array of shape grid_shape + tile_shape (+ channels)
+        """
+        frame = np.asarray(frame)
+        if frame.shape[:2] != self.frame_shape:
+            raise ValueError("Frame of shape {} does not match {}".format(frame.shape[:2], self))
+        if self.padding == (0, 0):
+            tiles = self._strided_tiles(frame, self.grid_shape)
+            return tiles if dtype is None else tiles.astype(dtype)
+        tiles = np.empty(self.grid_shape + self.tile_shape + frame.shape[2:],
+                         dtype=frame.dtype if dtype is None else dtype)
+        full_rows, full_cols = (max((f - t) // s + 1, 0)
+                                for f, t, s in zip(self.frame_shape, self.tile_shape, self.stride))
+        tiles[:full_rows, :full_cols] = self._strided_tiles(frame, (full_rows, full_cols))
+        for r in range(self.grid_shape[0]):
+            for c in range(full_cols if r < full_rows else 0, self.grid_shape[1]):
+                row0, col0 = r * self.stride[0], c * self.stride[1]
+                rows, cols = min(self.tile_shape[0], self.frame_shape[0] - row0), min(self.tile_shape[1],
+                                                                                      self.frame_shape[1] - col0)
+                tiles[r, c] = 0
+                tiles[r, c, :rows, :cols] = frame[row0:row0 + rows, col0:col0 + cols]
+        return tiles
+
+    def split(self, frame, dtype=None):
+        """
+        Returns the tiles of a frame as one contiguous array.
+
+        :param frame: Array of shape frame_shape (+ channels)
+        :param dtype: Dtype of the tiles, the frame is cast while it is copied (default is the dtype of the frame)
+        :return: Array of shape (len(self),) + tile_shape (+ channels)
+        """
+        tiles = self.tiles(frame, dtype)
+        return tiles.reshape((len(self),) + tiles.shape[2:])
+
+    def merge(self, tiles, out=None):
+        """
+        Stitches tiles back into frames, cropping the padding. Overlapping tiles are averaged.
+
+        :param tiles: Array of n * len(self) tiles of n frames in row-major order, of shape (n * len(self),) +
+        tile_shape (+ channels)
+        :param out: Array of shape (n,) + frame_shape (+ channels) into which the frames are written (Optional)
+        :return: Array of shape (n,) + frame_shape (+ channels)
+        """
+        tiles = np.asarray(tiles)
+        if tiles.shape[1:3] != self.tile_shape or tiles.shape[0] % len(self) != 0:
+            raise ValueError("Tiles of shape {} do not match {}".format(tiles.shape, self))
+        n_frames = tiles.shape[0] // len(self)
+        channels = tiles.shape[3:]
+        if out is None:
+            dtype = np.result_type(tiles.dtype, np.float32) if self.overlapping else tiles.dtype
+            out = np.zeros((n_frames,) + self.frame_shape + channels, dtype=dtype)
+        grids = tiles.reshape((n_frames,) + self.grid_shape + self.tile_shape + channels)
+        for frame, grid in zip(out, grids):
+            if self.overlapping:
+                self._merge_overlapping(grid, frame)
+            else:
+                self._merge(grid, frame)
+        return out
+
+    def _merge(self, grid, frame):
+        # tiles lying completely inside the frame are written through one strided view of it
+        full_rows, full_cols = (f // t for f, t in zip(self.frame_shape, self.tile_shape))
+        row_stride, col_stride = frame.strides[:2]
+        inner = np.lib.stride_tricks.as_strided(frame, shape=(full_rows, full_cols) + self.tile_shape + frame.shape[2:],
+                                                strides=(row_stride * self.tile_shape[0],
+                                                         col_stride * self.tile_shape[1],
+                                                         row_stride, col_stride) + frame.strides[2:])
+        inner[...] = grid[:full_rows, :full_cols]
+        # the cropped tiles of the last row and column
+        for r in range(self.grid_shape[0]):
+            for c in range(full_cols if r < full_rows else 0, self.grid_shape[1]):
+                row0, col0 = r * self.tile_shape[0], c * self.tile_shape[1]
+                rows, cols = min(self.tile_shape[0], self.frame_shape[0] - row0), min(self.tile_shape[1],
+                                                                                      self.frame_shape[1] - col0)
+                frame[row0:row0 + rows, col0:col0 + cols] = grid[r, c, :rows, :cols]
+
+    def _merge_overlapping(self, grid, frame):
+        frame[...] = 0
+        weight = np.zeros(self.frame_shape, dtype=np.float32)
+        for r, c in np.ndindex(*self.grid_shape):
+            row0, col0 = r * self.stride[0], c * self.stride[1]
+            rows, cols = min(self.tile_shape[0], self.frame_shape[0] - row0), min(self.tile_shape[1],
+                                                                                  self.frame_shape[1] - col0)
+            frame[row0:row0 + rows, col0:col0 + cols] += grid[r, c, :rows, :cols]
+            weight[row0:row0 + rows, col0:col0 + cols] += 1
+        frame /= weight.reshape(weight.shape + (1,) * (frame.ndim - 2))
+
+    def tf_merge(self, tiles):
+        """
+        Stitches the tiles of one frame back into the frame with TensorFlow operations, only for grids without
+        overlap.
+
+        :param tiles: Tensor of shape (len(self),) + tile_shape (+ channels)
+        :return: Tensor of shape frame_shape (+ channels)
+        """
+        if self.overlapping:
+            raise ValueError("tf_merge does not support overlapping tiles")
+        channels = tuple(tiles.shape[3:])
+        rank = len(channels)
+        frame = tf.reshape(tiles, self.grid_shape + self.tile_shape + channels)
+        frame = tf.transpose(frame, perm=[0, 2, 1, 3] + list(range(4, 4 + rank)))
+        frame = tf.reshape(frame, self.padded_shape + channels)
+        return frame[:self.frame_shape[0], :self.frame_shape[1]]
+
+
+def merge_frames(tiles, frame_shapes, tile_shape=None):
+    """
+    Stitches consecutive tiles of frames with possibly different shapes back into frames.
+
+    :param tiles: Array of tiles of all frames in frame order
+    :param frame_shapes: Shape (rows, columns) of every frame
+    :param tile_shape: Shape of the tiles (default is the shape of the given tiles)
+    :return: Array of shape (n,) + frame_shape if all frames have the same shape, list of frames otherwise
+    """
+    tile_shape = tiles.shape[1:3] if tile_shape is None else tile_shape
+    frame_shapes = [tuple(int(s) for s in shape[:2]) for shape in frame_shapes]
+    if len(set(frame_shapes)) == 1:
+        return TileGrid(frame_shapes[0], tile_shape).merge(tiles)
+    frames = []
+    start = 0
+    for shape in frame_shapes:
+        grid = TileGrid(shape, tile_shape)
+        frames.append(grid.merge(tiles[start:start + len(grid)])[0])
+        start += len(grid)
+    return frames
@@ -0,0 +1,119 @@
+import argparse
+import sys
+import json
+import numpy as np
+import tensorflow as tf
+
+sys.path.append("../")
+import tools
+
+
+def tile_labels(x, y):
+    # a tile is positive if any of its pixels belongs to a trail
+    return x, tf.reduce_max(tf.reshape(tf.cast(y, tf.float32), [tf.shape(y)[0], -1]), axis=1, keepdims=True)
+
+
+def main(args):
+    if args.gate_destination[-6:] != ".keras":
+        args.gate_destination += ".keras"
+    schema = tools.data.get_dataset_schema(args.train_dataset_path)
+    parse = tools.model.parse_function(img_shape=schema["shape"], test=False, schema=schema, batched=True)
+    dataset_train = tools.data.load_balanced_tfrecord_dataset(args.train_dataset_path,
+                                                              positive_fraction=args.positive_fraction)
+    dataset_train = dataset_train.batch(args.batch_size).map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset_train = dataset_train.map(tile_labels).prefetch(tf.data.AUTOTUNE)
+    # the validation tiles keep the natural fraction of positive tiles, they calibrate the gate threshold
+    dataset_val = tools.data.load_tfrecord_dataset(args.test_dataset_path).batch(args.batch_size)
+    dataset_val = dataset_val.map(parse, num_parallel_calls=tf.data.AUTOTUNE).map(tile_labels).cache()
+    if args.steps_per_epoch <= 0:
+        args.steps_per_epoch = max(tools.data.get_dataset_size(args.train_dataset_path) // args.batch_size, 1)
+
+    gate = tools.model.tile_gate_model(schema["shape"], filters=args.filters, kernel_size=args.kernel_size)
+    gate.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=args.start_lr),
+                 loss="binary_crossentropy",
+                 metrics=[tools.metrics.ConfusionMetrics(thresholds=0.5)])
+    reducelronplateau_kb = tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=2,
+                                                                verbose=1 if args.verbose else 0)
+    gate.fit(dataset_train, epochs=args.epochs, steps_per_epoch=args.steps_per_epoch, validation_data=dataset_val,
+             callbacks=[reducelronplateau_kb], verbose=1 if args.verbose else 2)
+    gate.save(args.gate_destination)
+
+    scores, labels = zip(*[(gate.predict_on_batch(x)[:, 0], y.numpy()[:, 0]) for x, y in dataset_val])
+    scores, labels = np.concatenate(scores), np.concatenate(labels)
+    calibration = {"positive_scores": np.sort(scores[labels > 0]).tolist(),
+                   "num_tiles": int(len(scores)),
+                   "num_positive_tiles": int(np.count_nonzero(labels)),
+                   "recall_targets": {}}
+    for recall in args.recall_targets:
+        threshold = tools.metrics.threshold_for_recall(scores, labels, recall)
+        calibration["recall_targets"][str(recall)] = {"threshold": threshold,
+                                                      "pass_fraction": float(np.mean(scores >= threshold))}
+        print("Recall {}: threshold {:.4f}, {:.2%} of the validation tiles pass the gate".format(
+            recall, threshold, calibration["recall_targets"][str(recall)]["pass_fraction"]))
+    with open(tools.model.gate_calibration_path(args.gate_destination), "w") as f:
+        json.dump(calibration, f, indent=2)
+
+
+def parse_arguments(args):
+    """Parse command line arguments.
+    Args:
+        args (list): Command line arguments.
+    Returns:
+        args (Namespace): Parsed command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(description="Trains the tile gate that skips tiles without trails at inference.")
+
+    parser.add_argument('--train_dataset_path', type=str,
+                        default='../DATA/train1.tfrecord',
+                        help='Path to training dataset.')
+
+    parser.add_argument('--test_dataset_path', type=str,
+                        default='../DATA/test1.tfrecord',
+                        help='Path to test dataset, used to calibrate the gate threshold.')
+
+    parser.add_argument('--gate_destination', type=str,
+                        default="../DATA/Tile_gate",
+                        help='Path where to save the gate once trained.')
+
+    parser.add_argument('--filters', type=int, nargs="+",
+                        default=[8, 16, 32, 32],
+                        help='Number of filters of the strided convolutions.')
+
+    parser.add_argument('--kernel_size', type=int,
+                        default=3,
+                        help='Size of the kernel.')
+
+    parser.add_argument('--positive_fraction', type=float,
+                        default=0.5,
+                        help='Fraction of training tiles containing trail pixels.')
+
+    parser.add_argument('--recall_targets', type=float, nargs="+",
+                        default=[0.95, 0.98, 0.99, 0.995, 0.999],
+                        help='Tile recalls for which the threshold and the fraction of passing tiles are reported.')
+
+    parser.add_argument('--epochs', type=int,
+                        default=8,
+                        help='Number of epochs.')
+
+    parser.add_argument('--steps_per_epoch', type=int,
+                        default=0,
+                        help='Number of steps per epoch.')
+
+    parser.add_argument('--batch_size', type=int,
+                        default=256,
+                        help='Batch size.')
+
+    parser.add_argument('--start_lr', type=float,
+                        default=0.001,
+                        help='Initial learning rate.')
+
+    parser.add_argument('-v', '--verbose', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Verbose output.')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
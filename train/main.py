@@ -50,67 +50,147 @@ def main(args):
             mirrored_strategy = tf.distribute.OneDeviceStrategy(device="/cpu:0")  # Force CPU strategy
             task_type, task_id = (None, None)
 
+    num_workers, worker_index = 1, 0
+    if args.multiworker:
+        num_workers = mirrored_strategy.cluster_resolver.cluster_spec().num_tasks("worker")
+        worker_index = task_id
+
+    def file_shards(dataset_path):
+        # every worker reads only its own files, unless there are fewer files than workers
+        if num_workers > 1 and len(tools.data.get_tfrecord_files(dataset_path)) >= num_workers:
+            return {"num_shards": num_workers, "shard_index": worker_index}
+        return {}
+
     with open(args.arhitecture) as f:
         arhitecture = json.load(f)
     if "0" in arhitecture.keys():
         arhitecture = arhitecture["0"]
     if args.model_destination[-6:] != ".keras":
         args.model_destination += ".keras"
-    dataset_train = tf.data.TFRecordDataset([args.train_dataset_path])
-    tfrecord_shape = tools.model.get_shape_of_quadratic_image_tfrecord(dataset_train)
-    train_size = sum(1 for _ in dataset_train)
-    if not args.multiworker:
-        dataset_train = dataset_train.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False), num_parallel_calls=tf.data.AUTOTUNE)
-        #dataset_train = dataset_train.cache()
-    else:
-        dataset_train = dataset_train.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False))
-    dataset_val = tf.data.TFRecordDataset([args.test_dataset_path])
-    if not args.multiworker:
-        dataset_val = dataset_val.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False), num_parallel_calls=tf.data.AUTOTUNE)
-        #dataset_val = dataset_val.cache()
+    schema = None
+    shards_train, shards_val = {}, {}
+    if args.butler_repo != "" or tools.frames.is_frame_store(args.train_dataset_path):
+        if args.butler_repo != "":
+            frames_train, frames_val = [tools.frames.ButlerFrameCache(args.butler_repo, args.butler_collection,
+                                                                      args.cache_dir or "../DATA/frame_cache",
+                                                                      max_bytes=int(args.cache_size_gb * 2 ** 30),
+                                                                      subset=subset) for subset in ("train", "test")]
+        else:
+            frames_train = tools.frames.FrameStore(args.train_dataset_path, subset="train")
+            frames_val = tools.frames.FrameStore(args.test_dataset_path, subset="test")
+        tfrecord_shape = (args.tile_size, args.tile_size, 1)
+        train_size = len(frames_train) * args.crops_per_frame
+        dataset_train = tools.frames.random_crop_dataset(frames_train, tfrecord_shape[:2],
+                                                         crops_per_frame=args.crops_per_frame)
+        if args.positive_fraction > 0:
+            dataset_train = tools.data.rebalance_dataset(dataset_train, positive_fraction=args.positive_fraction)
+        dataset_val = tools.frames.tile_frame_dataset(frames_val, tfrecord_shape[:2])
     else:
-        dataset_val = dataset_val.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False))
+        shards_train = file_shards(args.train_dataset_path)
+        shards_val = file_shards(args.test_dataset_path)
+        if args.positive_fraction > 0 and args.cache_dir == "":
+            dataset_train = tools.data.load_balanced_tfrecord_dataset(args.train_dataset_path,
+                                                                      positive_fraction=args.positive_fraction,
+                                                                      **shards_train)
+        else:
+            dataset_train = tools.data.load_tfrecord_dataset(args.train_dataset_path, **shards_train)
+        dataset_val = tools.data.load_tfrecord_dataset(args.test_dataset_path, **shards_val)
+        schema = tools.data.get_dataset_schema(args.train_dataset_path)
+        tfrecord_shape = schema["shape"]
+        train_size = tools.data.get_dataset_size(args.train_dataset_path)
+    policy = tools.model.set_precision_policy(args.mixed_precision)
     with mirrored_strategy.scope():
         if os.path.isfile(args.model_destination):
-            model = tf.keras.models.load_model(args.model_destination, compile=False)
+            model = tools.model.load_model(args.model_destination)
+            model = tools.model.cast_model(model, policy)
         else:
-            model = tools.model.unet_model(tfrecord_shape, arhitecture, kernel_size=args.kernel_size)
-        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=args.start_lr),
+            model = tools.model.unet_model(tfrecord_shape, arhitecture, kernel_size=args.kernel_size,
+                                           checkpoint_blocks="all" if args.checkpoint_blocks == ["all"]
+                                           else args.checkpoint_blocks)
+        model = tools.model.accumulating_model(model, args.accumulate_steps)
+        optimizer = tf.keras.optimizers.Adam(learning_rate=args.start_lr)
+        if policy == "mixed_float16":
+            # float16 gradients underflow without loss scaling, bfloat16 has the range of float32 and needs none
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        jit_mode = tools.model.jit_compile_mode(model, args.jit_compile)
+        if jit_mode == "autoclustering":
+            tf.config.optimizer.set_jit("autoclustering")
+        model.compile(optimizer=optimizer,
                       loss=tools.metrics.FocalTversky(alpha=args.alpha, gamma=args.gamma),
-                      metrics=["Precision", "Recall", tools.metrics.F1_Score()])
-
-    if tuple(model.outputs[0].shape[1:]) != tfrecord_shape:
-        dataset_train = dataset_train.map(tools.model.reshape_outputs(img_shape=tuple(model.outputs[0].shape[1:-1])))
-        dataset_val = dataset_val.map(tools.model.reshape_outputs(img_shape=tuple(model.outputs[0].shape[1:-1])))
+                      metrics=[tools.metrics.ConfusionMetrics(thresholds=args.thresholds)],
+                      jit_compile=jit_mode == "xla",
+                      steps_per_execution=args.steps_per_execution)
+
+    output_shape = tuple(model.outputs[0].shape[1:-1])
+    parse = None
+    if schema is not None and args.cache_dir != "":
+        dataset_train = tools.data.snapshot_tfrecord_dataset(args.train_dataset_path, args.cache_dir, schema=schema,
+                                                             output_shape=output_shape, **shards_train)
+        dataset_val = tools.data.snapshot_tfrecord_dataset(args.test_dataset_path, args.cache_dir, schema=schema,
+                                                           output_shape=output_shape, **shards_val)
+        if args.positive_fraction > 0:
+            dataset_train = tools.data.rebalance_dataset(dataset_train, positive_fraction=args.positive_fraction)
+    elif schema is not None:
+        # the serialized records are shuffled and batched first, then every batch is parsed, clipped and its labels
+        # resized (or rasterized from trail segments) at the resolution of the model output in one map
+        parse = tools.model.parse_function(img_shape=tfrecord_shape, test=False, schema=schema,
+                                           output_shape=output_shape, batched=True)
+    elif output_shape != tuple(tfrecord_shape[:2]):
+        dataset_train = dataset_train.map(tools.model.reshape_outputs(img_shape=output_shape))
+        dataset_val = dataset_val.map(tools.model.reshape_outputs(img_shape=output_shape))
+
+    # training batches are split into accumulate_steps micro-batches by the model, validation batches are not split
+    # and hold batch_size tiles
+    def batch(dataset, size, num_parallel_calls=None):
+        dataset = dataset.batch(size)
+        if parse is not None:
+            dataset = dataset.map(parse, num_parallel_calls=num_parallel_calls)
+        return dataset
+
+    dataset_source = dataset_train
     if args.multiworker:
         batch_size = args.batch_size * mirrored_strategy.num_replicas_in_sync
         if args.steps_per_epoch <= 0:
-            args.steps_per_epoch = train_size // batch_size
+            args.steps_per_epoch = train_size // (batch_size * args.accumulate_steps)
             if args.verbose:
                 print("Setting steps_per_epoch to: ", args.steps_per_epoch)
-        dataset_train = dataset_train.repeat().shuffle(train_size // 2).batch(batch_size).prefetch(10)
-        dataset_val = dataset_val.batch(batch_size).prefetch(10)
+        shuffle_buffer = max(min(args.shuffle_buffer, train_size // (2 * num_workers)), 1)
+        num_parallel_calls = None
+        dataset_train = batch(dataset_train.repeat().shuffle(shuffle_buffer), batch_size * args.accumulate_steps,
+                              num_parallel_calls).prefetch(10)
+        dataset_local = dataset_train
+        dataset_val = batch(dataset_val, batch_size).prefetch(10)
+        # datasets sharded by file above are not sharded again, the others are sharded by record
         options_train = tf.data.Options()
-        options_train.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        options_train.experimental_distribute.auto_shard_policy = (tf.data.experimental.AutoShardPolicy.OFF
+                                                                   if shards_train else
+                                                                   tf.data.experimental.AutoShardPolicy.DATA)
         dataset_train = dataset_train.with_options(options_train)
         dataset_train = mirrored_strategy.experimental_distribute_dataset(dataset_train)
         options_val = tf.data.Options()
-        options_val.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        options_val.experimental_distribute.auto_shard_policy = (tf.data.experimental.AutoShardPolicy.OFF
+                                                                 if shards_val else
+                                                                 tf.data.experimental.AutoShardPolicy.DATA)
         dataset_val = dataset_val.with_options(options_val)
         if task_type == 'worker' and task_id == 0:
             print('Number of replicas:', mirrored_strategy.num_replicas_in_sync)
             print("GPUS detected on chief:", len(tf.config.list_physical_devices('GPU')))
+            print("Training data sharded by", "file" if shards_train else "record")
     else:
         if len(tf.config.list_physical_devices('GPU')) == 0:
             batch_size = args.batch_size
         else:
             batch_size = args.batch_size * len(tf.config.list_physical_devices('GPU'))
         if args.steps_per_epoch <= 0:
-            args.steps_per_epoch = train_size // batch_size
+            args.steps_per_epoch = train_size // (batch_size * args.accumulate_steps)
             if args.verbose:
                 print("Setting steps_per_epoch to:", args.steps_per_epoch)
-        dataset_train = dataset_train.repeat().shuffle(train_size // 100).batch(batch_size).prefetch(tf.data.AUTOTUNE)
-        dataset_val = dataset_val.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        shuffle_buffer = max(min(args.shuffle_buffer, train_size // 100), 1)
+        num_parallel_calls = tf.data.AUTOTUNE
+        dataset_train = batch(dataset_train.repeat().shuffle(shuffle_buffer), batch_size * args.accumulate_steps,
+                              num_parallel_calls).prefetch(tf.data.AUTOTUNE)
+        dataset_local = dataset_train
+        dataset_val = batch(dataset_val, batch_size, tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
 
     earlystopping_kb = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=5 * args.decay_lr_patience,
                                                         verbose=1,
@@ -137,6 +217,18 @@ def main(args):
                                                            save_best_only=True,
                                                            initial_value_threshold=0.1)
         kb = [terminateonnan_kb, reducelronplateau_kb, checkpoint_kb]
+    if args.backup:
+        # the weights, optimizer state and epoch are backed up periodically and restored when the job is restarted
+        # after a preemption, every worker writes its own backup
+        backup_dir = args.backup_dir or args.model_destination[:-len(".keras")] + "_backup"
+        if not ((task_type == 'worker' and task_id == 0) or task_type is None):
+            backup_dir += "_worker" + str(task_id)
+        kb.insert(0, tf.keras.callbacks.BackupAndRestore(backup_dir, save_freq=args.backup_freq or "epoch",
+                                                         double_checkpoint=True))
+    if args.profile:
+        profile_dir = args.profile_dir or args.model_destination[:-len(".keras")] + "_profile"
+        profiler = tools.profiling.StepProfiler(profile_dir, profile_steps=args.profile_steps)
+        kb.append(profiler)
     if (task_type == 'worker' and task_id == 0) or task_type is None:
         if args.verbose:
             verbose = 1
@@ -147,6 +239,24 @@ def main(args):
     results = model.fit(dataset_train, epochs=args.epochs, validation_data=dataset_val, callbacks=kb, verbose=verbose,
                         steps_per_epoch=args.steps_per_epoch)
 
+    if args.profile:
+        # batch latencies of the input pipeline cut after each stage, and the step time of the model on a batch held
+        # in memory, which separates the time the training steps waited for their input
+        global_batch_size = batch_size * args.accumulate_steps
+        stages = {"read": dataset_source.repeat().batch(global_batch_size),
+                  "shuffle": dataset_source.repeat().shuffle(shuffle_buffer).batch(global_batch_size)}
+        if parse is not None:
+            stages["parse"] = stages["shuffle"].map(parse, num_parallel_calls=num_parallel_calls)
+        stages["prefetch"] = dataset_local
+        stage_latencies = {name: tools.profiling.time_dataset(stage) for name, stage in stages.items()}
+        compute_times = tools.profiling.time_train_steps(model, next(iter(dataset_local)))
+        report = tools.profiling.bottleneck_report(profiler.step_times, compute_times, stage_latencies,
+                                                   epoch_starts=profiler.epoch_starts)
+        if (task_type == 'worker' and task_id == 0) or task_type is None:
+            print(tools.profiling.write_report(report, profile_dir))
+        else:
+            tools.profiling.write_report(report, profile_dir, name="profile_summary_worker" + str(task_id))
+
 
 def parse_arguments(args):
     """Parse command line arguments.
@@ -160,12 +270,43 @@ def parse_arguments(args):
 
     parser.add_argument('--train_dataset_path', type=str,
                         default='../DATA/train1.tfrecord',
-                        help='Path to training dataset.')
+                        help='Path to training dataset (TFRecord dataset or frame store directory).')
 
     parser.add_argument('--test_dataset_path', type=str,
                         default='../DATA/test1.tfrecord',
                         help='Path to test dataset.')
 
+    parser.add_argument('--butler_repo', type=str,
+                        default="",
+                        help='Read the training data lazily from this Butler repository instead of a dataset file.')
+
+    parser.add_argument('--butler_collection', type=str,
+                        default="",
+                        help='Collection with the injected calexps and catalogs used with --butler_repo.')
+
+    parser.add_argument('--cache_dir', type=str,
+                        default="",
+                        help='Directory of on-disk caches. TFRecord datasets are parsed once into compressed '
+                             'snapshots stored there, with --butler_repo it holds the frame cache '
+                             '(default ../DATA/frame_cache).')
+
+    parser.add_argument('--cache_size_gb', type=float,
+                        default=100,
+                        help='Maximum size of the on-disk frame cache in GB.')
+
+    parser.add_argument('--tile_size', type=int,
+                        default=128,
+                        help='Size of the tiles cropped from a frame store.')
+
+    parser.add_argument('--crops_per_frame', type=int,
+                        default=64,
+                        help='Number of random crops drawn from every frame of a frame store per epoch.')
+
+    parser.add_argument('--positive_fraction', type=float,
+                        default=0,
+                        help='Resample the training tiles so that this fraction of them contains trail pixels '
+                             '(0 keeps the natural fraction).')
+
     parser.add_argument('--arhitecture', type=str,
                         default="../arhitecture.json",
                         help='Path to a JSON containing definition of an arhitecture.')
@@ -178,6 +319,59 @@ def parse_arguments(args):
                         default=False,
                         help='Use multiworker strategy.')
 
+    parser.add_argument('--shuffle_buffer', type=int,
+                        default=10000,
+                        help='Maximum number of training records held in the shuffle buffer.')
+
+    parser.add_argument('--backup', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Periodically back up the training state and resume from it after a restart, e.g. a '
+                             'resubmitted preempted job (--no-backup disables it).')
+
+    parser.add_argument('--backup_dir', type=str,
+                        default="",
+                        help='Directory of the training state backup (default <model_destination>_backup).')
+
+    parser.add_argument('--backup_freq', type=int,
+                        default=0,
+                        help='Back up the training state every this many batches (0 backs up every epoch).')
+
+    parser.add_argument('--profile', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Record the step times, capture a profiler trace of --profile_steps and write a summary '
+                             'of the input wait and the tf.data stage latencies.')
+
+    parser.add_argument('--profile_steps', type=int, nargs=2,
+                        default=[10, 20],
+                        help='First and last training step of the profiler trace.')
+
+    parser.add_argument('--profile_dir', type=str,
+                        default="",
+                        help='Directory of the profiler trace and summary (default <model_destination>_profile).')
+
+    parser.add_argument('--mixed_precision', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Train in mixed precision (float16 on GPUs, bfloat16 on CPUs).')
+
+    parser.add_argument('--jit_compile', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Compile the training step with XLA (XLA auto-clustering if the model cannot be '
+                             'compiled as a whole).')
+
+    parser.add_argument('--steps_per_execution', type=int,
+                        default=1,
+                        help='Number of batches run in one compiled call.')
+
+    parser.add_argument('--accumulate_steps', type=int,
+                        default=1,
+                        help='Split every batch of accumulate_steps * batch_size tiles into micro-batches of '
+                             'batch_size and apply the summed gradients once, for large effective batches.')
+
+    parser.add_argument('--checkpoint_blocks', type=str, nargs="*",
+                        default=[],
+                        help='Mini blocks (e.g. eblock5 dblock0, or all) whose activations are recomputed in the '
+                             'backward pass instead of stored, to train larger tiles or batches.')
+
     parser.add_argument('--kernel_size', type=int,
                         default=3,
                         help='Size of the kernel.')
@@ -202,6 +396,11 @@ def parse_arguments(args):
                         default=3,
                         help='Gamma parameter in loss function.')
 
+    parser.add_argument('--thresholds', type=float, nargs="+",
+                        default=[0.5],
+                        help='Thresholds of the precision, recall and F1 score metrics, the F1 score at the first one '
+                             'selects the saved model.')
+
     parser.add_argument('--batch_size', type=int,
                         default=32,
                         help='Batch size.')
@@ -30,15 +30,14 @@ def main(args):
     training_parameters = None
     print("Program started at: ", time.ctime())
     start_time = time.time()
-    dataset_train = tf.data.TFRecordDataset([args.train_dataset_path])
-    tfrecord_shape = tools.model.get_shape_of_quadratic_image_tfrecord(dataset_train)
-    dataset_train = dataset_train.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False))
-    dataset_val = tf.data.TFRecordDataset([args.test_dataset_path])
-    dataset_val = dataset_val.map(tools.model.parse_function(img_shape=tfrecord_shape, test=False))
-    dataset_train = dataset_train.map(tools.model.reshape_outputs(img_shape=(32, 32)))
-    dataset_val = dataset_val.map(tools.model.reshape_outputs(img_shape=(32, 32)))
-    dataset_train = dataset_train.shuffle(5 * args.batch_size).batch(args.batch_size).prefetch(2)
-    dataset_val = dataset_val.batch(args.batch_size).prefetch(2)
+    dataset_train = tools.data.load_tfrecord_dataset(args.train_dataset_path)
+    schema = tools.data.get_dataset_schema(args.train_dataset_path)
+    tfrecord_shape = schema["shape"]
+    parse = tools.model.parse_function(img_shape=tfrecord_shape, test=False, schema=schema, output_shape=(32, 32),
+                                       batched=True)
+    dataset_val = tools.data.load_tfrecord_dataset(args.test_dataset_path)
+    dataset_train = dataset_train.shuffle(5 * args.batch_size).batch(args.batch_size).map(parse).prefetch(2)
+    dataset_val = dataset_val.batch(args.batch_size).map(parse).prefetch(2)
     strategy = tf.distribute.MirroredStrategy()
     #strategy = tf.distribute.get_strategy()
     earlystopping_kb = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=5 * args.decay_lr_patience,